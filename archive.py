@@ -0,0 +1,161 @@
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+# Keeps the raw body of every API response in gzip compressed JSONL segments,
+# <directory>/<prefix>-<start>-<pid>-<n>.jsonl.gz, one {"name", "url", "fetched_at",
+# "body"} line per response. A segment is a series of gzip members of about
+# block_size bytes each, so `zcat` reads it whole and the replay decompresses only
+# the block it needs. A new segment starts once one reaches segment_size.
+#
+# <directory>/index.sqlite maps every url and fetch time to the segment, block
+# offset and line of its response. Lines reach the index once their block is
+# written, flush() writes the open block at the end of every pass.
+class ResponseArchive:
+    def __init__(self, directory, prefix="archive", segment_size=256 * 1024 * 1024, block_size=1024 * 1024):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.index = open_index(directory)
+        self.file = None
+        self.segment = None
+        self.segment_count = 0
+        self.lines = []
+        self.entries = []
+        self.block_bytes = 0
+        self.responses = 0
+
+    # Runs on the worker threads, the encoding happens outside the lock
+    def add(self, name, url, content):
+        fetched_at = time.time()
+        line = json.dumps({
+            "name": name, "url": url, "fetched_at": fetched_at, "body": content.decode("utf-8", "replace")
+        }).encode()
+        with self.lock:
+            self.entries.append((url, fetched_at, name, len(self.lines)))
+            self.lines.append(line)
+            self.block_bytes += len(line) + 1
+            self.responses += 1
+            if self.block_bytes >= self.block_size:
+                self.write_block()
+
+    def write_block(self):
+        if not self.lines:
+            return
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self.open_segment()
+        offset = self.file.tell()
+        # Level 6 keeps up with the fetching
+        self.file.write(gzip.compress(b"\n".join(self.lines) + b"\n", compresslevel=6))
+        self.file.flush()
+        self.index.executemany(
+            "INSERT INTO responses (url, fetched_at, name, segment, offset, line) VALUES (?, ?, ?, ?, ?, ?)",
+            [(url, fetched_at, name, self.segment, offset, line) for url, fetched_at, name, line in self.entries]
+        )
+        self.index.commit()
+        self.lines = []
+        self.entries = []
+        self.block_bytes = 0
+
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+            logging.info(f"archive: closed {self.segment}")
+        self.segment_count += 1
+        self.segment = f"{self.prefix}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.segment_count}.jsonl.gz"
+        self.file = open(os.path.join(self.directory, self.segment), "ab")
+
+    def flush(self):
+        with self.lock:
+            self.write_block()
+
+    def report(self):
+        return f"{self.responses} responses, segment {self.segment}"
+
+    def close(self):
+        with self.lock:
+            self.write_block()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.index.close()
+
+
+# Reads the responses back by url for the replay: the latest one fetched at or
+# before `until` (a timestamp, None for the latest of all)
+class ArchiveReader:
+    cache_size = 64
+
+    def __init__(self, directory, until=None):
+        if not os.path.exists(os.path.join(directory, "index.sqlite")):
+            raise RuntimeError(f"There is no archive in {directory}. Fetch with archive=true first.")
+        self.directory = directory
+        self.until = until if until is not None else float("inf")
+        self.lock = threading.Lock()
+        self.index = open_index(directory)
+        # The last blocks read, the pages of one employee are mostly in the same one
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # The raw body archived for url and when it was fetched, None if it never was
+    def get(self, url):
+        with self.lock:
+            found = self.index.execute(
+                "SELECT segment, offset, line, fetched_at FROM responses WHERE url = ? AND fetched_at <= ? ORDER BY fetched_at DESC LIMIT 1",
+                (url, self.until)
+            ).fetchone()
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            segment, offset, line, fetched_at = found
+            lines = self.blocks.get((segment, offset))
+            if lines is not None:
+                self.blocks.move_to_end((segment, offset))
+        if lines is None:
+            lines = self.read_block(segment, offset)
+            with self.lock:
+                self.blocks[(segment, offset)] = lines
+                while len(self.blocks) > self.cache_size:
+                    self.blocks.popitem(last=False)
+        return json.loads(lines[line])["body"].encode(), fetched_at
+
+    # Decompress the one gzip member that starts at offset
+    def read_block(self, segment, offset):
+        decompressor = zlib.decompressobj(wbits=31)
+        data = []
+        with open(os.path.join(self.directory, segment), "rb") as file:
+            file.seek(offset)
+            while not decompressor.eof:
+                chunk = file.read(65536)
+                if not chunk:
+                    break
+                data.append(decompressor.decompress(chunk))
+        return b"".join(data).split(b"\n")
+
+    def report(self):
+        return f"{self.hits} responses replayed, {self.misses} not archived"
+
+    def close(self):
+        self.index.close()
+
+
+def open_index(directory):
+    index = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=60, check_same_thread=False)
+    index.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT, fetched_at REAL, name TEXT, segment TEXT, offset INTEGER, line INTEGER)")
+    index.execute("CREATE INDEX IF NOT EXISTS ix_responses_url ON responses (url, fetched_at)")
+    index.commit()
+    return index
+
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from request_cache import current_client, current_employee
+from paginator import with_page_size
+from log_writer import Body
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# Runs one pass of Main over aiohttp instead of the blocking requests.Session.
+# The transform and insert code stays in Main, only the HTTP calls are async.
+class AsyncEngine:
+    max_in_flight = 64
+    endpoint_limits = {
+        "clients": 2,
+        "client_details": 4,
+        "employees": 4,
+        "employee_details": 16,
+        "jobs": 16,
+        "check_list": 16,
+        "check_details": 48,
+    }
+
+    def __init__(self, main, max_in_flight=None, endpoint_limits=None):
+        if aiohttp is None:
+            raise RuntimeError("The async engine needs aiohttp. Install it with: pip install aiohttp")
+        self.main = main
+        self.max_in_flight = max_in_flight or self.max_in_flight
+        self.endpoint_limits = dict(self.endpoint_limits)
+        self.endpoint_limits.update(endpoint_limits or {})
+        # pyodbc is blocking, keep all the inserts on one thread off the event loop
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+
+    def run(self):
+        try:
+            asyncio.run(self.start_requests())
+        finally:
+            self.db_executor.shutdown()
+
+    async def start_requests(self):
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.endpoint_limits.items()}
+        transport = self.main.transport
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(sock_connect=transport.connect_timeout, sock_read=transport.read_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            client_list = (await self.get_reference("clients", f"{self.main.api_endpoint}/clients", "get_client_list", "run") or {}).get("results", [])
+            for client_index, resume in self.main.claim_clients(client_list):
+                await self.parse_client(client_list, client_index, resume)
+
+            if client_list:
+                await asyncio.get_running_loop().run_in_executor(self.db_executor, self.main.save_checkpoint, True)
+
+    async def parse_client(self, client_list, client_index, resume):
+        main = self.main
+        client_started = time.perf_counter()
+        client = client_list[client_index]
+        current_client.set(client.get("id"))
+        client_details = await self.get_reference(
+            "client_details", main.get_client_details_url(client), "get_client_details", "client", main.get_fingerprint(client)
+        )
+        main.set_client(client, client_details or {})
+
+        pending = deque()
+        walked = False
+        try:
+            page_url, skip = main.get_employee_page_url(client, resume)
+
+            async for page_url, data in self.pages("employees", "get_employee_list", page_url):
+                logging.info("client_id: %s | page_url: %s", client.get("id"), page_url)
+                if data is None:
+                    logging.error(f"get_employee_list: giving up on client_id: {main.validate(client.get('id'))} at page_url: {page_url}")
+                    break
+
+                for employee_index, employee in enumerate(data.get("results", [])):
+                    if employee_index < skip or main.is_exception_employee(employee):
+                        continue
+
+                    position = main.get_position(client_list, client_index, page_url, employee_index + 1)
+                    pending.append((position, asyncio.ensure_future(self.fetch_employee(employee))))
+                    await self.drain_employees(pending, self.max_in_flight)
+                    main.metrics.queue_depth.set("employees", value=len(pending))
+                skip = 0
+            else:
+                walked = True
+
+        except Exception as e:
+            logging.exception(f"get_employee_list: {e}")
+
+        await self.drain_employees(pending, 0)
+        main.position = main.get_position(client_list, client_index + 1, None, 0)
+        await asyncio.get_running_loop().run_in_executor(self.db_executor, main.flush_loaders)
+        await asyncio.get_running_loop().run_in_executor(self.db_executor, main.complete_client, client, walked)
+        main.request_cache.clear("client", client.get("id"))
+        main.profiler.record("client", time.perf_counter() - client_started)
+
+    # Store the finished employees in the order they were submitted
+    async def drain_employees(self, pending, limit):
+        loop = asyncio.get_running_loop()
+        while len(pending) > limit:
+            position, task = pending.popleft()
+            result = await task
+            await loop.run_in_executor(self.db_executor, self.store_employee, result, position)
+
+    def store_employee(self, result, position):
+        self.main.store_employee(result)
+        self.main.position = position
+
+    async def fetch_employee(self, employee):
+        current_employee.set(employee.get("id"))
+        try:
+            jobs = await self.get_employee_jobs(employee)
+            if self.main.name == "details":
+                return employee, [await self.get_employee_details(employee, jobs)], None
+
+            watermark = self.main.get_watermark(employee)
+            employee_check_list, last_page_url, walked = await self.walk_employee_check_list(employee, watermark)
+            employee_check_list, watermark = self.main.select_new_checks(employee_check_list, watermark, last_page_url)
+            employee_check_list = self.main.skip_loaded_checks(employee_check_list)
+            employee_check_details_list = await asyncio.gather(
+                *[self.get_employee_check_details(employee_check, jobs) for employee_check in employee_check_list]
+            )
+            if not walked or not all(employee_check_details_list):
+                watermark = None
+            return employee, list(employee_check_details_list), watermark
+
+        except Exception as e:
+            logging.exception(f"fetch_employee: {employee.get('id')}: {e}")
+        finally:
+            self.main.request_cache.clear("employee", employee.get("id"))
+        return employee, [], None
+
+    # A refresh is a blocking call, keep it off the event loop
+    async def get_access_token(self):
+        tokens = self.main.tokens
+        return tokens.peek() or await asyncio.get_running_loop().run_in_executor(None, tokens.get_access_token)
+
+    # Async version of Paginator.pages, the next page is fetched by its own task
+    async def pages(self, endpoint, name, url, scope=None, stop=None):
+        paginator = self.main.paginator
+        url = with_page_size(url, paginator.page_size, paginator.page_size_param)
+        task = asyncio.ensure_future(self.get_json(endpoint, url, name, scope)) if url else None
+        try:
+            while task is not None:
+                data = await task
+                task = None
+                if data is None:
+                    yield url, None
+                    return
+                next_url = data.get("nextPageUrl")
+                if stop is not None and stop(data):
+                    next_url = None
+                if next_url:
+                    task = asyncio.ensure_future(self.get_json(endpoint, next_url, name, scope))
+                yield url, data
+                url = next_url
+        finally:
+            if task is not None:
+                task.cancel()
+
+    # See Main.get_reference
+    async def get_reference(self, endpoint, url, name, scope, fingerprint=None):
+        data = self.main.lookup_reference(name, url, fingerprint)
+        if data is None:
+            data = await self.get_json(endpoint, url, name, scope)
+            self.main.reference_cache.store(url, data, fingerprint)
+        return data
+
+    # GET a url once per scope, see Main.api_get
+    async def get_json(self, endpoint, url, name, scope=None):
+        if scope is None:
+            return await self.fetch_json(endpoint, url, name)
+        return await self.main.request_cache.get_async(
+            name, scope, self.main.get_scope_key(scope), url, lambda: self.fetch_json(endpoint, url, name)
+        )
+
+    # GET a url under the global and the per endpoint limits, None if it failed
+    # Same retry policy as Main.request_json, on top of the shared rate controller.
+    # The profile gets the wall clock only, the CPU time of the loop is shared.
+    async def fetch_json(self, endpoint, url, name):
+        rate = self.main.rate
+        phase_started = time.perf_counter()
+        attempt = 0
+        token_retried = False
+        try:
+            while True:
+                access_token = await self.get_access_token()
+                async with self.semaphores[endpoint], self.in_flight:
+                    await rate.acquire_async()
+                    started = time.time()
+                    try:
+                        async with self.session.get(url, headers=self.main.get_headers(access_token)) as response:
+                            status = response.status
+                            retry_after = response.headers.get("Retry-After")
+                            body = await response.read()
+                        self.main.record_request(endpoint, status, time.time() - started, len(body))
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        status = None
+                        retry_after = None
+                        body = str(e).encode()
+                        self.main.record_request(endpoint, "error", time.time() - started, 0)
+                    finally:
+                        rate.release()
+
+                rate.record(status, time.time() - started, retry_after)
+                if status == 401 and not token_retried:
+                    logging.warning(f"{name}: 401, refreshing the token")
+                    self.main.tokens.invalidate(access_token)
+                    token_retried = True
+                    continue
+                if rate.should_retry(status, attempt):
+                    delay = rate.retry_delay(attempt, retry_after)
+                    logging.warning(f"{name}: {status} | retry {attempt + 1} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                if status == 200:
+                    if self.main.archive is not None:
+                        self.main.archive.add(name, url, body)
+                    return self.main.decode(name, body)
+                logging.error("%s: %s: %s", name, status, Body(body))
+                return None
+        except Exception as e:
+            logging.exception(f"{name}: {e}")
+        finally:
+            self.main.profiler.record(endpoint, time.perf_counter() - phase_started)
+        return None
+
+    async def get_employee_jobs(self, employee):
+        employee_link = self.main.get_link(employee, "self")
+        return await self.get_json("jobs", f"{employee_link}/jobs", "get_employee_jobs", "employee") or []
+
+    async def get_employee_details(self, employee, jobs):
+        main = self.main
+        employee_details = await self.get_json("employee_details", main.get_link(employee, "self"), "get_employee_details", "employee") or {}
+        try:
+            employee_check_details = {}
+            if not main.has_job_organizations(jobs):
+                # Only the first check with details is needed, the rest of the list is not read
+                employee_checks = self.get_employee_check_list(employee)
+                try:
+                    async for employee_check in employee_checks:
+                        employee_check_details = await self.get_employee_check_details(employee_check, [])
+                        if employee_check_details:
+                            break
+                finally:
+                    await employee_checks.aclose()
+            await self.add_organizations(employee_details, jobs, employee_check_details)
+        except Exception as e:
+            logging.exception(f"get_employee_details: {e}")
+        return employee_details
+
+    # Get the checks by employee, yielded page by page like Main.get_employee_check_list
+    async def get_employee_check_list(self, employee):
+        pages = self.pages("check_list", "get_employee_check_list", self.main.get_link(employee, "Checks"), "employee")
+        try:
+            async for _, data in pages:
+                if data is None:
+                    return
+                for employee_check in data.get("results", []):
+                    yield employee_check
+        finally:
+            await pages.aclose()
+
+    # See Main.walk_employee_check_list
+    async def walk_employee_check_list(self, employee, watermark):
+        employee_check_list = []
+        last_page_url = None
+        walked = False
+        try:
+            pages = self.pages(
+                "check_list", "get_employee_check_list", self.main.get_check_list_start(employee, watermark), "employee",
+                lambda data: self.main.reached_watermark(data["results"], watermark)
+            )
+            async for page_url, data in pages:
+                if data is None:
+                    break
+                employee_check_list += data["results"]
+                last_page_url = page_url
+            else:
+                walked = True
+
+        except Exception as e:
+            logging.exception(f"get_employee_check_list: {e}")
+
+        logging.info("get_employee_check_list: %s", len(employee_check_list))
+        return employee_check_list, last_page_url, walked
+
+    async def get_employee_check_details(self, employee_check, jobs):
+        main = self.main
+        employee_check_details = await self.get_json(
+            "check_details", main.get_link(employee_check, "self"), "get_employee_check_details", "employee"
+        ) or {}
+        try:
+            await self.add_organizations(employee_check_details, jobs, employee_check_details)
+        except Exception as e:
+            logging.exception(f"get_employee_check_details: {e}")
+        return employee_check_details
+
+    # See Main.add_organizations, the refresh is a blocking call and runs off the event loop
+    async def add_organizations(self, record, jobs, employee_check_details):
+        try:
+            self.main.map_organizations(record, jobs, employee_check_details)
+        except KeyError:
+            await asyncio.get_running_loop().run_in_executor(None, self.main.refresh_client_details)
+            self.main.map_organizations(record, jobs, employee_check_details)
+
+
+# "check_details:64,jobs:8" -> {"check_details": 64, "jobs": 8}
+def parse_endpoint_limits(value):
+    limits = {}
+    for item in (value or "").split(","):
+        if ":" in item:
+            name, limit = item.split(":", 1)
+            limits[name.strip()] = int(limit)
+    return limits
@@ -0,0 +1,274 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+from loader import BulkLoader
+from run_me import Main
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Scripted scenarios: the mock size, the Main mode and how many passes run.
+# Only the last pass is measured, the ones before it fill the sink.
+scenarios = {
+    "backfill": {
+        "name": "checks", "clients": 10, "employees": 1000, "checks": 4, "passes": 1,
+        "help": "first checks pass over 10k employees into an empty database",
+    },
+    "steady": {
+        "name": "checks", "clients": 10, "employees": 1000, "checks": 4, "passes": 2, "new_checks": 1,
+        "help": "checks pass after a pay run, one new check per employee",
+    },
+    "lists": {
+        "name": "checks", "clients": 2, "employees": 100, "checks": 100, "passes": 2, "flags": ["--full"],
+        "help": "full walk of long check lists that are already loaded, mostly list page decoding",
+    },
+    "details": {
+        "name": "details", "clients": 10, "employees": 1000, "checks": 1, "passes": 1,
+        "help": "daily employee details pass over 10k employees",
+    },
+}
+
+
+# Stands in for the SQL Server tables. It keeps the counts, the stored checks and
+# the watermarks, which is all a later pass reads back.
+class MemorySink:
+    def __init__(self, keep_rows=False, flush_delay=0):
+        self.keep_rows = keep_rows
+        # Seconds every flush takes, stands in for the database round trips
+        self.flush_delay = flush_delay
+        self.rows = {}
+        self.counts = {}
+        self.check_ids = []
+        self.watermarks = {}
+        self.lock = threading.Lock()
+
+    def insert(self, table, columns, rows):
+        if self.flush_delay:
+            time.sleep(self.flush_delay)
+        with self.lock:
+            return self.insert_rows(table, columns, rows)
+
+    def insert_rows(self, table, columns, rows):
+        self.counts[table] = self.counts.get(table, 0) + len(rows)
+        if self.keep_rows:
+            self.rows.setdefault(table, []).extend(rows)
+        if table == "employee_checks":
+            earning_group = columns.index("earning_group")
+            system_id = columns.index("system_id")
+            self.check_ids.extend(row[system_id] for row in rows if row[earning_group] == "NetPay")
+        return len(rows)
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+# The BulkLoader interface on top of a MemorySink
+class MemoryLoader(BulkLoader):
+    sink = "memory"
+
+    def __init__(self, memory_sink, table, columns, key_columns, batch_size=1000, flush_interval=30):
+        super().__init__(None, table, columns, key_columns, batch_size, flush_interval)
+        self.memory_sink = memory_sink
+
+    def set_connection(self, conn):
+        pass
+
+    def flush(self):
+        inserted = self.memory_sink.insert(self.table, self.columns, self.rows) if self.rows else 0
+        self.inserted += inserted
+        self.rows = []
+        self.last_flush = time.time()
+        return inserted
+
+
+# Main with the database swapped for a MemorySink, the API calls are unchanged
+class BenchmarkMain(Main):
+    def __init__(self, sink, argv=None, config=None):
+        self.sink = sink
+        super().__init__(argv, config)
+
+    def connect_database(self):
+        self.setup_loaders()
+
+    def open_connection(self):
+        return None
+
+    def make_loaders(self, conn, part=None):
+        return {
+            table: [MemoryLoader(self.sink, table, columns, key_columns, self.batch_size, self.flush_interval)] if self.get_table_sinks(table) else []
+            for table, columns, key_columns in self.get_tables()
+        }
+
+    def disconnect_database(self):
+        self.flush_loaders()
+        self.close_loaders()
+
+    def load_watermarks(self):
+        self.watermarks = {}
+        if self.name == "checks" and self.incremental:
+            self.watermarks = dict(self.sink.watermarks)
+
+    def load_check_index(self):
+        if self.name == "checks" and self.use_check_index:
+            self.check_index.load([self.sink.check_ids])
+
+    def load_employee_hashes(self):
+        pass
+
+    def save_watermarks(self, watermarks, conn):
+        self.sink.watermarks.update(watermarks)
+
+
+# Runs the mock API in its own process, so it does not share the GIL with the client
+class MockProcess:
+    def __init__(self, args):
+        command = [
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_isolved.py"),
+            "--port", "0",
+            "--clients", str(args.clients),
+            "--employees", str(args.employees),
+            "--checks", str(args.checks),
+            "--lines", str(args.lines),
+            "--page-size", str(args.mock_page_size),
+            "--latency", str(args.latency),
+            "--jitter", str(args.jitter),
+            "--throttle-rate", str(args.throttle_rate),
+            "--retry-after", str(args.retry_after),
+        ]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        self.base_url = self.process.stdout.readline().strip()
+        if not self.base_url:
+            raise RuntimeError("The mock server did not start")
+
+    def control(self, path, method="GET"):
+        with urlopen(Request(f"{self.base_url}/{path}", data=b"" if method == "POST" else None, method=method)) as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 if sys.platform != "darwin" else peak / 1024 / 1024
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Benchmark run_me.py against a local mock API")
+    parser.add_argument("scenario", choices=list(scenarios),
+                        help="; ".join(f"{name}: {scenario['help']}" for name, scenario in scenarios.items()))
+    parser.add_argument("--clients", type=int)
+    parser.add_argument("--employees", type=int, help="employees per client")
+    parser.add_argument("--checks", type=int, help="checks per employee")
+    parser.add_argument("--lines", type=int, default=5, help="earning lines per check")
+    parser.add_argument("--mock-page-size", type=int, default=100, help="page size of the mock when none is asked")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of the requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds every flush into the sink takes")
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument("--engine", choices=Main.engines, default="sync")
+    parser.add_argument("--max-in-flight", type=int, default=64)
+    parser.add_argument("--rate-limit", type=float, default=0, help="0 turns the pacing off")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="any other .env setting")
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    args = parser.parse_args(argv)
+    for key in ["clients", "employees", "checks"]:
+        if getattr(args, key) is None:
+            setattr(args, key, scenarios[args.scenario][key])
+    return args
+
+
+def run(args):
+    scenario = scenarios[args.scenario]
+    mock = MockProcess(args)
+    work_dir = tempfile.mkdtemp(prefix="isolved-benchmark-")
+    try:
+        config = {
+            "api_endpoint": mock.base_url,
+            "client_id": "benchmark",
+            "client_secret": "benchmark",
+            "thread_count": str(args.threads),
+            "engine": args.engine,
+            "max_in_flight": str(args.max_in_flight),
+            "rate_limit": str(args.rate_limit),
+            "retry_base": "0.05",
+            "retry_cap": "5",
+            "checkpoint_file": os.path.join(work_dir, "checkpoint.json"),
+            "reference_cache_file": os.path.join(work_dir, "reference.json"),
+        }
+        for item in args.set:
+            key, value = item.split("=", 1)
+            config[key] = value
+        sink = MemorySink(flush_delay=args.db_latency)
+        main = BenchmarkMain(sink, [scenario["name"], "--no-resume"] + scenario.get("flags", []), config)
+
+        for _ in range(scenario["passes"] - 1):
+            main.run_pass()
+            mock.control(f"_checks?add={scenario.get('new_checks', 0)}", "POST")
+
+        rows_before = sink.total()
+        requests_before = mock.control("_stats")
+        decode_before = sum(main.metrics.decode_seconds.values.values())
+        started = time.time()
+        main.run_pass()
+        elapsed = time.time() - started
+        decode_seconds = sum(main.metrics.decode_seconds.values.values()) - decode_before
+        stats = mock.control("_stats")
+    finally:
+        mock.stop()
+
+    requests_made = stats["total"] - requests_before["total"]
+    rows = sink.total() - rows_before
+    return {
+        "scenario": args.scenario,
+        "engine": args.engine,
+        "threads": args.threads,
+        "employees": args.clients * args.employees,
+        "seconds": round(elapsed, 2),
+        "requests": requests_made,
+        "requests_per_second": round(requests_made / elapsed, 1) if elapsed else None,
+        "rows": rows,
+        "rows_per_second": round(rows / elapsed, 1) if elapsed else None,
+        "throttled": stats["throttled"] - requests_before["throttled"],
+        "wire_mb": round((stats["bytes_sent"] - requests_before["bytes_sent"]) / 1024 / 1024, 1),
+        "json_decoder": main.json_decoder.library,
+        "decode_seconds": round(decode_seconds, 3),
+        "peak_rss_mb": round(get_peak_rss(), 1) if resource is not None else None,
+        "requests_by_endpoint": {
+            endpoint: count - requests_before["requests"].get(endpoint, 0)
+            for endpoint, count in stats["requests"].items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = run(args)
+    logging.info(f"benchmark: {json.dumps(result)}")
+    print(
+        f"{result['scenario']}: {result['employees']} employees in {result['seconds']}s | "
+        f"requests: {result['requests']} ({result['requests_per_second']}/s) | "
+        f"rows: {result['rows']} ({result['rows_per_second']}/s) | "
+        f"throttled: {result['throttled']} | wire: {result['wire_mb']} MB | decode: {result['decode_seconds']}s ({result['json_decoder']}) | "
+        f"peak_rss: {result['peak_rss_mb']} MB"
+    )
+    print(json.dumps(result["requests_by_endpoint"]))
+    if args.output:
+        with open(args.output, "a") as output_file:
+            output_file.write(json.dumps(result) + "\n")
@@ -0,0 +1,73 @@
+import operator
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain, islice
+
+
+# The ids of the checks already in employee_checks. Numeric ids live in a sorted
+# int64 array (8 bytes a check), new ones go to a small set that is merged into
+# the array from time to time. Anything that is not a number goes to a plain set.
+class CheckIndex:
+    merge_size = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = array("q")
+        self.recent = set()
+        self.other = set()
+
+    # Takes the ids in chunks (the fetchmany batches), each chunk goes straight into
+    # the array so the ids are never all held as python objects. Read in the order
+    # of the index they are mostly sorted already, then the sort is skipped.
+    def load(self, chunks):
+        numbers = array("q")
+        other = set()
+        for chunk in chunks:
+            for check_id in chunk:
+                number = self.to_number(check_id)
+                if number is None:
+                    other.add(str(check_id))
+                else:
+                    numbers.append(number)
+        if not all(map(operator.le, numbers, islice(numbers, 1, None))):
+            numbers = array("q", sorted(numbers))
+        with self.lock:
+            self.ids = numbers
+            self.recent = set()
+            self.other = other
+
+    def add(self, check_id):
+        number = self.to_number(check_id)
+        with self.lock:
+            if number is None:
+                self.other.add(str(check_id))
+                return
+            if self.in_ids(number):
+                return
+            self.recent.add(number)
+            # The array is one sorted run, so this sort is close to a linear merge
+            if len(self.recent) >= self.merge_size:
+                self.ids = array("q", sorted(chain(self.ids, self.recent)))
+                self.recent = set()
+
+    def __contains__(self, check_id):
+        number = self.to_number(check_id)
+        if number is None:
+            return str(check_id) in self.other
+        return self.in_ids(number) or number in self.recent
+
+    def in_ids(self, number):
+        ids = self.ids
+        position = bisect_left(ids, number)
+        return position < len(ids) and ids[position] == number
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent) + len(self.other)
+
+    def to_number(self, check_id):
+        if isinstance(check_id, int):
+            return check_id
+        if isinstance(check_id, str) and check_id.isdigit() and len(check_id) < 19:
+            return int(check_id)
+        return None
@@ -0,0 +1,31 @@
+import json
+import os
+import time
+
+
+# Where a run got to, kept in a small JSON file. Every save writes a temp file
+# and renames it over the old one, so a crash never leaves half a checkpoint.
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return None
+
+    def save(self, state):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        state = dict(state, saved_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_path, self.path)
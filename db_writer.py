@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+
+
+# Write-behind stage between the fetching and the database. Producers put the rows
+# of one employee at a time on a bounded queue (put blocks while it is full), and
+# writer threads with their own connection and loaders drain them. The rows of an
+# employee always go to the same writer.
+#
+# mark() puts a marker behind everything queued so far on every writer. Each writer
+# flushes its loaders when it reaches the marker, and the last one to get there
+# commits the marker's payload (the watermarks and checkpoint) with on_mark. Writers
+# read their queues in order, so the markers are committed in order too.
+class DbWriter:
+    retry_delay = 60
+
+    def __init__(self, count, queue_size, connect, make_loaders, on_mark, on_flush=None):
+        self.connect = connect
+        self.make_loaders = make_loaders
+        self.on_mark = on_mark
+        self.on_flush = on_flush
+        self.lock = threading.Lock()
+        self.marks = {}
+        self.mark_count = 0
+        self.writers = [Writer(self, index, max(1, queue_size // count)) for index in range(count)]
+        for writer in self.writers:
+            writer.start()
+
+    def put(self, key, rows):
+        self.writers[hash(key) % len(self.writers)].queue.put(("rows", rows))
+
+    def queue_depth(self):
+        return sum(writer.queue.qsize() for writer in self.writers)
+
+    # Commit payload once every row queued before it is flushed. With wait the
+    # caller blocks until then, close also finishes the loaders' files.
+    def mark(self, payload, wait=False, close=False):
+        with self.lock:
+            self.mark_count += 1
+            mark = Mark(self.mark_count, payload, len(self.writers))
+            self.marks[mark.number] = mark
+        for writer in self.writers:
+            writer.queue.put(("close" if close else "mark", mark.number))
+        if wait:
+            mark.done.wait()
+
+    def reach(self, writer, number):
+        with self.lock:
+            mark = self.marks[number]
+            mark.remaining -= 1
+            if mark.remaining > 0:
+                return
+            del self.marks[number]
+        if mark.payload is not None:
+            writer.retry("on_mark", lambda: self.on_mark(writer.conn, mark.payload))
+        mark.done.set()
+
+    # Flush everything, commit payload and stop the writers
+    def close(self, payload=None):
+        self.mark(payload, wait=True, close=True)
+        for writer in self.writers:
+            writer.queue.put(("stop", None))
+        for writer in self.writers:
+            writer.thread.join()
+
+
+class Mark:
+    def __init__(self, number, payload, remaining):
+        self.number = number
+        self.payload = payload
+        self.remaining = remaining
+        self.done = threading.Event()
+
+
+class Writer:
+    def __init__(self, db_writer, index, queue_size):
+        self.db_writer = db_writer
+        self.index = index
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.conn = db_writer.connect()
+        self.loaders = db_writer.make_loaders(self.conn, index)
+        self.thread = threading.Thread(target=self.run, name=f"db-writer-{index}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                kind, item = self.queue.get(timeout=1)
+            except queue.Empty:
+                # Time based flushes still happen while the producers are idle
+                self.flush(due_only=True)
+                continue
+            if kind == "rows":
+                for table, row in item:
+                    for loader in self.loaders[table]:
+                        loader.add(row)
+                self.flush(due_only=True)
+            elif kind in ["mark", "close"]:
+                self.flush()
+                if kind == "close":
+                    self.close_loaders()
+                self.db_writer.reach(self, item)
+            elif kind == "stop":
+                self.close_connection()
+                return
+
+    def flush(self, due_only=False):
+        loaders = [loader for loaders in self.loaders.values() for loader in loaders]
+        if due_only and not any(loader.is_due() for loader in loaders):
+            return
+        for loader in loaders:
+            started = time.time()
+            inserted = self.retry(f"{loader.sink}: {loader.table}", loader.flush)
+            if self.db_writer.on_flush is not None:
+                self.db_writer.on_flush(loader, inserted, time.time() - started)
+
+    def close_loaders(self):
+        for loaders in self.loaders.values():
+            for loader in loaders:
+                try:
+                    loader.close()
+                except Exception as e:
+                    logging.exception(f"db_writer {self.index}: close: {loader.sink}: {loader.table}: {e}")
+
+    # Keep trying on a new connection, the queue backs up and holds the producers meanwhile
+    def retry(self, name, action):
+        while True:
+            try:
+                return action()
+            except Exception as e:
+                logging.exception(f"db_writer {self.index}: {name}: {e}")
+                time.sleep(self.db_writer.retry_delay)
+                logging.info(f"db_writer {self.index}: connecting database again")
+                try:
+                    self.close_connection()
+                    self.conn = self.db_writer.connect()
+                    for loaders in self.loaders.values():
+                        for loader in loaders:
+                            loader.set_connection(self.conn)
+                except Exception as e:
+                    logging.exception(f"db_writer {self.index}: connect: {e}")
+
+    def close_connection(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
@@ -0,0 +1,59 @@
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# The item fields the pipeline reads from each paged list, the rest of every item
+# is dropped right after decoding so a cached page holds only what is used
+list_fields = {
+    "get_employee_list": ["id", "legalCode", "links"],
+    "get_legal_employee_list": ["id", "legalCode", "links"],
+    "get_employee_check_list": ["id", "checkDate", "links"],
+}
+
+
+# Decodes the response bytes with the fastest library installed: orjson, ujson,
+# then the stdlib. `library` picks one, "auto" takes the first available.
+class JsonDecoder:
+    libraries = ["orjson", "ujson", "json"]
+
+    def __init__(self, library="auto", project=True):
+        self.library, self.loads = self.get_loads(library)
+        self.project = project
+        logging.info(f"json_decoder: {self.library}")
+
+    def get_loads(self, library):
+        if library in ["auto", "orjson"] and orjson is not None:
+            return "orjson", orjson.loads
+        if library in ["auto", "ujson"] and ujson is not None:
+            return "ujson", ujson.loads
+        if library not in ["auto", "json"]:
+            logging.warning(f"json_decoder: {library} is not installed, using json")
+        return "json", json.loads
+
+    # bytes -> data, list pages keep only the fields in list_fields
+    def decode(self, name, content):
+        data = self.loads(content)
+        fields = list_fields.get(name)
+        if fields is not None and self.project and isinstance(data, dict):
+            data = project_page(data, fields)
+        return data
+
+
+def project_page(data, fields):
+    page = {"results": [
+        {field: item[field] for field in fields if field in item}
+        for item in data.get("results") or []
+    ]}
+    if data.get("nextPageUrl"):
+        page["nextPageUrl"] = data["nextPageUrl"]
+    return page
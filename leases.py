@@ -0,0 +1,178 @@
+import logging
+import threading
+
+
+# Spreads the clients of a pass over worker processes on any number of nodes.
+# Every (job, client) has a row in work_leases. A worker claims the next client
+# that is neither leased nor completed in the last min_age seconds, renews its
+# leases every duration / 3 seconds while it works, and marks the client completed
+# once its rows are flushed. A client it could not finish is released instead and
+# can be claimed again. The lease of a worker that died runs out after
+# `duration` seconds and the client goes to the next worker that asks. The
+# database clock decides, so the nodes' clocks do not have to agree.
+class Leases:
+    def __init__(self, connect, job, worker, duration=120, min_age=0):
+        self.connect = connect
+        self.job = job
+        self.worker = worker
+        self.duration = int(duration)
+        self.min_age = int(min_age)
+        self.conn = connect()
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stopped = threading.Event()
+        # The renewals have their own connection, pyodbc connections are not shared across threads
+        self.thread = threading.Thread(target=self.renew_forever, name=f"leases-{job}", daemon=True)
+        self.thread.start()
+
+    # Yield the index in client_list of every client this worker gets, until none is left
+    def claims(self, client_list):
+        positions = {str(client.get("id")): index for index, client in enumerate(client_list)}
+        registered = False
+        while True:
+            try:
+                if not registered:
+                    self.register(positions)
+                    registered = True
+                client_id = self.claim()
+            except Exception as e:
+                # The other workers go on, the pass of this one ends here
+                logging.exception(f"leases: claim: {e}")
+                self.reconnect()
+                return
+            if client_id is None:
+                return
+            # Gone from the client list since it was registered
+            if client_id not in positions:
+                self.complete(client_id)
+                continue
+            yield positions[client_id]
+
+    # Add the clients that have no row yet, the position keeps the claims in list order
+    def register(self, positions):
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany('''
+                MERGE work_leases WITH (HOLDLOCK) AS t
+                USING (SELECT ? AS job, ? AS client_id, ? AS position) AS s
+                ON t.job = s.job AND t.client_id = s.client_id
+                WHEN MATCHED THEN UPDATE SET position = s.position
+                WHEN NOT MATCHED THEN INSERT (job, client_id, position) VALUES (s.job, s.client_id, s.position);''',
+                [(self.job, client_id, position) for client_id, position in positions.items()]
+            )
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    # The next free client, None when every one is leased or recently completed.
+    # READPAST lets concurrent claims skip each other's locked rows instead of waiting.
+    def claim(self):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('''
+                WITH next AS (
+                    SELECT TOP (1) * FROM work_leases WITH (UPDLOCK, READPAST, ROWLOCK)
+                    WHERE job = ?
+                        AND (leased_until IS NULL OR leased_until < SYSUTCDATETIME())
+                        AND (completed_at IS NULL OR completed_at < DATEADD(second, -?, SYSUTCDATETIME()))
+                    ORDER BY position
+                )
+                UPDATE next SET worker = ?, leased_until = DATEADD(second, ?, SYSUTCDATETIME())
+                OUTPUT inserted.client_id''',
+                self.job, self.min_age, self.worker, self.duration
+            )
+            row = cursor.fetchone()
+            self.conn.commit()
+        finally:
+            cursor.close()
+        if row is None:
+            return None
+        with self.lock:
+            self.held.add(row[0])
+        logging.info(f"leases: {self.worker} claimed {self.job} client {row[0]}")
+        return row[0]
+
+    # The client's rows are committed, no worker needs it before min_age is over
+    def complete(self, client_id):
+        client_id = str(client_id)
+        with self.lock:
+            self.held.discard(client_id)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('''
+                UPDATE work_leases SET completed_at = SYSUTCDATETIME(), leased_until = NULL, worker = NULL
+                WHERE job = ? AND client_id = ? AND worker = ?''',
+                self.job, client_id, self.worker
+            )
+            if cursor.rowcount == 0:
+                logging.warning(f"leases: {self.job} client {client_id} was reclaimed before {self.worker} completed it")
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    # The client is not done, any worker can claim it again after `delay` seconds.
+    # completed_at stays as it was, so the client is not skipped for min_age.
+    def release(self, client_id, delay=0):
+        client_id = str(client_id)
+        with self.lock:
+            self.held.discard(client_id)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('''
+                UPDATE work_leases SET leased_until = DATEADD(second, ?, SYSUTCDATETIME()), worker = NULL
+                WHERE job = ? AND client_id = ? AND worker = ?''',
+                delay, self.job, client_id, self.worker
+            )
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    def renew_forever(self):
+        conn = None
+        while not self.stopped.wait(max(1, self.duration / 3)):
+            with self.lock:
+                held = list(self.held)
+            if not held:
+                continue
+            try:
+                if conn is None:
+                    conn = self.connect()
+                cursor = conn.cursor()
+                for client_id in held:
+                    cursor.execute('''
+                        UPDATE work_leases SET leased_until = DATEADD(second, ?, SYSUTCDATETIME())
+                        WHERE job = ? AND client_id = ? AND worker = ?''',
+                        self.duration, self.job, client_id, self.worker
+                    )
+                    if cursor.rowcount == 0:
+                        logging.warning(f"leases: lost the lease on {self.job} client {client_id}")
+                        with self.lock:
+                            self.held.discard(client_id)
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                logging.exception(f"leases: renew: {e}")
+                conn = None
+
+    def reconnect(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        try:
+            self.conn = self.connect()
+        except Exception as e:
+            logging.exception(f"leases: connect: {e}")
+
+    # Give the unfinished clients back right away instead of after `duration`
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            held = list(self.held)
+        try:
+            for client_id in held:
+                self.release(client_id)
+            self.conn.close()
+        except Exception as e:
+            logging.exception(f"leases: close: {e}")
@@ -0,0 +1,124 @@
+import time
+
+
+# Buffers rows for one table and writes them set-based: the batch goes into a
+# #stage table with fast_executemany, then one anti-join insert moves the rows
+# that are not in the target yet. One commit per batch. With replace the rows of
+# the target that share a key with the batch are deleted first, so the batch wins.
+class BulkLoader:
+    sink = "sql"
+
+    def __init__(self, conn, table, columns, key_columns, batch_size=1000, flush_interval=30, replace=False):
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.last_flush = time.time()
+        self.stage = f"#stage_{table}"
+        self.staged = False
+        self.replace = replace
+        self.inserted = 0
+        # Staged rows that were not inserted, their key was in the target or twice in the batch
+        self.skipped = 0
+        self.replaced = 0
+
+        column_list = ", ".join(self.columns)
+        keys = ", ".join(self.key_columns)
+        match = " AND ".join(f"t.{column} = s.{column}" for column in self.key_columns)
+        self.stage_query = f"INSERT INTO {self.stage} ({column_list}) VALUES ({', '.join('?' for _ in self.columns)})"
+        self.merge_query = f"""
+            WITH batch AS (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY (SELECT NULL)) AS row_num
+                FROM {self.stage}
+            )
+            INSERT INTO {self.table} ({column_list})
+            SELECT {column_list} FROM batch s
+            WHERE s.row_num = 1 AND NOT EXISTS (SELECT 1 FROM {self.table} t WHERE {match})"""
+        self.delete_query = f"DELETE t FROM {self.table} t WHERE EXISTS (SELECT 1 FROM {self.stage} s WHERE {match})"
+
+    # The temp table belongs to the connection, so a new connection needs a new one
+    def set_connection(self, conn):
+        self.conn = conn
+        self.staged = False
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def is_due(self):
+        if len(self.rows) >= self.batch_size:
+            return True
+        return len(self.rows) > 0 and time.time() - self.last_flush >= self.flush_interval
+
+    # Write the buffered rows, they are kept for a retry if anything fails
+    def flush(self):
+        if not self.rows:
+            self.last_flush = time.time()
+            return 0
+
+        cursor = self.conn.cursor()
+        try:
+            if not self.staged:
+                cursor.execute(f"""
+                    IF OBJECT_ID('tempdb..{self.stage}') IS NULL
+                    SELECT TOP 0 {", ".join(self.columns)} INTO {self.stage} FROM {self.table}""")
+                self.staged = True
+            cursor.execute(f"TRUNCATE TABLE {self.stage}")
+            cursor.fast_executemany = True
+            cursor.executemany(self.stage_query, self.rows)
+            inserted = self.merge(cursor)
+            self.conn.commit()
+        except Exception:
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            cursor.close()
+
+        self.inserted += max(inserted, 0)
+        self.skipped += max(len(self.rows) - inserted, 0)
+        self.rows = []
+        self.last_flush = time.time()
+        return inserted
+
+    # Move the staged rows into the table, returns the number of rows inserted
+    def merge(self, cursor):
+        if self.replace:
+            cursor.execute(self.delete_query)
+            self.replaced += max(cursor.rowcount, 0)
+        cursor.execute(self.merge_query)
+        return cursor.rowcount
+
+    def close(self):
+        self.flush()
+
+
+# Keeps one row per version of an employee (SCD type 2). A staged row whose
+# row_hash differs from the open version closes it (valid_to = the new valid_from)
+# and becomes the open version, an unchanged one is dropped.
+class HistoryLoader(BulkLoader):
+    def __init__(self, conn, table, columns, key_columns, batch_size=1000, flush_interval=30):
+        super().__init__(conn, table, columns, key_columns, batch_size, flush_interval)
+        column_list = ", ".join(self.columns)
+        keys = ", ".join(self.key_columns)
+        match = " AND ".join(f"t.{column} = s.{column}" for column in self.key_columns)
+        self.close_query = f"""
+            UPDATE t SET valid_to = s.valid_from
+            FROM {self.table} t JOIN {self.stage} s ON {match}
+            WHERE t.valid_to IS NULL AND t.row_hash <> s.row_hash"""
+        self.merge_query = f"""
+            WITH batch AS (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY valid_from DESC) AS row_num
+                FROM {self.stage}
+            )
+            INSERT INTO {self.table} ({column_list})
+            SELECT {column_list} FROM batch s
+            WHERE s.row_num = 1 AND NOT EXISTS (SELECT 1 FROM {self.table} t WHERE {match} AND t.valid_to IS NULL)"""
+
+    def merge(self, cursor):
+        cursor.execute(self.close_query)
+        return super().merge(cursor)
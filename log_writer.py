@@ -0,0 +1,167 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import threading
+
+
+# Bodies of failed responses are cut to this many characters in the log
+body_limit = 2000
+
+
+# A response body that is only decoded and cut when the record is written, on the
+# log writer thread when there is one: logging.error("%s: %s", name, Body(content))
+class Body:
+    __slots__ = ["content"]
+
+    def __init__(self, content):
+        self.content = content
+
+    def __str__(self):
+        content = self.content
+        if isinstance(content, bytes):
+            content = content[:body_limit * 4].decode("utf-8", "replace")
+        content = str(content)
+        size = len(self.content)
+        if size > body_limit:
+            return f"{content[:body_limit]}... ({size} bytes)"
+        return content
+
+
+# The start of the message up to the first ":", "get_employee_check_list: 12" ->
+# "get_employee_check_list". It names the event for the sampling and the json lines.
+def get_event(message):
+    return message.split(":", 1)[0][:60]
+
+
+# Keeps `rate` of the info records of the sampled events, warnings and errors always pass
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        # The unformatted message, the frequent events are logged with %s arguments
+        rate = self.rates.get(get_event(str(record.msg)))
+        if rate is None:
+            return True
+        record.sample_rate = rate
+        return random.random() < rate
+
+
+# One json object per line: time, level, event, message, thread, the sample rate
+# of sampled events, the fields passed with extra= and the exception
+class JsonFormatter(logging.Formatter):
+    fields = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime", "sample_rate"}
+
+    def format(self, record):
+        message = record.getMessage()
+        line = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "event": get_event(message),
+            "message": message,
+            "thread": record.threadName,
+        }
+        if getattr(record, "sample_rate", None) is not None:
+            line["sample_rate"] = record.sample_rate
+        for key, value in record.__dict__.items():
+            if key not in self.fields:
+                line[key] = value
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+# Hands records to the writer thread without waiting. The message is formatted
+# there, not on the fetching thread; a full queue drops the record and counts it.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+
+# Rotates the log at max_bytes and gzips the rotated files, history.log.1.gz ...
+class CompressingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, max_bytes=0, backup_count=10):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.namer = lambda name: name if name == self.baseFilename else f"{name}.gz"
+        self.rotator = compress_file
+
+
+def compress_file(source, destination):
+    with open(source, "rb") as source_file, gzip.open(destination, "wb") as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+
+# Log to path: text like before or json lines, written on the calling thread or
+# with queue_size by a writer thread. `sample` maps events to the share of their
+# info records kept. Only the first call in a process sets the logging up.
+def setup_logging(path, log_format="text", queue_size=0, sample=None, max_bytes=0, backup_count=10):
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    handler = CompressingFileHandler(path, max_bytes, backup_count)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    root.setLevel(logging.INFO)
+
+    if not queue_size:
+        if sample:
+            handler.addFilter(SamplingFilter(sample))
+        root.addHandler(handler)
+        return None
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    # Sampled out records never reach the queue
+    if sample:
+        queue_handler.addFilter(SamplingFilter(sample))
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+    root.addHandler(queue_handler)
+
+    # Whatever is queued at exit is still written
+    def stop():
+        if queue_handler.dropped:
+            handler.handle(logging.LogRecord("root", logging.WARNING, __file__, 0, f"log_writer: dropped {queue_handler.dropped} records, the queue was full", None, None))
+        root.removeHandler(queue_handler)
+        listener.stop()
+        handler.close()
+    atexit.register(stop)
+    return queue_handler
+
+
+# "get_employee_check_list=0.01,client_id=0.1" -> {"get_employee_check_list": 0.01, "client_id": 0.1}
+def parse_sample(value):
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
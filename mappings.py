@@ -0,0 +1,172 @@
+# The API record -> table row mappings. Each one is a list of Fields compiled once
+# into a single extractor function that returns the row as a plain tuple, so the
+# transform does no dict lookups on the mapping and one allocation per row.
+
+
+# Same rules as Main.validate
+def to_string(item):
+    if item is None:
+        return ""
+    if type(item) == str:
+        return item.replace("'", "`")
+    return item
+
+
+def to_number(item):
+    if item is None:
+        return 0.0
+    if type(item) == str:
+        return item.replace("'", "`")
+    return item
+
+
+def to_datetime(item):
+    if item is None:
+        return None
+    if type(item) == str:
+        return item.replace("'", "`").split("T")[0]
+    return item
+
+
+field_types = {"string": to_string, "number": to_number, "datetime": to_datetime}
+
+employment_status_codes = {
+    "Active": "A",
+    "Inactive": "I",
+    "Terminated": "T",
+}
+
+
+def get_status_code(status):
+    return employment_status_codes.get(status, status)
+
+
+def first_name(name):
+    return name.split(" ")[0]
+
+
+def last_name(name):
+    return name.split(" ")[-1]
+
+
+# One column of a row. `path` is a dotted path into the record with "|" between
+# fallbacks ("itemCode|itemDescription"), `context` names a value the caller
+# passes in, and a field with neither is the constant `value`.
+class Field:
+    def __init__(self, column, path=None, field_type="string", transform=None, context=None, value=None):
+        self.column = column
+        self.path = path
+        self.field_type = field_type
+        self.transform = transform
+        self.context = context
+        self.value = value
+
+
+class RowMapping:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = list(fields)
+        self.columns = [field.column for field in self.fields]
+        self.extract = compile_fields(name, self.fields)
+
+
+# Generates def extract(record, context=None): return (<one expression per field>,)
+def compile_fields(name, fields):
+    namespace = {"empty": {}}
+    namespace.update((function.__name__, function) for function in field_types.values())
+    expressions = []
+    for index, field in enumerate(fields):
+        if field.path is not None:
+            expression = " or ".join(get_expression(path) for path in field.path.split("|"))
+            expression = f"to_{field.field_type}({expression})"
+        elif field.context is not None:
+            expression = f"context[{field.context!r}]"
+        else:
+            namespace[f"value_{index}"] = field.value
+            expression = f"value_{index}"
+        if field.transform is not None:
+            namespace[f"transform_{index}"] = field.transform
+            expression = f"transform_{index}({expression})"
+        expressions.append(expression)
+    source = "def extract(record, context=None):\n    return (\n" + "".join(f"        {expression},\n" for expression in expressions) + "    )\n"
+    exec(compile(source, f"<mapping {name}>", "exec"), namespace)
+    return namespace["extract"]
+
+
+# "Department.description" -> (record.get("Department") or empty).get("description")
+def get_expression(path):
+    expression = "record"
+    keys = path.split(".")
+    for key in keys[:-1]:
+        expression = f"({expression}.get({key!r}) or empty)"
+    return f"{expression}.get({keys[-1]!r})"
+
+
+employee_list = RowMapping("employee_list", [
+    Field("facility_name", context="facility_name"),
+    Field("department", "Department.description"),
+    Field("department_code", "Department.code"),
+    Field("employee_first_name", "nameAddress.firstName"),
+    Field("employee_middle_name", "nameAddress.middleName"),
+    Field("employee_last_name", "nameAddress.lastName"),
+    Field("hire_date", "hireDate", "datetime"),
+    Field("rehire_date", "rehireDate", "datetime"),
+    Field("termination_date", "terminationDate", "datetime"),
+    Field("leave_date"),
+    Field("seniority_date"),
+    Field("position", "Position.description"),
+    Field("position_id", "Position.code"),
+    Field("system_id", "id"),
+    Field("employee_id", "employeeNumber"),
+    Field("status", "employmentStatus", transform=get_status_code),
+    Field("status_type", "employmentCategoryCode"),
+    Field("email", "emailAddress"),
+    Field("pay_type", "payType"),
+    Field("hourly_rate", "hourlyRate", "number"),
+    Field("load_date", context="load_date"),
+])
+
+# An employee_checks row is the check head + one line item + the check tail.
+# The head and tail are extracted once per check and shared by all its lines.
+check_head = RowMapping("check_head", [
+    Field("facility_name", "legalCompanyName"),
+    Field("department", "Department.description"),
+    Field("department_code", "Department.code"),
+    Field("employee_first_name", "employeeName", transform=first_name),
+    Field("employee_last_name", "employeeName", transform=last_name),
+    Field("position", "Position.description"),
+    Field("position_code", "Position.code"),
+    Field("system_id", "id"),
+    Field("employee_id", "employeeNumber"),
+])
+
+check_tail = RowMapping("check_tail", [
+    Field("check_date", "checkDate", "datetime"),
+    Field("period_end_date", "periodEndDate", "datetime"),
+    Field("check_type", "checkTypeDescription"),
+    Field("check_number", "checkNumber"),
+    Field("load_date", context="load_date"),
+])
+
+
+def check_line(earning_group, code_path, hours_path, dollars_path):
+    return RowMapping(f"check_line_{earning_group}", [
+        Field("hours", hours_path, "number") if hours_path else Field("hours", value=0.0),
+        Field("dollars", dollars_path, "number"),
+        Field("earning_code", code_path) if code_path else Field("earning_code", value=""),
+        Field("earning_group", value=earning_group),
+    ])
+
+
+# (list of line items in the check, mapping of one item), in the order they are stored.
+# NetPay maps the check itself and goes last, it marks the check as complete.
+check_lines = [
+    ("garnishments", check_line("Garnishments", "itemCode", "checkHours", "checkDollars")),
+    ("deductions", check_line("Deductions", "itemCode", "checkHours", "checkDollars")),
+    ("directDeposits", check_line("Direct Deposits", "itemDescription", None, "depositAmount")),
+    ("taxes", check_line("Taxes", "itemCode|itemDescription", "checkHours", "checkDollars")),
+    ("earnings", check_line("Earning", "itemCode|itemDescription", "checkHours", "checkDollars")),
+    (None, check_line("NetPay", None, None, "netPay")),
+]
+
+employee_checks_columns = check_head.columns + check_lines[0][1].columns + check_tail.columns
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Label values in the Prometheus text format
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    # values[labels] = [bucket counts..., count, sum]
+    def observe(self, *label_values, value):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for label_values, series in sorted(self.values.items()):
+                for index, bound in enumerate(self.buckets):
+                    labels = format_labels(self.label_names, label_values, ("le", bound))
+                    lines.append(f"{self.name}_bucket{labels} {series[index]}")
+                labels = format_labels(self.label_names, label_values, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {series[-2]}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_count{labels} {series[-2]}")
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+        return lines
+
+
+# Every metric of the pipeline, rendered in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        self.request_seconds = Histogram("isolved_request_seconds", "Latency of the iSolved API calls", ["endpoint"])
+        self.requests = Counter("isolved_requests_total", "iSolved API calls by status", ["endpoint", "status"])
+        self.response_bytes = Counter("isolved_response_bytes_total", "Bytes received from the iSolved API", ["endpoint"])
+        self.decode_seconds = Counter("isolved_decode_seconds_total", "Time spent decoding the API responses", ["endpoint"])
+        self.flush_seconds = Histogram("db_flush_seconds", "Time to flush a batch into a table", ["sink", "table"])
+        self.rows_inserted = Counter("db_rows_inserted_total", "Rows written by sink and table", ["sink", "table"])
+        self.rows_buffered = Gauge("db_rows_buffered", "Rows waiting for the next flush", ["sink", "table"])
+        self.queue_depth = Gauge("pipeline_queue_depth", "Items waiting in a pipeline queue", ["queue"])
+        self.employees = Counter("pipeline_employees_total", "Employees stored", ["mode"])
+
+    def all(self):
+        return [value for value in vars(self).values() if isinstance(value, Metric)]
+
+    def render(self):
+        lines = []
+        for metric in self.all():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# Serves GET /metrics from a daemon thread
+class MetricsServer:
+    def __init__(self, metrics, port, host="0.0.0.0"):
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        logging.info(f"metrics: serving on port {self.server.server_address[1]}")
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# Rewrites a textfile for the node_exporter textfile collector every `interval` seconds
+class MetricsFileWriter:
+    def __init__(self, metrics, path, interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics-file", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(self.metrics.render())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"metrics: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
@@ -0,0 +1,270 @@
+import logging
+import time
+
+
+# Versioned changes to the sql schema. Every migration runs once per database in
+# its own transaction and is recorded in schema_migrations, so a reconnect or a
+# restart only reads the applied versions. sp_getapplock keeps two processes
+# starting together from applying the same migration twice.
+#
+# Applied migrations are never edited, a change to the schema is a new one at the
+# end of the list. Their column lists are spelled out for the same reason.
+class Migration:
+    def __init__(self, version, name, statements, option=None):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        # Only applied while this setting is on, and recorded once it is
+        self.option = option
+
+
+employee_list_history_columns = [
+    "facility_name", "department", "department_code", "employee_first_name", "employee_middle_name",
+    "employee_last_name", "hire_date", "rehire_date", "termination_date", "leave_date", "seniority_date",
+    "position", "position_id", "system_id", "employee_id", "status", "status_type", "email", "pay_type",
+    "hourly_rate",
+]
+
+
+def get_index(name, definition):
+    return f"""
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='{name}')
+            CREATE {definition}"""
+
+
+# One row per employee and day from valid_from up to valid_to (or today), like the snapshot tables
+def get_daily_view(list_type, table):
+    columns = ", ".join(f"h.{column}" for column in employee_list_history_columns if list_type == 1 or column != "hourly_rate")
+    return f"""
+            IF OBJECT_ID('{table}_daily', 'V') IS NULL
+            EXEC('CREATE VIEW {table}_daily AS
+                SELECT h.id, {columns}, CAST(DATEADD(day, d.n, h.valid_from) AS date) AS load_date
+                FROM employee_list_history h
+                CROSS APPLY (
+                    SELECT TOP (DATEDIFF(day, h.valid_from, COALESCE(h.valid_to, DATEADD(day, 1, CAST(GETDATE() AS date)))))
+                        ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS n
+                    FROM sys.all_objects a CROSS JOIN sys.all_objects b
+                ) d
+                WHERE h.list_type = {list_type}')"""
+
+
+migrations = [
+    # The tables connect_database used to create on every connect
+    Migration(1, "create employee tables", ['''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_list_type_1' AND xtype='U')
+            CREATE TABLE employee_list_type_1 (
+                id int Identity primary key NOT NULL,
+                facility_name nvarchar(100),
+                department nvarchar(100),
+                department_code nvarchar(100),
+                employee_first_name nvarchar(100),
+                employee_middle_name nvarchar(100),
+                employee_last_name nvarchar(100),
+                hire_date date,
+                rehire_date date,
+                termination_date date,
+                leave_date date,
+                seniority_date date,
+                position nvarchar(100),
+                position_id nvarchar(100),
+                system_id nvarchar(100),
+                employee_id nvarchar(100),
+                status nvarchar(100),
+                status_type nvarchar(100),
+                email nvarchar(100),
+                pay_type nvarchar(100),
+                hourly_rate float,
+                load_date date
+            )''', '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_list_type_2' AND xtype='U')
+            CREATE TABLE employee_list_type_2 (
+                id int Identity primary key NOT NULL,
+                facility_name nvarchar(100),
+                department nvarchar(100),
+                department_code nvarchar(100),
+                employee_first_name nvarchar(100),
+                employee_middle_name nvarchar(100),
+                employee_last_name nvarchar(100),
+                hire_date date,
+                rehire_date date,
+                termination_date date,
+                leave_date date,
+                seniority_date date,
+                position nvarchar(100),
+                position_id nvarchar(100),
+                system_id nvarchar(100),
+                employee_id nvarchar(100),
+                status nvarchar(100),
+                status_type nvarchar(100),
+                email nvarchar(100),
+                pay_type nvarchar(100),
+                load_date date
+            )''', '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_checks' AND xtype='U')
+            CREATE TABLE employee_checks (
+                id int Identity primary key NOT NULL,
+                facility_name nvarchar(100),
+                department nvarchar(100),
+                department_code nvarchar(100),
+                employee_first_name nvarchar(100),
+                employee_last_name nvarchar(100),
+                position nvarchar(100),
+                position_code nvarchar(100),
+                system_id nvarchar(100),
+                employee_id nvarchar(100),
+                hours float,
+                dollars float,
+                earning_code nvarchar(100),
+                earning_group nvarchar(100),
+                check_date date,
+                period_end_date date,
+                check_type nvarchar(100),
+                check_number nvarchar(100),
+                load_date date
+            )''']),
+    Migration(2, "create employee_check_watermarks", ['''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_check_watermarks' AND xtype='U')
+            CREATE TABLE employee_check_watermarks (
+                employee_system_id nvarchar(100) primary key NOT NULL,
+                last_check_id nvarchar(100),
+                last_check_date date,
+                last_page_url nvarchar(1000),
+                updated_at datetime
+            )''']),
+    # The keys of the loaders' NOT EXISTS checks and of load_check_index. Not unique,
+    # rows loaded before the loaders deduplicated may hold duplicates.
+    Migration(3, "add dedup indexes", [
+        get_index("ix_employee_list_type_1_system_id", "INDEX ix_employee_list_type_1_system_id ON employee_list_type_1 (system_id, load_date)"),
+        get_index("ix_employee_list_type_2_system_id", "INDEX ix_employee_list_type_2_system_id ON employee_list_type_2 (system_id, load_date)"),
+        get_index("ix_employee_checks_system_id", "INDEX ix_employee_checks_system_id ON employee_checks (system_id, earning_code, earning_group)"),
+        get_index("ix_employee_checks_netpay", "INDEX ix_employee_checks_netpay ON employee_checks (system_id) WHERE earning_group = 'NetPay'"),
+    ]),
+    # The SCD type 2 table of details_mode=cdc and the views in the shape of the daily snapshots
+    Migration(4, "create employee_list_history", ['''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_list_history' AND xtype='U')
+            CREATE TABLE employee_list_history (
+                id int Identity primary key NOT NULL,
+                facility_name nvarchar(100),
+                department nvarchar(100),
+                department_code nvarchar(100),
+                employee_first_name nvarchar(100),
+                employee_middle_name nvarchar(100),
+                employee_last_name nvarchar(100),
+                hire_date date,
+                rehire_date date,
+                termination_date date,
+                leave_date date,
+                seniority_date date,
+                position nvarchar(100),
+                position_id nvarchar(100),
+                system_id nvarchar(100),
+                employee_id nvarchar(100),
+                status nvarchar(100),
+                status_type nvarchar(100),
+                email nvarchar(100),
+                pay_type nvarchar(100),
+                hourly_rate float,
+                list_type tinyint,
+                row_hash char(40),
+                valid_from date,
+                valid_to date
+            )''',
+        get_index("ix_employee_list_history_system_id", "INDEX ix_employee_list_history_system_id ON employee_list_history (system_id, valid_to) INCLUDE (row_hash)"),
+        get_daily_view(1, "employee_list_type_1"),
+        get_daily_view(2, "employee_list_type_2"),
+    ]),
+    # employee_checks is only appended to and scanned by system_id, as a clustered
+    # columnstore it takes a fraction of the space. The identity primary key stays,
+    # nonclustered.
+    Migration(5, "employee_checks clustered columnstore", [
+        """
+            DECLARE @name sysname = (
+                SELECT k.name FROM sys.key_constraints k
+                JOIN sys.indexes i ON i.object_id = k.parent_object_id AND i.index_id = k.unique_index_id
+                WHERE k.parent_object_id = OBJECT_ID('employee_checks') AND k.type = 'PK' AND i.type = 1
+            )
+            IF @name IS NOT NULL
+            EXEC('ALTER TABLE employee_checks DROP CONSTRAINT ' + @name)""",
+        get_index("cci_employee_checks", "CLUSTERED COLUMNSTORE INDEX cci_employee_checks ON employee_checks"),
+        """
+            IF NOT EXISTS (SELECT * FROM sys.key_constraints WHERE parent_object_id = OBJECT_ID('employee_checks') AND type = 'PK')
+            ALTER TABLE employee_checks ADD CONSTRAINT pk_employee_checks PRIMARY KEY NONCLUSTERED (id)""",
+    ], option="checks_columnstore"),
+    # The client leases of sharding=true
+    Migration(6, "create work_leases", ['''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='work_leases' AND xtype='U')
+            CREATE TABLE work_leases (
+                job nvarchar(20) NOT NULL,
+                client_id nvarchar(100) NOT NULL,
+                position int,
+                worker nvarchar(200),
+                leased_until datetime2,
+                completed_at datetime2,
+                primary key (job, client_id)
+            )''']),
+]
+
+
+# Apply the migrations the database does not have yet, `options` holds the settings
+# of the optional ones. Returns the applied versions.
+#
+# The lock is a session lock taken around the whole loop: a transaction lock needs
+# an open transaction, and pyodbc only opens one with the first statement that
+# reads or writes. Each migration still commits on its own.
+def migrate(conn, options=None):
+    options = options or {}
+    cursor = conn.cursor()
+    locked = False
+    try:
+        cursor.execute('''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='schema_migrations' AND xtype='U')
+            CREATE TABLE schema_migrations (
+                version int primary key NOT NULL,
+                name nvarchar(200),
+                applied_at datetime
+            )''')
+        conn.commit()
+        applied = get_applied(cursor)
+        conn.commit()
+
+        pending = [
+            migration for migration in migrations
+            if migration.version not in applied and (migration.option is None or options.get(migration.option))
+        ]
+        if pending:
+            cursor.execute("EXEC sp_getapplock @Resource = 'schema_migrations', @LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = -1")
+            locked = True
+            # Another process may have applied some while this one waited for the lock
+            applied = get_applied(cursor)
+            conn.commit()
+        for migration in pending:
+            if migration.version in applied:
+                continue
+            started = time.time()
+            for statement in migration.statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, GETDATE())", migration.version, migration.name)
+            conn.commit()
+            applied.add(migration.version)
+            logging.info(f"migrations: applied {migration.version} {migration.name} in {time.time() - started:.1f}s")
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        if locked:
+            try:
+                cursor.execute("EXEC sp_releaseapplock @Resource = 'schema_migrations', @LockOwner = 'Session'")
+                conn.commit()
+            except Exception as e:
+                logging.exception(f"migrations: release lock: {e}")
+        cursor.close()
+    logging.info(f"migrations: schema version {max(applied) if applied else 0}")
+    return applied
+
+
+def get_applied(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return set(row[0] for row in cursor.fetchall())
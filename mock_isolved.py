@@ -0,0 +1,327 @@
+import argparse
+import gzip
+import json
+import random
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+
+# A local stand-in for the iSolved REST API with synthetic clients, employees,
+# jobs and checks. Every response can be delayed by `latency` (+ up to `jitter`)
+# seconds, and `throttle_rate` of the requests get a 429 with Retry-After.
+#
+# Bodies over 1 KB are gzipped for clients that accept it, like the real API.
+# GET /_stats returns the request counts and bytes sent, POST /_checks?add=N gives every
+# employee N more checks (the next pay run).
+class MockIsolved:
+    first_check_date = date(2020, 1, 3)
+
+    def __init__(self, clients=2, employees=100, checks=10, lines=5, page_size=100,
+                 latency=0.0, jitter=0.0, throttle_rate=0.0, retry_after=1, expires_in=3600):
+        self.clients = clients
+        self.employees = employees
+        self.checks = checks
+        self.lines = lines
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.expires_in = expires_in
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.base_url = ""
+
+    def start(self, port=0, host="127.0.0.1"):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                mock.handle(self, "GET")
+
+            def do_POST(self):
+                mock.handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-isolved", daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+
+    def handle(self, request, method):
+        parts = urlsplit(request.path)
+        path = [part for part in parts.path.split("/") if part]
+        query = dict(parse_qsl(parts.query))
+        if request.headers.get("Content-Length"):
+            request.rfile.read(int(request.headers["Content-Length"]))
+
+        if path and path[0].startswith("_"):
+            return self.send(request, 200, self.control(method, path[0], query))
+
+        endpoint, body = self.route(method, path, query)
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if endpoint != "token" and self.throttle_rate and random.random() < self.throttle_rate:
+            with self.lock:
+                self.throttled += 1
+            return self.send(request, 429, {"message": "Too Many Requests"}, {"Retry-After": str(self.retry_after)})
+        if body is None:
+            return self.send(request, 404, {"message": "Not Found"})
+        self.send(request, 200, body)
+
+    def send(self, request, status, body, headers=None):
+        content = json.dumps(body).encode()
+        headers = dict(headers or {})
+        if len(content) > 1024 and "gzip" in (request.headers.get("Accept-Encoding") or ""):
+            content = gzip.compress(content, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        with self.lock:
+            self.bytes_sent += len(content)
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def control(self, method, name, query):
+        if name == "_checks" and method == "POST":
+            with self.lock:
+                self.checks += int(query.get("add", 1))
+        return self.stats()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "total": sum(self.requests.values()),
+                "throttled": self.throttled,
+                "bytes_sent": self.bytes_sent,
+                "checks": self.checks,
+            }
+
+    # (endpoint name, response body), the body is None for an unknown url
+    def route(self, method, path, query):
+        if method == "POST":
+            return "token", self.get_token() if path == ["token"] else None
+        if not path or path[0] != "clients":
+            return "unknown", None
+        try:
+            ids = [int(part) for part in path[1::2]]
+        except ValueError:
+            return "unknown", None
+        if len(path) == 1:
+            return "clients", self.get_client_list()
+        client_id = ids[0]
+        if not 0 < client_id <= self.clients:
+            return "unknown", None
+        if len(path) == 2:
+            return "client_details", self.get_client_details(client_id)
+        if path[2] == "legals":
+            return "legals", self.get_legal_list(client_id)
+        if path[2] != "employees":
+            return "unknown", None
+        if len(path) == 3:
+            return "employees", self.get_employee_list(client_id, query)
+        employee_index = ids[1] % 1000000
+        if not 0 < employee_index <= self.employees:
+            return "unknown", None
+        employee_id = ids[1]
+        if len(path) == 4:
+            return "employee_details", self.get_employee_details(client_id, employee_id)
+        if path[4] == "jobs":
+            return "jobs", self.get_employee_jobs()
+        if path[4] != "checks":
+            return "unknown", None
+        if len(path) == 5:
+            return "check_list", self.get_check_list(client_id, employee_id, query)
+        check_index = ids[2] % 1000
+        if not 0 < check_index <= self.checks:
+            return "unknown", None
+        return "check_details", self.get_check_details(client_id, employee_id, check_index)
+
+    def get_token(self):
+        return {
+            "access_token": f"mock-{time.time()}",
+            "refresh_token": "mock-refresh",
+            "token_type": "bearer",
+            "expires_in": self.expires_in,
+        }
+
+    def get_client_list(self):
+        return {"results": [
+            {"id": client_id, "name": f"Client {client_id}", "links": [self.link("self", f"/clients/{client_id}")]}
+            for client_id in range(1, self.clients + 1)
+        ]}
+
+    def get_client_details(self, client_id):
+        return {
+            "id": client_id,
+            "organizations": [
+                {"title": "Department", "lookups": [
+                    {"code": f"D{index}", "description": f"Department {index}"} for index in range(1, 11)
+                ]},
+                {"title": "Position", "lookups": [
+                    {"code": f"P{index}", "description": f"Position {index}"} for index in range(1, 21)
+                ]},
+            ],
+            "legalCompanies": [{"legalCode": f"L{client_id}", "legalName": f"Facility {client_id}"}],
+        }
+
+    def get_legal_list(self, client_id):
+        return [{"legalCode": f"L{client_id}", "legalName": f"Facility {client_id}",
+                 "links": [self.link("Employees", f"/clients/{client_id}/employees")]}]
+
+    def get_employee_list(self, client_id, query):
+        page = int(query.get("page", 0))
+        page_size = int(query.get("pageSize", self.page_size))
+        first = page * page_size + 1
+        last = min(first + page_size - 1, self.employees)
+        data = {"results": [
+            {
+                "id": self.employee_id(client_id, index),
+                "employeeNumber": f"E{index:06d}",
+                "legalCode": f"L{client_id}",
+                "links": [
+                    self.link("self", self.employee_path(client_id, index)),
+                    self.link("Checks", f"{self.employee_path(client_id, index)}/checks"),
+                ],
+            }
+            for index in range(first, last + 1)
+        ]}
+        if last < self.employees:
+            data["nextPageUrl"] = self.base_url + f"/clients/{client_id}/employees?page={page + 1}&pageSize={page_size}"
+        return data
+
+    def get_employee_details(self, client_id, employee_id):
+        index = employee_id % 1000000
+        return {
+            "id": employee_id,
+            "employeeNumber": f"E{index:06d}",
+            "legalCode": f"L{client_id}",
+            "nameAddress": {"firstName": f"First{index}", "middleName": "M", "lastName": f"Last{index}"},
+            "hireDate": "2019-05-01T00:00:00",
+            "rehireDate": None,
+            "terminationDate": None,
+            "employmentStatus": "Active",
+            "employmentCategoryCode": "FT",
+            "emailAddress": f"employee{index}@example.com",
+            "payType": "Hourly",
+            "hourlyRate": 20 + index % 15,
+        }
+
+    def get_employee_jobs(self):
+        return [{"organizations": [
+            {"clientOrganizationField": {"title": "Department"}, "organizationValue": "D1"},
+            {"clientOrganizationField": {"title": "Position"}, "organizationValue": "P1"},
+        ]}]
+
+    # Oldest first, new checks are appended to the last page
+    def get_check_list(self, client_id, employee_id, query):
+        page = int(query.get("page", 0))
+        page_size = int(query.get("pageSize", self.page_size))
+        checks = self.checks
+        first = page * page_size + 1
+        last = min(first + page_size - 1, checks)
+        path = f"/clients/{client_id}/employees/{employee_id}/checks"
+        data = {"results": [
+            {
+                "id": self.check_id(employee_id, index),
+                "checkDate": self.check_date(index),
+                "links": [self.link("self", f"{path}/{self.check_id(employee_id, index)}")],
+            }
+            for index in range(first, last + 1)
+        ]}
+        if last < checks:
+            data["nextPageUrl"] = self.base_url + f"{path}?page={page + 1}&pageSize={page_size}"
+        return data
+
+    def get_check_details(self, client_id, employee_id, index):
+        employee_index = employee_id % 1000000
+        lines = [
+            {"itemCode": f"C{line}", "itemDescription": f"Code {line}", "checkHours": 8.0, "checkDollars": 160.0}
+            for line in range(self.lines)
+        ]
+        return {
+            "id": self.check_id(employee_id, index),
+            "employeeNumber": f"E{employee_index:06d}",
+            "employeeName": f"First{employee_index} Last{employee_index}",
+            "legalCompanyName": f"Facility {client_id}",
+            "checkDate": self.check_date(index),
+            "periodEndDate": self.check_date(index),
+            "checkTypeDescription": "Regular",
+            "checkNumber": str(index),
+            "netPay": 160.0 * len(lines),
+            "earnings": lines,
+            "taxes": lines[:2],
+            "deductions": lines[:1],
+            "garnishments": [],
+            "directDeposits": [{"itemDescription": "Checking", "depositAmount": 160.0 * len(lines)}],
+            "employeeOrganizations": [],
+        }
+
+    def link(self, rel, path):
+        return {"rel": rel, "href": self.base_url + path}
+
+    def employee_path(self, client_id, index):
+        return f"/clients/{client_id}/employees/{self.employee_id(client_id, index)}"
+
+    def employee_id(self, client_id, index):
+        return client_id * 1000000 + index
+
+    def check_id(self, employee_id, index):
+        return employee_id * 1000 + index
+
+    def check_date(self, index):
+        return (self.first_check_date + timedelta(days=14 * (index - 1))).strftime("%Y-%m-%dT00:00:00")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="mock_isolved.py", description="Local mock of the iSolved REST API")
+    parser.add_argument("--port", type=int, default=8080, help="0 picks a free port")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--employees", type=int, default=100, help="employees per client")
+    parser.add_argument("--checks", type=int, default=10, help="checks per employee")
+    parser.add_argument("--lines", type=int, default=5, help="earning lines per check")
+    parser.add_argument("--page-size", type=int, default=100, help="default page size of the lists")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many random seconds on top")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of the requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the 429s")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    mock = MockIsolved(
+        args.clients, args.employees, args.checks, args.lines, args.page_size,
+        args.latency, args.jitter, args.throttle_rate, args.retry_after
+    )
+    base_url = mock.start(args.port, args.host)
+    # The benchmark reads the url from this first line
+    print(base_url, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+        sys.exit(0)
@@ -0,0 +1,75 @@
+import contextvars
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# Sets the page size on the first url of a list, the nextPageUrl links keep it
+def with_page_size(url, page_size, page_size_param="pageSize"):
+    if not url or not page_size:
+        return url
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if any(key == page_size_param for key, _ in query):
+        return url
+    query.append((page_size_param, str(page_size)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+
+# Walks a nextPageUrl list lazily. While the caller works on page N, page N+1
+# is already being fetched on the prefetch executor.
+class Paginator:
+    def __init__(self, fetch, executor=None, page_size=None, page_size_param="pageSize"):
+        self.fetch = fetch
+        self.executor = executor
+        self.page_size = page_size
+        self.page_size_param = page_size_param
+
+    # Yields (page_url, data) and stops after the last page. A page that could not
+    # be fetched is yielded as (page_url, None) and ends the walk. stop(data) ends
+    # the walk after that page without prefetching the next one.
+    def pages(self, name, url, scope=None, stop=None):
+        url = with_page_size(url, self.page_size, self.page_size_param)
+        future = self.submit(name, url, scope) if url else None
+        try:
+            while future is not None:
+                data = future.result()
+                future = None
+                if data is None:
+                    yield url, None
+                    return
+                next_url = data.get("nextPageUrl")
+                if stop is not None and stop(data):
+                    next_url = None
+                if next_url:
+                    future = self.submit(name, next_url, scope)
+                yield url, data
+                url = next_url
+        finally:
+            # The caller stopped early, don't fetch a page nobody reads
+            if future is not None:
+                future.cancel()
+
+    def items(self, name, url, scope=None):
+        for _, data in self.pages(name, url, scope):
+            if data is None:
+                return
+            yield from data.get("results", [])
+
+    def submit(self, name, url, scope):
+        if self.executor is None:
+            return Deferred(self.fetch, name, url, scope)
+        # Run in the caller's context so the client and employee scopes carry over
+        context = contextvars.copy_context()
+        return self.executor.submit(context.run, self.fetch, name, url, scope)
+
+
+# Without an executor the next page is only fetched once the caller asks for it
+class Deferred:
+    def __init__(self, fetch, *args):
+        self.fetch = fetch
+        self.args = args
+
+    def result(self):
+        return self.fetch(*self.args)
+
+    def cancel(self):
+        return True
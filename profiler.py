@@ -0,0 +1,154 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+
+# Per phase timers for --profile. Every phase adds its calls, wall clock and CPU
+# time (of the thread it ran on) to the pass totals. Phases nest, so the times are
+# inclusive: an http phase holds its retries and waits, insert holds the mapping.
+#
+# A sample of the employees is fetched under cProfile, and with memory also under
+# tracemalloc, one employee at a time so the rest runs at full speed. tracemalloc
+# traces the whole process, so the allocation column is the change in traced memory
+# while a phase ran during a sample, including what the other workers and the writer
+# threads allocated meanwhile. Only --threads 1 with db_writers=0 narrows it to the
+# sampled employee. report() writes the summary, the sampled profile and the top
+# allocation sites and starts over.
+class Profiler:
+    null_phase = nullcontext()
+
+    def __init__(self, enabled=False, sample=0.01, memory=False, directory="profiles", name="run"):
+        self.enabled = enabled
+        self.sample_rate = sample
+        self.memory = memory
+        self.directory = directory
+        self.name = name
+        self.lock = threading.Lock()
+        # Held while an employee is sampled
+        self.sampling = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.stats = None
+        self.snapshot = None
+        self.samples = 0
+        self.started = time.time()
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.null_phase
+        return Phase(self, name)
+
+    def record(self, name, wall, cpu=0.0, memory=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            totals = self.phases.get(name)
+            if totals is None:
+                totals = self.phases[name] = [0, 0.0, 0.0, 0]
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] += memory
+
+    # func(*args), profiled for a sample of the calls
+    def sample(self, func, *args):
+        if not self.enabled or random.random() >= self.sample_rate or not self.sampling.acquire(blocking=False):
+            return func(*args)
+        try:
+            if self.memory:
+                tracemalloc.start()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                snapshot = tracemalloc.take_snapshot() if self.memory else None
+                if self.memory:
+                    tracemalloc.stop()
+                with self.lock:
+                    self.samples += 1
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    if snapshot is not None:
+                        self.add_snapshot(snapshot)
+        finally:
+            self.sampling.release()
+
+    # The allocations of the process still alive after each sampled employee, added up by line
+    def add_snapshot(self, snapshot):
+        statistics = snapshot.statistics("lineno")
+        if self.snapshot is None:
+            self.snapshot = {}
+        for statistic in statistics:
+            frame = statistic.traceback[0]
+            key = f"{frame.filename}:{frame.lineno}"
+            size, count = self.snapshot.get(key, (0, 0))
+            self.snapshot[key] = (size + statistic.size, count + statistic.count)
+
+    def summary(self):
+        lines = [f"{'phase':<28}{'calls':>10}{'wall s':>12}{'cpu s':>12}{'ms/call':>10}{'proc alloc KB':>15}"]
+        for name, (calls, wall, cpu, memory) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<28}{calls:>10}{wall:>12.2f}{cpu:>12.2f}{wall / calls * 1000:>10.2f}{memory / 1024:>15.0f}")
+        return "\n".join(lines)
+
+    # Log the summary and write it with the sampled profiles to <directory>/<name>-<start>.txt,
+    # the cProfile data goes to the .prof next to it (snakeviz, pstats)
+    def report(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            summary = self.summary()
+            stats, snapshot, samples = self.stats, self.snapshot, self.samples
+            started = self.started
+            self.reset()
+        logging.info(f"profiler: {time.time() - started:.0f}s pass, {samples} employees sampled\n{summary}")
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d%H%M%S', time.localtime(started))}")
+            with open(f"{path}.txt", "w") as file:
+                file.write(f"{summary}\n\n{samples} employees sampled\n")
+                if stats is not None:
+                    output = io.StringIO()
+                    stats.stream = output
+                    stats.sort_stats("cumulative").print_stats(40)
+                    file.write(output.getvalue())
+                    stats.dump_stats(f"{path}.prof")
+                if snapshot:
+                    file.write("\nallocations of the whole process (every thread) still alive after the sampled employees\n")
+                    for key, (size, count) in sorted(snapshot.items(), key=lambda item: -item[1][0])[:30]:
+                        file.write(f"{size / 1024:>10.1f} KB {count:>8} blocks  {key}\n")
+            logging.info(f"profiler: wrote {path}.txt")
+        except Exception as e:
+            logging.exception(f"profiler: {e}")
+
+
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        memory = 0
+        if self.memory is not None and tracemalloc.is_tracing():
+            memory = max(0, tracemalloc.get_traced_memory()[0] - self.memory)
+        self.profiler.record(self.name, wall, cpu, memory)
+        return False
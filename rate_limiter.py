@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+
+# Paces requests to `rate` per second with bursts of up to `burst`.
+# pause() holds everybody back, e.g. for the Retry-After of a 429.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Take a token and return how long the caller has to wait before using it
+    def reserve(self):
+        if not self.rate:
+            # Unpaced, but a pause still holds every caller back
+            return max(0, self.paused_until - time.monotonic())
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# A concurrency limit that grows by one per window of successful requests and
+# halves when the API pushes back (additive increase, multiplicative decrease).
+# Threads wait on the condition, event loop tasks on a future each that a release
+# resolves from whichever thread it runs on.
+class AIMDLimiter:
+    def __init__(self, limit, min_limit=1, max_limit=None, latency_target=None):
+        self.max_limit = max_limit or limit
+        self.min_limit = min_limit
+        self.limit = float(limit)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+        self.waiters = deque()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.condition:
+                    if (loop, waiter) in self.waiters:
+                        self.waiters.remove((loop, waiter))
+                    else:
+                        # Woken and cancelled at once, the slot goes to the next waiter
+                        self.notify()
+                raise
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.notify()
+
+    # Wake as many waiters as there are free slots, called with the condition held.
+    # A woken waiter that lost its slot to another one waits again.
+    def notify(self):
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self.condition.notify(free)
+        for _ in range(min(free, len(self.waiters))):
+            loop, waiter = self.waiters.popleft()
+            loop.call_soon_threadsafe(wake, waiter)
+
+    def on_success(self, latency):
+        with self.condition:
+            if self.latency_target and latency > self.latency_target:
+                self.decrease(0.9)
+            elif self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.notify()
+
+    def on_throttle(self):
+        with self.condition:
+            self.decrease(0.5)
+
+    # At most one decrease per second, a burst of 429s is one signal
+    def decrease(self, factor):
+        now = time.monotonic()
+        if now - self.decreased_at < 1:
+            return
+        self.decreased_at = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        logging.warning(f"rate_limiter: concurrency limit down to {int(self.limit)}")
+
+
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+# Everything the requests share: pacing, the adaptive concurrency limit and the retry policy
+class RateController:
+    throttle_statuses = [429, 503]
+    retry_statuses = [429, 500, 502, 503, 504]
+
+    def __init__(self, rate, burst, concurrency, max_retries=5, retry_base=0.5, retry_cap=60, latency_target=None):
+        self.bucket = TokenBucket(rate, burst or max(1, concurrency))
+        self.limiter = AIMDLimiter(concurrency, latency_target=latency_target)
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.retries = 0
+        self.throttled = 0
+
+    @contextmanager
+    def slot(self):
+        wait = self.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        self.limiter.acquire()
+        try:
+            yield
+        finally:
+            self.limiter.release()
+
+    async def acquire_async(self):
+        wait = self.bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.limiter.acquire_async()
+
+    def release(self):
+        self.limiter.release()
+
+    # Feed the outcome of a request back, status None for a connection error
+    def record(self, status, latency, retry_after=None):
+        if status in self.throttle_statuses:
+            self.throttled += 1
+            self.limiter.on_throttle()
+            delay = self.parse_retry_after(retry_after)
+            if delay:
+                self.bucket.pause(delay)
+        elif status is not None and status < 500:
+            self.limiter.on_success(latency)
+
+    def should_retry(self, status, attempt):
+        return attempt < self.max_retries and (status is None or status in self.retry_statuses)
+
+    # Full jitter exponential backoff, never shorter than the Retry-After
+    def retry_delay(self, attempt, retry_after=None):
+        self.retries += 1
+        delay = random.uniform(0, min(self.retry_cap, self.retry_base * 2 ** attempt))
+        return max(delay, self.parse_retry_after(retry_after) or 0)
+
+    # Retry-After is either seconds or an HTTP date
+    def parse_retry_after(self, value):
+        if not value:
+            return None
+        try:
+            return min(self.retry_cap, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            return min(self.retry_cap, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
+    def report(self):
+        return f"limit: {int(self.limiter.limit)} | retries: {self.retries} | throttled: {self.throttled}"
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+import time
+from request_cache import canonical_url
+
+
+# The client list and client details outlive a pass: they are kept in a JSON file
+# and served from it for `ttl` seconds, so a pass starts on the employees right
+# away. An entry can carry the fingerprint of what it was fetched for (the
+# client's record in the client list), a different fingerprint refetches it.
+#
+# The file holds the format version and the api endpoint, a file written by
+# another version or for another endpoint is ignored. Entries are written out
+# by save(), temp file and rename like the checkpoint.
+class ReferenceCache:
+    version = 1
+
+    def __init__(self, path, ttl=21600, api_endpoint=None):
+        self.path = path
+        self.ttl = ttl
+        self.api_endpoint = api_endpoint
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if self.ttl > 0:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                state = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logging.warning(f"reference_cache: ignoring {self.path}: {e}")
+            return
+        if state.get("version") != self.version or state.get("api_endpoint") != self.api_endpoint:
+            logging.info(f"reference_cache: {self.path} is for another version or endpoint, starting over")
+            return
+        self.entries = state.get("entries") or {}
+        logging.info(f"reference_cache: {len(self.entries)} entries from {self.path}")
+
+    # The cached data of url, None when there is none, it expired or its fingerprint changed
+    def lookup(self, url, fingerprint=None):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(canonical_url(url))
+            if entry is None or time.time() - entry["fetched_at"] >= self.ttl or entry.get("fingerprint") != fingerprint:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["data"]
+
+    def store(self, url, data, fingerprint=None):
+        if self.ttl <= 0 or data is None:
+            return
+        with self.lock:
+            self.entries[canonical_url(url)] = {"fetched_at": time.time(), "fingerprint": fingerprint, "data": data}
+            self.dirty = True
+
+    # Drop every entry, or the ones whose url starts with prefix
+    def invalidate(self, prefix=None):
+        with self.lock:
+            if prefix is None:
+                self.entries = {}
+            else:
+                prefix = canonical_url(prefix)
+                self.entries = {url: entry for url, entry in self.entries.items() if not url.startswith(prefix)}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {"version": self.version, "api_endpoint": self.api_endpoint, "entries": dict(self.entries)}
+            self.dirty = False
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump(state, cache_file)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.exception(f"reference_cache: save: {e}")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def report(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries"
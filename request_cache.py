@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import copy
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# The client and the employee being fetched, they key the client and employee scopes.
+# Context variables follow both the worker threads and the asyncio tasks.
+current_client = contextvars.ContextVar("current_client", default=None)
+current_employee = contextvars.ContextVar("current_employee", default=None)
+
+
+# "HTTPS://Host/rest/api/clients/1/?b=2&a=1" -> "https://host/rest/api/clients/1?a=1&b=2"
+def canonical_url(url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+
+# Fetches every resource at most once per scope. A scope is a (name, key) pair,
+# e.g. ("run", None), ("client", 83) or ("employee", 1234), and is dropped with
+# clear() once the run, client or employee is done. Concurrent callers of the
+# same url share one request.
+class RequestCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scopes = {}
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, name, scope, scope_key, url, fetch):
+        entries, url, future, owner = self.lookup(name, scope, scope_key, url, Future)
+        if not owner:
+            return self.copy(future.result())
+
+        try:
+            value = fetch()
+        except Exception as e:
+            self.forget(entries, url)
+            future.set_exception(e)
+            raise
+        # Failed requests are not cached so the next caller tries again
+        if value is None:
+            self.forget(entries, url)
+        future.set_result(value)
+        return self.copy(value)
+
+    async def get_async(self, name, scope, scope_key, url, fetch):
+        entries, url, future, owner = self.lookup(name, scope, scope_key, url, asyncio.get_running_loop().create_future)
+        if not owner:
+            return self.copy(await asyncio.shield(future))
+
+        try:
+            value = await fetch()
+        except Exception as e:
+            self.forget(entries, url)
+            future.set_exception(e)
+            # Nobody may be waiting, keep asyncio from warning about it
+            future.exception()
+            raise
+        if value is None:
+            self.forget(entries, url)
+        future.set_result(value)
+        return self.copy(value)
+
+    # Returns the pending or finished future of the url and whether this caller has to fetch it
+    def lookup(self, name, scope, scope_key, url, new_future):
+        url = canonical_url(url)
+        with self.lock:
+            entries = self.scopes.setdefault((scope, scope_key), {})
+            future = entries.get(url)
+            if future is not None:
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return entries, url, future, False
+            self.misses[name] = self.misses.get(name, 0) + 1
+            future = entries[url] = new_future()
+            return entries, url, future, True
+
+    def forget(self, entries, url):
+        with self.lock:
+            entries.pop(url, None)
+
+    # Drop one scope, every scope of a kind, or everything
+    def clear(self, scope=None, scope_key=None):
+        with self.lock:
+            if scope is None:
+                self.scopes = {}
+            elif scope_key is None:
+                for key in [key for key in self.scopes if key[0] == scope]:
+                    del self.scopes[key]
+            else:
+                self.scopes.pop((scope, scope_key), None)
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = {}
+            self.misses = {}
+
+    # "get_employee_jobs: 10 hits / 990 misses, ..." plus the total of saved calls
+    def report(self):
+        with self.lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            lines = [f"{name}: {self.hits.get(name, 0)} hits / {self.misses.get(name, 0)} misses" for name in names]
+            saved = sum(self.hits.values())
+        return f"saved {saved} calls | " + ", ".join(lines)
+
+    # Callers add organization keys to the records they get back, keep the cached one clean
+    def copy(self, value):
+        if isinstance(value, dict):
+            return copy.copy(value)
+        return value
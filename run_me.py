@@ -1,155 +1,614 @@
 import requests
-import csv
 import pdb
 import json
+import hashlib
 import pyodbc
 import time
+import threading
 from datetime import date, datetime
 import logging
 import sys
 import os
+import argparse
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import dotenv_values
-import schedule
+import signal
+from async_engine import AsyncEngine, parse_endpoint_limits
+from loader import BulkLoader, HistoryLoader
+from sinks import CsvSink, ParquetSink, parse_sinks
+from request_cache import RequestCache, current_client, current_employee
+from token_manager import TokenManager
+from rate_limiter import RateController
+from check_index import CheckIndex
+from paginator import Paginator
+from checkpoint import Checkpoint
+from scheduler import Scheduler
+from db_writer import DbWriter
+from migrations import migrate
+from archive import ResponseArchive, ArchiveReader
+from leases import Leases
+from profiler import Profiler
+from reference_cache import ReferenceCache
+from transport import Transport
+import log_writer
+from log_writer import Body, setup_logging, parse_sample
+from metrics import Metrics, MetricsServer, MetricsFileWriter
+import mappings
+from json_decoder import JsonDecoder
 
 
 class Main:
     names = ["details", "checks"]
+    engines = ["sync", "async"]
+    check_list_orders = ["oldest_first", "newest_first"]
+    sink_names = ["sql", "csv", "parquet"]
+    details_modes = ["snapshot", "cdc"]
+    replay_modes = ["insert", "replace"]
+    # The replayed responses that become rows, tagged with when they were archived
+    dated_endpoints = ["get_employee_details", "get_employee_check_details"]
     api_endpoint = "https://snfpayroll.myisolved.com/rest/api"
-    debug = False
     exception_list = ["beecan health llc", "beecan health co llc"]
     exception_code_list = ["BHC", "BHCO"]
     thread_count = 10
-
-    def __init__(self):
-        self.config = dotenv_values(".env")
-        if sys.argv[1] in self.names:
-            self.name = sys.argv[1]
-            if len(sys.argv) > 2:
-                self.begin_at = int(sys.argv[2])
-                self.page_num = int(sys.argv[3])
-            else:
-                self.begin_at = 0
-                self.page_num = 0
-            print(f"It's running for {self.name} from {self.begin_at} - {self.page_num}...")
+    batch_size = 1000
+    flush_interval = 30
+    # Requests per second, 0 leaves the pace to the adaptive concurrency limit
+    rate_limit = 0
+    # Logical endpoint of every API call, the label of its metrics
+    endpoints = {
+        "get_client_list": "clients",
+        "get_client_details": "client_details",
+        "get_legal_list": "legals",
+        "get_legal_employee_list": "employees",
+        "get_employee_list": "employees",
+        "get_employee_details": "employee_details",
+        "get_employee_jobs": "jobs",
+        "get_employee_check_list": "check_list",
+        "get_employee_check_details": "check_details",
+    }
+    employee_list_columns = mappings.employee_list.columns
+    employee_checks_columns = mappings.employee_checks_columns
+    # One row per version of an employee, the snapshot columns without load_date
+    employee_list_history_columns = employee_list_columns[:-1] + ["list_type", "row_hash", "valid_from"]
+    system_id_index = employee_list_columns.index("system_id")
+
+    # Set everything up, run() starts the passes
+    def __init__(self, argv=None, config=None, metrics=None):
+        self.config = dotenv_values(".env") if config is None else config
+        args = self.parse_args(argv)
+        if args.name in self.names:
+            self.name = args.name
+            self.begin_at = args.begin_at
+            self.page_num = args.page_num
+            self.thread_count = max(1, args.threads)
+            self.engine = args.engine
+            self.incremental = not args.full
+            self.replay = args.replay
+            # A replay reads every archived check again and never moves the watermarks
+            if self.replay:
+                self.engine = "sync"
+                self.incremental = False
+            checkpoint_file = self.setting("checkpoint_file", f"checkpoints/{self.name}.json")
+            self.checkpoint = Checkpoint(checkpoint_file if not self.replay else f"checkpoints/replay-{self.name}.json")
+            self.position = None
+            self.resume = self.get_resume_state(args.no_resume)
+            print(f"It's {'replaying' if self.replay else 'running'} for {self.name} from {self.resume or 'the start'} on the {self.engine} engine...")
         else:
-            print("The command is out of control. Try with checks or details, please.")
+            print("The command is out of control. Try with checks, details or all, please.")
             exit(0)
-        self.session = requests.Session()
+        self.api_endpoint = self.config.get("api_endpoint") or self.api_endpoint
+        self.max_in_flight = args.max_in_flight
+        self.endpoint_limits = parse_endpoint_limits(self.config.get("endpoint_limits"))
+        self.executor = ThreadPoolExecutor(max_workers=self.thread_count) if self.thread_count > 1 else None
+        # Every worker walks at most one list at a time, so one prefetch thread each is enough
+        prefetch = self.setting("prefetch", "true").lower() == "true"
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=self.thread_count + 1) if prefetch else None
+        self.paginator = Paginator(
+            self.api_get, self.prefetch_executor,
+            self.setting("page_size", None, int), self.setting("page_size_param", "pageSize")
+        )
         self.setup_log()
+        self.setup_metrics(metrics)
+        self.profiler = Profiler(
+            args.profile, self.setting("profile_sample", 0.01, float), self.setting("profile_memory", "false").lower() == "true",
+            self.setting("profile_dir", "profiles"), self.name
+        )
+        self.json_decoder = JsonDecoder(
+            self.setting("json_decoder", "auto"), self.setting("project_list_pages", "true").lower() == "true"
+        )
         self.count = 0
-        self.token = self.get_token()
+        self.batch_size = int(self.config.get("batch_size") or self.batch_size)
+        self.flush_interval = float(self.config.get("flush_interval") or self.flush_interval)
+        self.sinks = parse_sinks(self.config.get("sinks"))
+        for sink in self.sinks:
+            if sink not in self.sink_names:
+                print(f"Unknown sink: {sink}. Use {', '.join(self.sink_names)}, please.")
+                exit(0)
+        # Watermarks and the check index live in SQL Server, without it they are kept in memory
+        self.database = "sql" in self.sinks
+        self.output_dir = self.setting("output_dir", "output")
+        self.loaders = {}
+        self.request_cache = RequestCache()
+        # A replay reads the client list and details from the archive like the rest
+        self.reference_cache = ReferenceCache(
+            self.setting("reference_cache_file", f"cache/reference-{self.name}.json"),
+            self.setting("reference_ttl", 21600, float) if not self.replay else 0, self.api_endpoint
+        )
+        if args.refresh_reference:
+            self.reference_cache.invalidate()
+        self.client = None
+        self.client_refreshed = False
+        self.client_lock = threading.Lock()
+        self.check_list_order = self.config.get("check_list_order") or "oldest_first"
+        self.watermarks = {}
+        self.pending_watermarks = {}
+        self.check_index = CheckIndex()
+        self.skipped_checks = 0
+        self.use_check_index = self.setting("check_index", "true").lower() == "true" and not self.replay
+        self.setup_archive(args.replay_until)
+        details_mode = self.setting("details_mode", "snapshot")
+        if details_mode not in self.details_modes:
+            print(f"Unknown details_mode: {details_mode}. Use {', '.join(self.details_modes)}, please.")
+            exit(0)
+        self.cdc = self.name == "details" and details_mode == "cdc"
+        # insert only adds the rows whose key is not in the tables yet, replace
+        # deletes the rows with the keys of the replayed ones first (a fixed mapping)
+        replay_mode = self.setting("replay_mode", "insert")
+        if replay_mode not in self.replay_modes:
+            print(f"Unknown replay_mode: {replay_mode}. Use {', '.join(self.replay_modes)}, please.")
+            exit(0)
+        self.replace = self.replay and replay_mode == "replace"
+        self.employee_hashes = {}
+        self.unchanged_employees = 0
+        self.seen_employees = set()
+        self.walked_all = False
+        self.transport = Transport(self.setting("connect_timeout", 10, float), self.setting("read_timeout", 60, float))
+        refresh_margin = self.config.get("token_refresh_margin")
+        self.tokens = TokenManager(self.get_token, self.get_refresh_token, float(refresh_margin) if refresh_margin else None)
+        if not self.replay and self.tokens.get_access_token() is None:
+            exit(0)
+        self.rate = RateController(
+            self.setting("rate_limit", self.rate_limit, float),
+            self.setting("rate_burst", None, int),
+            self.max_in_flight if self.engine == "async" else self.thread_count,
+            max_retries=self.setting("max_retries", 5, int),
+            retry_base=self.setting("retry_base", 0.5, float),
+            retry_cap=self.setting("retry_cap", 60, float),
+            latency_target=self.setting("latency_target", None, float),
+        )
+        self.migrated = False
         self.connect_database()
-        if self.debug:
-            self.csv_writer = self.get_writer()
-        self.prev_time = time.time()
+        self.setup_writer()
+        self.setup_leases()
+
+    # details or checks, or all to run both jobs in one process
+    @classmethod
+    def start(cls, argv=None):
+        argv = sys.argv[1:] if argv is None else argv
+        if argv and argv[0] == "all":
+            details = cls(["details"] + argv[1:])
+            checks = cls(["checks"] + argv[1:], metrics=details.metrics)
+            cls.run_jobs([details, checks])
+        else:
+            cls(argv).run()
+
+    def run(self):
+        self.run_jobs([self])
+
+    # Run the passes of every instance on one scheduler until SIGTERM or Ctrl+C,
+    # a pass that is already running is finished first
+    @staticmethod
+    def run_jobs(instances):
+        scheduler = Scheduler()
+        for instance in instances:
+            instance.add_jobs(scheduler)
+        signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+        try:
+            # A replay is one pass over the archive
+            if all(instance.replay for instance in instances):
+                for instance in instances:
+                    instance.run_pass()
+            else:
+                scheduler.run_forever()
+        except KeyboardInterrupt:
+            logging.info("scheduler: interrupted")
+        finally:
+            for instance in instances:
+                instance.disconnect_database()
+
+    # Checks passes every checks_interval seconds, details once at the start and then daily at details_at
+    def add_jobs(self, scheduler):
         if self.name == "checks":
-            while True:
-                self.start_requests()
+            scheduler.add(
+                "checks", self.run_pass,
+                interval=self.setting("checks_interval", 900, float), jitter=self.setting("checks_jitter", 60, float)
+            )
+        else:
+            scheduler.add(
+                "details", self.run_pass,
+                at=self.setting("details_at", "06:00"), jitter=self.setting("details_jitter", 0, float)
+            )
+
+    def parse_args(self, argv):
+        parser = argparse.ArgumentParser(prog="run_me.py")
+        parser.add_argument("name", help="details or checks")
+        parser.add_argument("begin_at", nargs="?", type=int, default=0)
+        parser.add_argument("page_num", nargs="?", type=int, default=0)
+        parser.add_argument("--threads", type=int, default=int(self.config.get("thread_count") or self.thread_count),
+                            help="number of employees fetched concurrently")
+        parser.add_argument("--engine", choices=self.engines, default=self.config.get("engine") or "sync",
+                            help="sync uses a requests worker pool, async uses aiohttp")
+        parser.add_argument("--max-in-flight", type=int, default=int(self.config.get("max_in_flight") or AsyncEngine.max_in_flight),
+                            help="global limit of concurrent requests for the async engine")
+        parser.add_argument("--full", action="store_true",
+                            help="ignore the check watermarks and walk every employee's full check history")
+        parser.add_argument("--no-resume", action="store_true",
+                            help="start from the first client instead of the last checkpoint")
+        parser.add_argument("--profile", action="store_true", default=self.setting("profile", "false").lower() == "true",
+                            help="time every phase and profile a sample of the employees, reported after each pass")
+        parser.add_argument("--refresh-reference", action="store_true",
+                            help="fetch the client list and client details again instead of using the reference cache")
+        parser.add_argument("--replay", action="store_true",
+                            help="run one pass over the archived responses instead of the API")
+        parser.add_argument("--replay-until", default=None,
+                            help="replay the responses fetched up to this time, YYYY-MM-DD[ HH:MM]")
+        return parser.parse_args(argv)
+
+    # Serve the metrics on metrics_port and/or rewrite them into metrics_file.
+    # Instances in one process share the first one's metrics.
+    def setup_metrics(self, metrics=None):
+        if metrics is not None:
+            self.metrics = metrics
+            return
+        self.metrics = Metrics()
+        metrics_port = self.setting("metrics_port", None, int)
+        if metrics_port:
+            MetricsServer(self.metrics, metrics_port)
+        metrics_file = self.setting("metrics_file", None)
+        if metrics_file:
+            MetricsFileWriter(self.metrics, metrics_file, self.setting("metrics_interval", 15, float))
+
+    # Archive the raw responses when archive=true, a replay reads them back instead of the API
+    def setup_archive(self, replay_until=None):
+        archive_dir = self.setting("archive_dir", "archive")
+        self.archive = None
+        self.archive_reader = None
+        if self.replay:
+            until = datetime.fromisoformat(replay_until).timestamp() if replay_until else None
+            self.archive_reader = ArchiveReader(archive_dir, until)
+        elif self.setting("archive", "false").lower() == "true":
+            self.archive = ResponseArchive(archive_dir, self.name, self.setting("archive_segment_mb", 256, int) * 1024 * 1024)
+
+    # With sharding=true the workers share the clients through leases in the database
+    # instead of walking all of them, a checks client is due again after half the interval
+    def setup_leases(self):
+        self.leases = None
+        if self.setting("sharding", "false").lower() != "true" or self.replay:
+            return
+        if not self.database:
+            print("sharding needs the sql sink, the leases live in the database.")
+            exit(0)
+        interval = self.setting("checks_interval", 900, float) if self.name == "checks" else 86400
+        worker = self.setting("worker_id", f"{socket.gethostname()}-{os.getpid()}")
+        self.leases = Leases(
+            self.open_connection, self.name, worker,
+            self.setting("lease_seconds", 120, int), self.setting("shard_min_age", interval / 2, float)
+        )
+        # The leases say where the work is, the local checkpoint does not
+        self.resume = None
+        logging.info(f"leases: sharding as {worker}")
+
+    # A value from .env, or the default when it is not set
+    def setting(self, name, default, cast=str):
+        value = self.config.get(name)
+        if value is None or value == "":
+            return default
+        return cast(value)
+
+    def run_pass(self):
+        self.load_watermarks()
+        self.load_check_index()
+        self.load_employee_hashes()
+        self.skipped_checks = 0
+        self.unchanged_employees = 0
+        self.seen_employees = set()
+        self.walked_all = True
+        self.request_cache.clear()
+        self.request_cache.reset_stats()
+        self.reference_cache.reset_stats()
+        self.profiler.reset()
+        if self.engine == "async":
+            AsyncEngine(self, self.max_in_flight, self.endpoint_limits).run()
         else:
             self.start_requests()
-            schedule.every().day.at("06:00").do(self.start_requests)
-            while True:
-                schedule.run_pending()
-        self.disconnect_database()
+        self.flush_loaders()
+        self.close_loaders()
+        self.close_missing_employees()
+        self.request_cache.clear()
+        self.reference_cache.save()
+        logging.info(f"request_cache: {self.request_cache.report()}")
+        logging.info(f"reference_cache: {self.reference_cache.report()}")
+        logging.info(f"rate_limiter: {self.rate.report()}")
+        logging.info(f"check_index: skipped {self.skipped_checks} loaded checks")
+        if self.cdc:
+            logging.info(f"cdc: {self.unchanged_employees} unchanged employees skipped")
+        if self.archive is not None:
+            self.archive.flush()
+            logging.info(f"archive: {self.archive.report()}")
+        if self.archive_reader is not None:
+            logging.info(f"replay: {self.archive_reader.report()}")
+            self.report_replayed_rows()
+        self.profiler.report()
 
     def start_requests(self):
         client_list = self.get_client_list() # [83, 96]
-        for client in client_list[self.begin_at:]:
-            client_details = self.get_client_details(client)
-            self.client_organizations = {}
-            for organization in client_details.get("organizations", []):
-                o_key = self.validate(organization.get("title"))
-                o_value = {}
-                for lookup in organization.get("lookups", []):
-                    o_value[lookup["code"]] = {
-                        "code": lookup["code"],
-                        "description": lookup["description"]
-                    }
-                self.client_organizations[o_key] = o_value
-
-            self.client_legals = {}
-            for legal in client_details.get("legalCompanies", []):
-                l_key = self.validate(legal.get("legalCode"))
-                l_value = self.validate(legal.get("legalName"))
-                self.client_legals[l_key] = l_value
-
+        for client_index, resume in self.claim_clients(client_list):
+            client_started = time.perf_counter()
+            client = client_list[client_index]
+            pending = deque()
+            current_client.set(client.get("id"))
+            self.set_client(client, self.get_client_details(client))
+
+            walked = False
             try:
-                page_url = None
-                for link in client.get("links", []):
-                    if link["rel"] == "self":
-                        page_url = f"{link['href']}/employees"
-                        break
+                page_url, skip = self.get_employee_page_url(client, resume)
 
-                if self.page_num != 0:
-                    page_url = f"https://snfpayroll.myisolved.com/rest/api/clients/{client.get('id')}/employees?page={self.page_num}"
-
-                while page_url:
-                    logging.info(f"client_id: {self.validate(client.get('id'))} | page_url: {page_url}")
-
-                    response = self.session.get(
-                        url = page_url, 
-                        headers = {
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {self.token['access_token']}",
-                        }
-                    )
-                    if response.status_code == 200:
-                        data = response.json()
-                        employee_list = data.get("results", [])
-
-                        for employee in employee_list:
-                            if self.name == "checks":
-                                facility_code = employee.get("legalCode")
-                                if "BHC" in facility_code or "BHCO" in facility_code:
-                                    logging.warning(f"exception_facility: employee_id: {employee.get('id')} | legal_code: {facility_code}")
-                                    continue
-
-                            cur_time = time.time()
-                            if cur_time - self.prev_time > 240:
-                                self.token = self.get_token()
-                                self.prev_time = cur_time
-
-                            self.parse_employee(employee)
-
-                        page_url = data["nextPageUrl"]
-                    else:
-                        logging.error(f"get_employee_list: {response.status_code}: {response.content}")
+                for page_url, data in self.paginator.pages("get_employee_list", page_url):
+                    logging.info("client_id: %s | page_url: %s", client.get("id"), page_url)
+                    if data is None:
+                        logging.error(f"get_employee_list: giving up on client_id: {self.validate(client.get('id'))} at page_url: {page_url}")
                         break
 
+                    for employee_index, employee in enumerate(data.get("results", [])):
+                        if employee_index < skip or self.is_exception_employee(employee):
+                            continue
+
+                        position = self.get_position(client_list, client_index, page_url, employee_index + 1)
+                        self.submit_employee(pending, employee, position)
+                    skip = 0
+                else:
+                    walked = True
+
             except Exception as e:
                 logging.exception(f"get_employee_list: {e}")
 
+            # Organizations and legals are per client, so finish this client before moving on
+            self.drain_employees(pending, 0)
+            self.position = self.get_position(client_list, client_index + 1, None, 0)
+            self.flush_loaders()
+            self.complete_client(client, walked)
+            self.request_cache.clear("client", client.get("id"))
+            self.profiler.record("client", time.perf_counter() - client_started)
+
+        if client_list:
+            self.save_checkpoint(completed=True)
+
+    # The clients to walk: all of them from the resume point, or with sharding the
+    # ones this worker gets a lease on. Yields (client_index, resume state).
+    def claim_clients(self, client_list):
+        if not client_list:
+            self.walked_all = False
+        if self.leases is not None:
+            for client_index in self.leases.claims(client_list):
+                yield client_index, None
+            return
+        start, resume = self.get_resume_point(client_list)
+        for client_index in range(start, len(client_list)):
+            yield client_index, resume
+            resume = None
+
+    # Called once the rows of the client are flushed. A client whose employee list was
+    # not walked to the end is released instead, it is due again after lease_seconds.
+    def complete_client(self, client, walked=True):
+        if not walked:
+            self.walked_all = False
+        if self.leases is None:
+            return
+        try:
+            if walked:
+                self.leases.complete(client.get("id"))
+            else:
+                self.leases.release(client.get("id"), self.leases.duration)
+        except Exception as e:
+            logging.exception(f"complete_client: {client.get('id')}: {e}")
+            self.leases.reconnect()
+
+    # Where to start: the begin_at/page_num arguments, else the last unfinished checkpoint
+    def get_resume_state(self, no_resume):
+        if self.begin_at or self.page_num:
+            return {"client_index": self.begin_at, "page_num": self.page_num}
+        if no_resume:
+            return None
+        state = self.checkpoint.load()
+        if state and state.get("name") == self.name and not state.get("completed"):
+            return state
+        return None
+
+    # The index of the first client to run and the resume state for it, only used once
+    def get_resume_point(self, client_list):
+        resume, self.resume = self.resume, None
+        if not resume:
+            return 0, None
+        # The employees before the resume point are not walked in this pass
+        self.walked_all = False
+        start = resume.get("client_index") or 0
+        # The client list can change between runs, the id is what counts
+        for client_index, client in enumerate(client_list):
+            if resume.get("client_id") is not None and client.get("id") == resume["client_id"]:
+                start = client_index
+                break
+        logging.info(f"resume: client_index: {start} | page_url: {resume.get('page_url')} | employee_index: {resume.get('employee_index')}")
+        return start, resume
+
+    # The first employee page of the client and how many employees of it are already done
+    def get_employee_page_url(self, client, resume):
+        page_url = self.get_link(client, "self")
+        if page_url:
+            page_url = f"{page_url}/employees"
+        if not resume:
+            return page_url, 0
+        if resume.get("page_num"):
+            return f"{self.api_endpoint}/clients/{client.get('id')}/employees?page={resume['page_num']}", 0
+        return resume.get("page_url") or page_url, resume.get("employee_index") or 0
+
+    # Everything before this point is stored once the next flush commits
+    def get_position(self, client_list, client_index, page_url, employee_index):
+        client_id = client_list[client_index].get("id") if client_index < len(client_list) else None
+        return {
+            "client_index": client_index,
+            "client_id": client_id,
+            "page_url": page_url,
+            "employee_index": employee_index,
+        }
+
+    def save_checkpoint(self, completed=False, position=None):
+        if self.leases is not None:
+            return
+        position = position or self.position
+        if position is None and not completed:
+            return
+        state = dict(position or {}, name=self.name, completed=completed)
+        try:
+            self.checkpoint.save(state)
+        except Exception as e:
+            logging.exception(f"save_checkpoint: {e}")
+        if completed:
+            self.position = None
+
+    # Make client the current one, with its organization lookups and legal names
+    def set_client(self, client, client_details):
+        self.client = client
+        self.client_refreshed = False
+        self.set_client_details(client_details)
+
+    # An organization value the current client's details do not know: they may come
+    # from the reference cache and be older than the value. Fetch them again past
+    # both caches, once per client; the callers map the record again either way.
+    def refresh_client_details(self):
+        with self.client_lock:
+            if self.client_refreshed or self.client is None:
+                return
+            self.client_refreshed = True
+            client = self.client
+            url = self.get_client_details_url(client)
+            logging.warning(f"get_client_details: unknown organization value, fetching client_id: {client.get('id')} again")
+            self.reference_cache.invalidate(url)
+            data = self.fetch_json("get_client_details", url)
+            if data is not None:
+                self.reference_cache.store(url, data, self.get_fingerprint(client))
+                self.set_client_details(data)
+
+    # Build the organization lookups and legal names of the current client
+    def set_client_details(self, client_details):
+        self.client_organizations = {}
+        for organization in client_details.get("organizations", []):
+            o_key = self.validate(organization.get("title"))
+            o_value = {}
+            for lookup in organization.get("lookups", []):
+                o_value[lookup["code"]] = {
+                    "code": lookup["code"],
+                    "description": lookup["description"]
+                }
+            self.client_organizations[o_key] = o_value
+
+        self.client_legals = {}
+        for legal in client_details.get("legalCompanies", []):
+            l_key = self.validate(legal.get("legalCode"))
+            l_value = self.validate(legal.get("legalName"))
+            self.client_legals[l_key] = l_value
+
+    # Checks of the excepted facilities are not loaded
+    def is_exception_employee(self, employee):
+        if self.name == "checks":
+            facility_code = employee.get("legalCode")
+            if "BHC" in facility_code or "BHCO" in facility_code:
+                logging.warning(f"exception_facility: employee_id: {employee.get('id')} | legal_code: {facility_code}")
+                return True
+        return False
+
+    # Queue the employee on the worker pool, keeping at most 2 * thread_count in flight
+    def submit_employee(self, pending, employee, position=None):
+        if self.executor is None:
+            self.store_employee(self.profiler.sample(self.fetch_employee, employee))
+            self.position = position or self.position
+            return
+        pending.append((position, self.executor.submit(self.profiler.sample, self.fetch_employee, employee)))
+        self.drain_employees(pending, self.thread_count * 2)
+        self.metrics.queue_depth.set("employees", value=len(pending))
+
+    # Store the finished employees in the order they were submitted
+    def drain_employees(self, pending, limit):
+        while len(pending) > limit:
+            position, future = pending.popleft()
+            self.store_employee(future.result())
+            self.position = position or self.position
+
     def parse_employee(self, employee):
-        jobs = self.get_employee_jobs(employee)
-        if self.name == "details":
-            employee_details = self.get_employee_details(employee, jobs)
-            self.insert_employee_details(employee_details)
-        else:
-            employee_check_list = self.get_employee_check_list(employee)
+        self.store_employee(self.profiler.sample(self.fetch_employee, employee))
+
+    # Fetch everything for one employee, runs on the worker threads
+    def fetch_employee(self, employee):
+        current_employee.set(employee.get("id"))
+        try:
+            jobs = self.get_employee_jobs(employee)
+            if self.name == "details":
+                return employee, [self.get_employee_details(employee, jobs)], None
+
+            watermark = self.get_watermark(employee)
+            employee_check_list, last_page_url, walked = self.walk_employee_check_list(employee, watermark)
+            employee_check_list, watermark = self.select_new_checks(employee_check_list, watermark, last_page_url)
+            employee_check_list = self.skip_loaded_checks(employee_check_list)
+            employee_check_details_list = []
             for employee_check in employee_check_list:
-                cur_time = time.time()
-                if cur_time - self.prev_time > 260:
-                    self.token = self.get_token()
-                    self.prev_time = cur_time
+                employee_check_details_list.append(self.get_employee_check_details(employee_check, jobs))
+            # Never move the watermark past a check that could not be fetched
+            if not walked or not all(employee_check_details_list):
+                watermark = None
+            return employee, employee_check_details_list, watermark
 
-                employee_check_details = self.get_employee_check_details(employee_check, jobs)
-                self.insert_employee_checks(employee, employee_check_details)
+        except Exception as e:
+            logging.exception(f"fetch_employee: {employee.get('id')}: {e}")
+        finally:
+            self.request_cache.clear("employee", employee.get("id"))
+        return employee, [], None
+
+    # Insert the fetched rows, only the main thread touches the database
+    def store_employee(self, result):
+        employee, rows, watermark = result
+        self.metrics.employees.inc(self.name)
+        if self.cdc:
+            self.seen_employees.add(str(self.validate(employee.get("id"))))
+        if watermark is not None:
+            self.pending_watermarks[str(self.validate(employee.get("id")))] = watermark
+        self.writer_rows = []
+        with self.profiler.phase("insert"):
+            for row in rows:
+                try:
+                    if self.name == "details":
+                        self.insert_employee_details(row)
+                    else:
+                        self.insert_employee_checks(employee, row)
+                        if self.use_check_index and row.get("id") is not None:
+                            self.check_index.add(row.get("id"))
+                except Exception as e:
+                    logging.exception(f"store_employee: {employee.get('id')}: {e}")
+        if self.writer is not None:
+            # Blocks while the writers are behind
+            with self.profiler.phase("db_writer_wait"):
+                self.writer.put(employee.get("id"), self.writer_rows)
+            self.metrics.queue_depth.set("db_writer", value=self.writer.queue_depth())
+            if time.time() - self.last_mark >= self.flush_interval:
+                self.flush_loaders(wait=False)
 
     # Get all the clients
     def get_client_list(self):
         client_list = []
         try:
-            response = self.session.get(
-                url = f"{self.api_endpoint}/clients", 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                client_list = response.json()["results"]
-            else:
-                logging.error(f"get_client_list: {response.status_code}: {response.content}")
+            data = self.get_reference("get_client_list", f"{self.api_endpoint}/clients", "run")
+            if data is not None:
+                client_list = data["results"]
 
         except Exception as e:
             logging.exception(f"get_client_list: {e}")
@@ -161,17 +620,9 @@ class Main:
     def get_client_details(self, client):
         client_details = {}
         try:
-            response = self.session.get(
-                url = f"{self.api_endpoint}/clients/{client['id']}?includeDetails=True", 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                client_details = response.json()
-            else:
-                logging.error(f"get_client_details: {response.status_code}: {response.content}")
+            data = self.get_reference("get_client_details", self.get_client_details_url(client), "client", self.get_fingerprint(client))
+            if data is not None:
+                client_details = data
 
         except Exception as e:
             logging.exception(f"get_client_details: {e}")
@@ -179,21 +630,16 @@ class Main:
         # logging.info(f"get_client_details")
         return client_details
 
+    def get_client_details_url(self, client):
+        return f"{self.api_endpoint}/clients/{client['id']}?includeDetails=True"
+
     # Get the legal list by client
     def get_legal_list(self, client):
         legal_list = []
         try:
-            response = self.session.get(
-                url = f"{self.api_endpoint}/clients/{client['id']}/legals", 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                legal_list = response.json()
-            else:
-                logging.error(f"get_legal_list: {response.status_code}: {response.content}")
+            data = self.api_get("get_legal_list", f"{self.api_endpoint}/clients/{client['id']}/legals", "client")
+            if data is not None:
+                legal_list = data
 
         except Exception as e:
             logging.exception(f"get_legal_list: {e}")
@@ -201,105 +647,36 @@ class Main:
         # logging.info(f"get_legal_list: {len(legal_list)}")
         return legal_list
 
-    # Get the legal details
+    # Get the legal details, the same resource as the client details
     def get_legal_details(self, client):
-        legal_details = {}
-        try:
-            response = self.session.get(
-                url = f"{self.api_endpoint}/clients/{client['id']}?includeDetails=True", 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                legal_details = response.json()
-            else:
-                logging.error(f"get_legal_details: {response.status_code}: {response.content}")
-
-        except Exception as e:
-            logging.exception(f"get_legal_details: {e}")
-
-        # logging.info(f"get_legal_details")
-        return legal_details
+        return self.get_client_details(client)
 
-    # Get the employees list by legal
+    # Get the employees list by legal, yielded page by page
     def get_legal_employee_list(self, legal):
-        employee_list = []
         try:
-            page_url = None
-            for link in legal.get("links", []):
-                if link["rel"] == "Employees":
-                    page_url = link["href"]
-                    break
-
-            while page_url:
-                response = self.session.get(
-                    url = page_url, 
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {self.token['access_token']}",
-                    }
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    employee_list += data["results"]
-                    page_url = data["nextPageUrl"]
-                else:
-                    logging.error(f"get_legal_employee_list: {response.status_code}: {response.content}")
-                    break
+            yield from self.paginator.items("get_legal_employee_list", self.get_link(legal, "Employees"), "client")
 
         except Exception as e:
             logging.exception(f"get_legal_employee_list: {e}")
 
-        # logging.info(f"get_legal_employee_list: {len(employee_list)}")
-        return employee_list
-
     # Get the employee details
     def get_employee_details(self, employee, jobs):
         employee_details = {}
         try:
-            employee_link = None
-            for link in employee.get("links", []):
-                if link["rel"] == "self":
-                    employee_link = link["href"]
-                    break
+            employee_link = self.get_link(employee, "self")
 
-            response = self.session.get(
-                url = employee_link, 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                employee_details = response.json()
-            else:
-                logging.error(f"get_employee_details: {response.status_code}: {response.content}")
-
-            organizations = []
-            if len(jobs) > 0 and jobs[0].get("organizations"):
-                organizations = jobs[0].get("organizations") or []
-                for organization in organizations:
-                    key = self.validate(organization.get("clientOrganizationField", {}).get("title"))
-                    value = self.validate(organization.get("organizationValue"))
-                    if key == "" or value == "":
-                        continue
-                    employee_details[key] = self.client_organizations[key][value]
-            else:
+            data = self.api_get("get_employee_details", employee_link, "employee")
+            if data is not None:
+                employee_details = data
+
+            employee_check_details = {}
+            if not self.has_job_organizations(jobs):
                 employee_check_list = self.get_employee_check_list(employee)
-                employee_check_details = {}
                 for employee_check in employee_check_list:
                     employee_check_details = self.get_employee_check_details(employee_check, [])
                     if employee_check_details:
                         break
-                organizations = employee_check_details.get("employeeOrganizations") or []
-                for organization in organizations:
-                    key = self.validate(organization.get("title"))
-                    value = self.validate(organization.get("value"))
-                    if key == "" or value == "":
-                        continue
-                    employee_details[key] = self.client_organizations[key][value]
+            self.add_organizations(employee_details, jobs, employee_check_details)
 
         except Exception as e:
             logging.exception(f"get_employee_details: {e}")
@@ -307,77 +684,175 @@ class Main:
         # logging.info(f"get_employee_details")
         return employee_details
 
-    # Get the checks by employee
+    # Get the checks by employee, yielded page by page
     def get_employee_check_list(self, employee):
-        employee_check_list = []
         try:
-            page_url = None
-            for link in employee.get("links", []):
-                if link["rel"] == "Checks":
-                    page_url = link["href"]
-                    break
+            yield from self.paginator.items("get_employee_check_list", self.get_link(employee, "Checks"), "employee")
 
-            while page_url:
-                response = self.session.get(
-                    url = page_url, 
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {self.token['access_token']}",
-                    }
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    employee_check_list += data["results"]
-                    page_url = data["nextPageUrl"]
-                else:
-                    logging.error(f"get_employee_check_list: {response.status_code}: {response.content}")
+        except Exception as e:
+            logging.exception(f"get_employee_check_list: {e}")
+
+    # Walk the check list pages, starting from the watermark page when there is one.
+    # Returns the checks, the url of the last page read and whether the walk got to
+    # its end. The checks of a walk that gave up on a page are loaded, but they must
+    # not move the watermark past the checks of the pages it did not read.
+    def walk_employee_check_list(self, employee, watermark):
+        employee_check_list = []
+        last_page_url = None
+        walked = False
+        try:
+            pages = self.paginator.pages(
+                "get_employee_check_list", self.get_check_list_start(employee, watermark), "employee",
+                lambda data: self.reached_watermark(data["results"], watermark)
+            )
+            for page_url, data in pages:
+                if data is None:
                     break
+                employee_check_list += data["results"]
+                last_page_url = page_url
+            else:
+                walked = True
 
         except Exception as e:
             logging.exception(f"get_employee_check_list: {e}")
 
-        logging.info(f"get_employee_check_list: {len(employee_check_list)}")
-        return employee_check_list
+        logging.info("get_employee_check_list: %s", len(employee_check_list))
+        return employee_check_list, last_page_url, walked
+
+    # Read the check watermark of every employee, keyed by the employee system id
+    def load_watermarks(self):
+        if not self.database and self.incremental:
+            return
+        self.watermarks = {}
+        if self.name != "checks" or not self.incremental:
+            return
+        try:
+            self.cursor.execute("SELECT employee_system_id, last_check_id, last_check_date, last_page_url FROM employee_check_watermarks")
+            for row in self.cursor.fetchall():
+                self.watermarks[str(row[0])] = {
+                    "check_id": row[1],
+                    "check_date": str(row[2]) if row[2] else None,
+                    "page_url": row[3],
+                }
+        except Exception as e:
+            logging.exception(f"load_watermarks: {e}")
+        logging.info(f"load_watermarks: {len(self.watermarks)}")
+
+    # Keyed by str: the API sends int ids, employee_system_id comes back from SQL as str
+    def get_watermark(self, employee):
+        return self.watermarks.get(str(self.validate(employee.get("id"))))
+
+    # New checks are appended to the last page, so an oldest first list resumes there
+    def get_check_list_start(self, employee, watermark):
+        if watermark and watermark.get("page_url") and self.check_list_order == "oldest_first":
+            return watermark["page_url"]
+        return self.get_link(employee, "Checks")
+
+    # A newest first list can stop at the first page that holds a known check
+    def reached_watermark(self, employee_check_list, watermark):
+        if not watermark or self.check_list_order != "newest_first":
+            return False
+        return any(self.is_known_check(employee_check, watermark) for employee_check in employee_check_list)
+
+    def is_known_check(self, employee_check, watermark):
+        if str(employee_check.get("id")) == watermark.get("check_id"):
+            return True
+        check_date = self.validate(employee_check.get("checkDate"), "datetime")
+        return bool(check_date and watermark.get("check_date") and check_date < watermark["check_date"])
+
+    # Walk the checks newest first and keep them until the first known one.
+    # Returns the new checks and the watermark to save once they are stored.
+    def select_new_checks(self, employee_check_list, watermark, last_page_url):
+        direction = 1 if self.check_list_order == "oldest_first" else -1
+        ordered = [
+            employee_check for _, employee_check in sorted(
+                enumerate(employee_check_list),
+                key=lambda item: (self.validate(item[1].get("checkDate"), "datetime") or "", item[0] * direction),
+                reverse=True
+            )
+        ]
+        new_checks = []
+        for employee_check in ordered:
+            if watermark and self.is_known_check(employee_check, watermark):
+                break
+            new_checks.append(employee_check)
+
+        if not new_checks:
+            return new_checks, None
+        newest = new_checks[0]
+        return new_checks, {
+            "check_id": str(newest.get("id")),
+            "check_date": self.validate(newest.get("checkDate"), "datetime"),
+            "page_url": last_page_url,
+        }
+
+    # Every stored check has exactly one NetPay row, written after its other lines,
+    # so only checks that were loaded completely end up in the index
+    def load_check_index(self):
+        if self.name != "checks" or not self.use_check_index or not self.database:
+            return
+        started = time.time()
+        try:
+            self.cursor.execute("SELECT system_id FROM employee_checks WHERE earning_group = 'NetPay'")
+            self.check_index.load(self.fetch_chunks(self.cursor))
+        except Exception as e:
+            logging.exception(f"load_check_index: {e}")
+        logging.info(f"load_check_index: {len(self.check_index)} checks in {time.time() - started:.1f}s")
+
+    # The first column of the cursor's rows, one fetchmany batch at a time
+    def fetch_chunks(self, cursor, size=50000):
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield [row[0] for row in rows]
+
+    # Drop the checks that are already in the database before fetching their details
+    def skip_loaded_checks(self, employee_check_list):
+        if not self.use_check_index:
+            return employee_check_list
+        new_checks = [
+            employee_check for employee_check in employee_check_list
+            if self.validate(employee_check.get("id")) not in self.check_index
+        ]
+        self.skipped_checks += len(employee_check_list) - len(new_checks)
+        return new_checks
+
+    # Save the watermarks of the employees whose checks are flushed
+    def save_watermarks(self, watermarks, conn):
+        if not watermarks or self.replay:
+            return
+        if not self.database:
+            self.watermarks.update(watermarks)
+            return
+        rows = [
+            (employee_system_id, watermark["check_id"], watermark["check_date"], watermark["page_url"])
+            for employee_system_id, watermark in watermarks.items()
+        ]
+        cursor = conn.cursor()
+        cursor.executemany('''
+            MERGE employee_check_watermarks AS t
+            USING (SELECT ? AS employee_system_id, ? AS last_check_id, ? AS last_check_date, ? AS last_page_url) AS s
+            ON t.employee_system_id = s.employee_system_id
+            WHEN MATCHED THEN UPDATE SET
+                last_check_id = s.last_check_id, last_check_date = s.last_check_date,
+                last_page_url = s.last_page_url, updated_at = GETDATE()
+            WHEN NOT MATCHED THEN INSERT (employee_system_id, last_check_id, last_check_date, last_page_url, updated_at)
+                VALUES (s.employee_system_id, s.last_check_id, s.last_check_date, s.last_page_url, GETDATE());''', rows)
+        conn.commit()
+        cursor.close()
 
     # Get the employee check details
     def get_employee_check_details(self, employee_check, jobs):
         employee_check_details = {}
         try:
-            employee_check_link = None
-            for link in employee_check.get("links", []):
-                if link["rel"] == "self":
-                    employee_check_link = link["href"]
-                    break
+            employee_check_link = self.get_link(employee_check, "self")
 
-            response = self.session.get(
-                url = employee_check_link, 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                employee_check_details = response.json()
-            else:
-                logging.error(f"get_employee_check_details: {response.status_code}: {response.content}")
-
-            organizations = []
-            if len(jobs) > 0 and jobs[0].get("organizations"):
-                organizations = jobs[0].get("organizations") or []
-                for organization in organizations:
-                    key = self.validate(organization.get("clientOrganizationField", {}).get("title"))
-                    value = self.validate(organization.get("organizationValue"))
-                    if key == "" or value == "":
-                        continue
-                    employee_check_details[key] = self.client_organizations[key][value]
-            else:
-                organizations = employee_check_details.get("employeeOrganizations") or []
-                for organization in organizations:
-                    key = self.validate(organization.get("title"))
-                    value = self.validate(organization.get("value"))
-                    if key == "" or value == "":
-                        continue
-                    employee_check_details[key] = self.client_organizations[key][value]
+            data = self.api_get("get_employee_check_details", employee_check_link, "employee")
+            if data is not None:
+                employee_check_details = data
+
+            self.add_organizations(employee_check_details, jobs, employee_check_details)
 
         except Exception as e:
             logging.exception(f"get_employee_check_details: {e}")
@@ -385,27 +860,51 @@ class Main:
         # logging.info(f"get_employee_check_details")
         return employee_check_details
 
+    # Copy the organizations of the first job, or else of the check, onto the record.
+    # A value missing from the client details refreshes them and maps once more.
+    def add_organizations(self, record, jobs, employee_check_details):
+        try:
+            self.map_organizations(record, jobs, employee_check_details)
+        except KeyError:
+            self.refresh_client_details()
+            self.map_organizations(record, jobs, employee_check_details)
+
+    def map_organizations(self, record, jobs, employee_check_details):
+        if self.has_job_organizations(jobs):
+            self.add_job_organizations(record, jobs)
+        else:
+            self.add_check_organizations(record, employee_check_details)
+
+    def has_job_organizations(self, jobs):
+        return len(jobs) > 0 and bool(jobs[0].get("organizations"))
+
+    # Copy the organizations of the first job onto the record
+    def add_job_organizations(self, record, jobs):
+        for organization in jobs[0].get("organizations") or []:
+            key = self.validate(organization.get("clientOrganizationField", {}).get("title"))
+            value = self.validate(organization.get("organizationValue"))
+            if key == "" or value == "":
+                continue
+            record[key] = self.client_organizations[key][value]
+
+    # Copy the organizations of a check onto the record
+    def add_check_organizations(self, record, employee_check_details):
+        for organization in employee_check_details.get("employeeOrganizations") or []:
+            key = self.validate(organization.get("title"))
+            value = self.validate(organization.get("value"))
+            if key == "" or value == "":
+                continue
+            record[key] = self.client_organizations[key][value]
+
     # Get the jobs by employee
     def get_employee_jobs(self, employee,):
         jobs = []
         try:
-            employee_link = None
-            for link in employee.get("links", []):
-                if link["rel"] == "self":
-                    employee_link = link["href"]
-                    break
+            employee_link = self.get_link(employee, "self")
 
-            response = self.session.get(
-                url = f"{employee_link}/jobs", 
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.token['access_token']}",
-                }
-            )
-            if response.status_code == 200:
-                jobs = response.json()
-            else:
-                logging.error(f"get_employee_jobs: {response.status_code}: {response.content}")
+            data = self.api_get("get_employee_jobs", f"{employee_link}/jobs", "employee")
+            if data is not None:
+                jobs = data
 
         except Exception as e:
             logging.exception(f"get_employee_jobs: {e}")
@@ -413,6 +912,124 @@ class Main:
         # logging.info(f"get_employee_jobs")
         return jobs
 
+    # Reference data from the reference cache, fetched when it is not there
+    def get_reference(self, name, url, scope, fingerprint=None):
+        data = self.lookup_reference(name, url, fingerprint)
+        if data is None:
+            data = self.api_get(name, url, scope)
+            self.reference_cache.store(url, data, fingerprint)
+        return data
+
+    # The archive gets the cached responses too, a replay needs them
+    def lookup_reference(self, name, url, fingerprint=None):
+        data = self.reference_cache.lookup(url, fingerprint)
+        if data is not None and self.archive is not None:
+            self.archive.add(name, url, json.dumps(data).encode())
+        return data
+
+    # A client's details are fetched again once its record in the client list changes
+    def get_fingerprint(self, record):
+        return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+    # GET an API resource, at most once per run, client or employee scope. None if it failed.
+    def api_get(self, name, url, scope=None):
+        if scope is None:
+            return self.fetch_json(name, url)
+        return self.request_cache.get(name, scope, self.get_scope_key(scope), url, lambda: self.fetch_json(name, url))
+
+    # One phase of the profile per endpoint, the waits and retries included
+    def fetch_json(self, name, url):
+        with self.profiler.phase(self.endpoints.get(name, name)):
+            if self.replay:
+                return self.replay_json(name, url)
+            return self.request_json(name, url)
+
+    # Paced by the rate controller. Throttling, 5xx and connection errors are retried
+    # with backoff, a 401 means the token expired under us and is retried once.
+    def request_json(self, name, url):
+        endpoint = self.endpoints.get(name, name)
+        attempt = 0
+        token_retried = False
+        while True:
+            access_token = self.tokens.get_access_token()
+            try:
+                with self.rate.slot():
+                    started = time.time()
+                    response = self.transport.get(url, access_token)
+                    self.record_request(endpoint, response.status_code, time.time() - started, len(response.content))
+            except requests.exceptions.RequestException as e:
+                self.record_request(endpoint, "error", time.time() - started, 0)
+                self.rate.record(None, time.time() - started)
+                if not self.rate.should_retry(None, attempt):
+                    raise
+                delay = self.rate.retry_delay(attempt)
+                logging.warning(f"{name}: {e} | retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            retry_after = response.headers.get("Retry-After")
+            self.rate.record(response.status_code, time.time() - started, retry_after)
+            if response.status_code == 401 and not token_retried:
+                logging.warning(f"{name}: 401, refreshing the token")
+                self.tokens.invalidate(access_token)
+                token_retried = True
+                continue
+            if self.rate.should_retry(response.status_code, attempt):
+                delay = self.rate.retry_delay(attempt, retry_after)
+                logging.warning(f"{name}: {response.status_code} | retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if response.status_code == 200:
+                if self.archive is not None:
+                    self.archive.add(name, url, response.content)
+                return self.decode(name, response.content)
+            logging.error("%s: %s: %s", name, response.status_code, Body(response.content))
+            return None
+
+    # The archived response of url, like a failed request when it was never fetched
+    def replay_json(self, name, url):
+        found = self.archive_reader.get(url)
+        if found is None:
+            logging.warning(f"{name}: not in the archive: {url}")
+            return None
+        content, fetched_at = found
+        data = self.decode(name, content)
+        if name in self.dated_endpoints and isinstance(data, dict):
+            data["_fetched_at"] = fetched_at
+        return data
+
+    # Decode a response body, list pages are cut down to the fields that are read
+    def decode(self, name, content):
+        started = time.perf_counter()
+        with self.profiler.phase("decode"):
+            data = self.json_decoder.decode(name, content)
+        self.metrics.decode_seconds.inc(self.endpoints.get(name, name), amount=time.perf_counter() - started)
+        return data
+
+    def record_request(self, endpoint, status, latency, size):
+        self.metrics.request_seconds.observe(endpoint, value=latency)
+        self.metrics.requests.inc(endpoint, status)
+        self.metrics.response_bytes.inc(endpoint, amount=size)
+
+    def get_scope_key(self, scope):
+        if scope == "client":
+            return current_client.get()
+        if scope == "employee":
+            return current_employee.get()
+        return None
+
+    def get_headers(self, access_token=None):
+        return self.transport.get_headers(access_token or self.tokens.get_access_token())
+
+    # Find the href of the given rel in the links of an item
+    def get_link(self, item, rel):
+        for link in item.get("links", []):
+            if link["rel"] == rel:
+                return link["href"]
+        return None
+
     # Retrived the token from OAuth2
     def get_token(self):
         token = {}
@@ -421,7 +1038,7 @@ class Main:
                 self.config.get("client_id"),
                 self.config.get("client_secret")
             )
-            response = requests.post(
+            response = self.transport.post(
                 url = f"{self.api_endpoint}/token",
                 auth = client_auth,
                 data = {
@@ -433,305 +1050,331 @@ class Main:
                 logging.info(f"get_token")
                 return token
             else:
-                logging.error(f"get_token: {response.status_code}: {response.content}")
+                logging.error("get_token: %s: %s", response.status_code, Body(response.content))
 
         except Exception as e:
             logging.exception(f"get_token: {e}")
-        
-        exit(0)
+
+        return None
 
     # Retrived the refresh_token from OAuth2
-    def get_refresh_token(self):
-        refresh_token = {}
+    def get_refresh_token(self, refresh_token):
+        token = {}
         try:
-            initial_token = self.get_token()
-            response = requests.post(
+            response = self.transport.post(
                 url = f"{self.api_endpoint}/token",
                 data = {
                     "grant_type": "refresh_token",
-                    "refresh_token": initial_token['refresh_token'],
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
+                    "refresh_token": refresh_token,
+                    "client_id": self.config.get("client_id"),
+                    "client_secret": self.config.get("client_secret"),
                 }
             )
             if response.status_code == 200:
-                refresh_token = response.json()
+                token = response.json()
             else:
-                logging.info(f"get_refresh_token: {response.status_code}: {response.content}")
+                logging.info("get_refresh_token: %s: %s", response.status_code, Body(response.content))
 
         except Exception as e:
             logging.info(f"get_refresh_token: {e}")
 
-        return refresh_token
+        return token
 
     # Create the Azure sql database connection
     def connect_database(self):
+        if not self.database:
+            self.setup_loaders()
+            return
+        self.conn = self.open_connection()
+        self.cursor = self.conn.cursor()
+
+        # The schema is brought up to date once per process, a reconnect only connects
+        if not self.migrated:
+            migrate(self.conn, {"checks_columnstore": self.setting("checks_columnstore", "false").lower() == "true"})
+            self.migrated = True
+        self.setup_loaders()
+
+    # A new connection to the Azure sql database, None when there is no sql sink
+    def open_connection(self):
+        if not self.database:
+            return None
         server = self.config.get('server')
         database = self.config.get('database')
         username = self.config.get('username')
         password = self.config.get('password')
         driver= self.config.get('driver')
-        self.conn = pyodbc.connect(f"DRIVER={driver};PORT=1433;SERVER={server};PORT=1443;DATABASE={database};UID={username};PWD={password}")
-        self.cursor = self.conn.cursor()
+        return pyodbc.connect(f"DRIVER={driver};PORT=1433;SERVER={server};PORT=1443;DATABASE={database};UID={username};PWD={password}")
+
+    # One loader per table and sink, the sql dedup keys match the old IF NOT EXISTS checks
+    def setup_loaders(self):
+        if self.loaders:
+            for loaders in self.loaders.values():
+                for loader in loaders:
+                    loader.set_connection(getattr(self, "conn", None))
+            return
+        self.loaders = self.make_loaders(getattr(self, "conn", None))
+
+    # Every writer thread has its own loaders, `part` keeps their files apart
+    def make_loaders(self, conn, part=None):
+        return {
+            table: [self.get_loader(sink, table, columns, key_columns, conn, part) for sink in self.get_table_sinks(table)]
+            for table, columns, key_columns in self.get_tables()
+        }
 
-        # Create employee_list_type_1 table if not exist
-        self.cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_list_type_1' AND xtype='U')
-            CREATE TABLE employee_list_type_1 (
-                id int Identity primary key NOT NULL,
-                facility_name nvarchar(100),
-                department nvarchar(100),
-                department_code nvarchar(100),
-                employee_first_name nvarchar(100),
-                employee_middle_name nvarchar(100),
-                employee_last_name nvarchar(100),
-                hire_date date,
-                rehire_date date,
-                termination_date date,
-                leave_date date,
-                seniority_date date,
-                position nvarchar(100),
-                position_id nvarchar(100),
-                system_id nvarchar(100),
-                employee_id nvarchar(100),
-                status nvarchar(100),
-                status_type nvarchar(100),
-                email nvarchar(100),
-                pay_type nvarchar(100),
-                hourly_rate float,
-                load_date date
-            )
-       ''')
-        self.conn.commit()
-
-        # Create employee_list_type_2 table if not exist
-        self.cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_list_type_2' AND xtype='U')
-            CREATE TABLE employee_list_type_2 (
-                id int Identity primary key NOT NULL,
-                facility_name nvarchar(100),
-                department nvarchar(100),
-                department_code nvarchar(100),
-                employee_first_name nvarchar(100),
-                employee_middle_name nvarchar(100),
-                employee_last_name nvarchar(100),
-                hire_date date,
-                rehire_date date,
-                termination_date date,
-                leave_date date,
-                seniority_date date,
-                position nvarchar(100),
-                position_id nvarchar(100),
-                system_id nvarchar(100),
-                employee_id nvarchar(100),
-                status nvarchar(100),
-                status_type nvarchar(100),
-                email nvarchar(100),
-                pay_type nvarchar(100),
-                load_date date
+    # In cdc mode SQL Server gets the history table instead of the snapshots, the files keep the snapshot shape
+    def get_table_sinks(self, table):
+        if not self.cdc:
+            return self.sinks
+        if table == "employee_list_history":
+            return [sink for sink in self.sinks if sink == "sql"]
+        if table in ["employee_list_type_1", "employee_list_type_2"]:
+            return [sink for sink in self.sinks if sink != "sql"]
+        return self.sinks
+
+    def get_loader(self, sink, table, columns, key_columns, conn, part=None):
+        if sink == "csv":
+            return CsvSink(self.output_dir, table, columns, self.batch_size, self.flush_interval, part)
+        if sink == "parquet":
+            return ParquetSink(
+                self.output_dir, table, columns, self.setting("parquet_partition", "load_date"),
+                self.setting("parquet_row_group_size", 50000, int), self.flush_interval, part,
+                self.setting("parquet_max_buffered_rows", 200000, int), self.setting("parquet_max_open_files", 64, int)
             )
-       ''')
-        self.conn.commit()
-
-        # Create employee_checks table if not exist
-        self.cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='employee_checks' AND xtype='U')
-            CREATE TABLE employee_checks (
-                id int Identity primary key NOT NULL,
-                facility_name nvarchar(100),
-                department nvarchar(100),
-                department_code nvarchar(100),
-                employee_first_name nvarchar(100),
-                employee_last_name nvarchar(100),
-                position nvarchar(100),
-                position_code nvarchar(100),
-                system_id nvarchar(100),
-                employee_id nvarchar(100),
-                hours float,
-                dollars float,
-                earning_code nvarchar(100),
-                earning_group nvarchar(100),
-                check_date date,
-                period_end_date date,
-                check_type nvarchar(100),
-                check_number nvarchar(100),
-                load_date date
+        if table == "employee_list_history":
+            return HistoryLoader(conn, table, columns, key_columns, self.batch_size, self.flush_interval)
+        return BulkLoader(conn, table, columns, key_columns, self.batch_size, self.flush_interval, self.replace)
+
+    # The sql loaders of this instance and of the writer threads
+    def get_sql_loaders(self):
+        loader_sets = [self.loaders]
+        if self.writer is not None:
+            loader_sets += [writer.loaders for writer in self.writer.writers]
+        return [
+            loader for loaders in loader_sets for table_loaders in loaders.values()
+            for loader in table_loaders if loader.sink == "sql"
+        ]
+
+    # A replay that only inserts keeps the rows already loaded, say how many replayed rows that dropped
+    def report_replayed_rows(self):
+        loaders = self.get_sql_loaders()
+        skipped = sum(loader.skipped for loader in loaders)
+        if self.replace:
+            logging.info(f"replay: replaced {sum(loader.replaced for loader in loaders)} rows")
+        elif skipped:
+            logging.warning(f"replay: {skipped} rows not loaded, their keys are already in the tables. Delete those rows first or replay with replay_mode=replace")
+
+    # Rows are written behind by db_writers threads on their own connections,
+    # 0 writes them on the storing thread as before
+    def setup_writer(self):
+        self.writer = None
+        self.writer_rows = []
+        self.last_mark = time.time()
+        db_writers = self.setting("db_writers", 1, int)
+        if db_writers > 0:
+            self.writer = DbWriter(
+                db_writers, self.setting("db_queue_size", 200, int), self.open_connection,
+                self.make_loaders, self.commit_mark, self.record_flush
             )
-       ''')
-        self.conn.commit()
+
+    # The loaded tables with their columns and dedup keys
+    def get_tables(self):
+        employee_list_type_2_columns = [column for column in self.employee_list_columns if column != "hourly_rate"]
+        tables = [
+            ("employee_list_type_1", self.employee_list_columns, ["system_id", "load_date"]),
+            ("employee_list_type_2", employee_list_type_2_columns, ["system_id", "load_date"]),
+            ("employee_checks", self.employee_checks_columns, ["system_id", "earning_code", "earning_group"]),
+        ]
+        if self.cdc:
+            tables.append(("employee_list_history", self.employee_list_history_columns, ["system_id"]))
+        return tables
 
     # Close the Azure sql database connection
     def disconnect_database(self):
-        self.cursor.close()
-        self.conn.close()
-
-    # Insert employee checks into database
-    def insert_employee_details(self, employee_details):
-        today = date.today().strftime('%Y-%m-%d')
+        self.flush_loaders()
+        self.close_loaders()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.leases is not None:
+            self.leases.close()
+            self.leases = None
+        self.reference_cache.save()
+        self.transport.close()
+        if self.database:
+            self.cursor.close()
+            self.conn.close()
+
+    # Buffer the row in every sink and flush once a batch is full or old enough.
+    # With the writer the rows of the employee are queued together by store_employee.
+    def load_row(self, table, row):
+        if self.writer is not None:
+            self.writer_rows.append((table, row))
+            return
+        due = False
+        for loader in self.loaders[table]:
+            loader.add(row)
+            self.metrics.rows_buffered.set(loader.sink, table, value=len(loader.rows))
+            due = due or loader.is_due()
+        # Flush every table together so the checkpoint and watermarks match what is committed
+        if due:
+            self.flush_loaders()
+
+    def flush_loader(self, loader):
         try:
-            facility_name = self.client_legals.get(self.validate(employee_details.get("legalCode"))) or ""
-            system_id = self.validate(employee_details.get("id"))
-            employee_id = self.validate(employee_details.get("employeeNumber"))
-            if facility_name != "" and facility_name.lower() not in self.exception_list:
-                self.cursor.execute(f"""
-                    IF NOT EXISTS (SELECT * FROM employee_list_type_1 WHERE system_id='{system_id}' and load_date='{today}')
-                    INSERT employee_list_type_1 (
-                        facility_name, department, department_code, employee_first_name,
-                        employee_middle_name, employee_last_name, hire_date, rehire_date,
-                        termination_date, leave_date, seniority_date, position,
-                        position_id, system_id, employee_id, status, status_type,
-                        email, pay_type, hourly_rate, load_date
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-
-                    self.validate(facility_name),
-                    self.validate(employee_details.get("Department", {}).get("description")),
-                    self.validate(employee_details.get("Department", {}).get("code")),
-                    self.validate(employee_details.get("nameAddress", {}).get("firstName")),
-                    self.validate(employee_details.get("nameAddress", {}).get("middleName")),
-                    self.validate(employee_details.get("nameAddress", {}).get("lastName")),
-                    self.validate(employee_details.get("hireDate"), "datetime"),
-                    self.validate(employee_details.get("rehireDate"), "datetime"),
-                    self.validate(employee_details.get("terminationDate"), "datetime"),
-                    None,
-                    None,
-                    self.validate(employee_details.get("Position", {}).get("description")),
-                    self.validate(employee_details.get("Position", {}).get("code")),
-                    system_id,
-                    employee_id,
-                    self.get_employee_status_code(self.validate(employee_details.get("employmentStatus"))),
-                    self.validate(employee_details.get("employmentCategoryCode")),
-                    self.validate(employee_details.get("emailAddress")),
-                    self.validate(employee_details.get("payType")),
-                    self.validate(employee_details.get("hourlyRate"), "number"),
-                    today
-                )
-            else:
-                self.cursor.execute(f"""
-                    IF NOT EXISTS (SELECT * FROM employee_list_type_2 WHERE system_id='{system_id}' and load_date='{today}')
-                    INSERT employee_list_type_2 (
-                        facility_name, department, department_code, employee_first_name,
-                        employee_middle_name, employee_last_name, hire_date, rehire_date,
-                        termination_date, leave_date, seniority_date, position,
-                        position_id, system_id, employee_id, status, status_type,
-                        email, pay_type, load_date
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-
-                    self.validate(facility_name),
-                    self.validate(employee_details.get("Department", {}).get("description")),
-                    self.validate(employee_details.get("Department", {}).get("code")),
-                    self.validate(employee_details.get("nameAddress", {}).get("firstName")),
-                    self.validate(employee_details.get("nameAddress", {}).get("middleName")),
-                    self.validate(employee_details.get("nameAddress", {}).get("lastName")),
-                    self.validate(employee_details.get("hireDate"), "datetime"),
-                    self.validate(employee_details.get("rehireDate"), "datetime"),
-                    self.validate(employee_details.get("terminationDate"), "datetime"),
-                    None,
-                    None,
-                    self.validate(employee_details.get("Position", {}).get("description")),
-                    self.validate(employee_details.get("Position", {}).get("code")),
-                    system_id,
-                    employee_id,
-                    self.get_employee_status_code(self.validate(employee_details.get("employmentStatus"))),
-                    self.validate(employee_details.get("employmentCategoryCode")),
-                    self.validate(employee_details.get("emailAddress")),
-                    self.validate(employee_details.get("payType")),
-                    today
-                )
-            self.conn.commit()
-            if self.count / 100 == 0:
-                logging.info(f"counter: {self.count} | legal_code: {employee_details.get('legalCode')} | facility_name: {facility_name}")
-            self.count += 1
+            started = time.time()
+            inserted = loader.flush()
+            self.record_flush(loader, inserted, time.time() - started)
         except Exception as e:
-            logging.exception(f"insert_employee_details: {e}")
+            logging.exception(f"flush_loader: {loader.table}: {e}")
             time.sleep(60)
-            logging.exception(f"insert_employee_details: connecting database again")
+            logging.exception(f"flush_loader: connecting database again")
             self.connect_database()
-            self.insert_employee_details(employee_details)
-
-    # Insert employee checks into database
-    def insert_employee_checks(self, employee, employee_check_details):
-        system_id = self.validate(employee_check_details.get("id"))
-        employee_id = self.validate(employee_check_details.get("employeeNumber"))
-        for earning in employee_check_details.get("garnishments") or []:
-            self.add_query(employee, employee_check_details, system_id, employee_id, "Garnishments", 
-                self.validate(earning.get("itemCode")), 
-                self.validate(earning.get("checkHours"), "number"),
-                self.validate(earning.get("checkDollars"), "number")
-            )
-
-        for earning in employee_check_details.get("deductions") or []:
-            self.add_query(employee, employee_check_details, system_id, employee_id, "Deductions", 
-                self.validate(earning.get("itemCode")), 
-                self.validate(earning.get("checkHours"), "number"),
-                self.validate(earning.get("checkDollars"), "number")
-            )
-
-        for earning in employee_check_details.get("directDeposits") or []:
-            self.add_query(employee, employee_check_details, system_id, employee_id, "Direct Deposits", 
-                self.validate(earning.get("itemDescription")), 
-                0.0,
-                self.validate(earning.get("depositAmount"), "number")
-            )
+            self.flush_loader(loader)
+
+    def record_flush(self, loader, inserted, seconds):
+        self.profiler.record(f"flush:{loader.table}", seconds)
+        self.metrics.flush_seconds.observe(loader.sink, loader.table, value=seconds)
+        self.metrics.rows_inserted.inc(loader.sink, loader.table, amount=inserted)
+        self.metrics.rows_buffered.set(loader.sink, loader.table, value=len(loader.rows))
+
+    # Watermarks are saved only after the checks they cover are in the database.
+    # With the writer they go out with a marker behind the queued rows, wait=False
+    # lets the fetching go on while the writers catch up.
+    def flush_loaders(self, wait=True):
+        if self.writer is not None:
+            watermarks, self.pending_watermarks = self.pending_watermarks, {}
+            self.last_mark = time.time()
+            self.writer.mark((watermarks, self.position), wait)
+            return
+        for loaders in self.loaders.values():
+            for loader in loaders:
+                self.flush_loader(loader)
+        self.flush_watermarks()
+        self.save_checkpoint()
+
+    # Runs on the writer thread that reaches the marker last
+    def commit_mark(self, conn, payload):
+        watermarks, position = payload
+        self.save_watermarks(watermarks, conn)
+        if position is not None:
+            self.save_checkpoint(position=position)
+
+    # Finish the files of the pass, the parquet footers are written here
+    def close_loaders(self):
+        if self.writer is not None:
+            self.writer.mark(None, wait=True, close=True)
+        for loaders in self.loaders.values():
+            for loader in loaders:
+                try:
+                    loader.close()
+                except Exception as e:
+                    logging.exception(f"close_loaders: {loader.sink}: {loader.table}: {e}")
+
+    def flush_watermarks(self):
+        try:
+            self.save_watermarks(self.pending_watermarks, getattr(self, "conn", None))
+            self.pending_watermarks = {}
+        except Exception as e:
+            logging.exception(f"flush_watermarks: {e}")
+            time.sleep(60)
+            logging.exception(f"flush_watermarks: connecting database again")
+            self.connect_database()
+            self.flush_watermarks()
 
-        for earning in employee_check_details.get("taxes") or []:
-            self.add_query(employee, employee_check_details, system_id, employee_id, "Taxes", 
-                self.validate(earning.get("itemCode") or earning.get("itemDescription")), 
-                self.validate(earning.get("checkHours"), "number"),
-                self.validate(earning.get("checkDollars"), "number")
-            )
+    # Today, for a replayed response the day it was archived, so a replace keeps the load_date of the history
+    def get_load_date(self, record):
+        fetched_at = record.get("_fetched_at")
+        return (date.fromtimestamp(fetched_at) if fetched_at else date.today()).strftime('%Y-%m-%d')
 
-        for earning in employee_check_details.get("earnings") or []:
-            self.add_query(employee, employee_check_details, system_id, employee_id, "Earning", 
-                self.validate(earning.get("itemCode") or earning.get("itemDescription")), 
-                self.validate(earning.get("checkHours"), "number"),
-                self.validate(earning.get("checkDollars"), "number")
-            )
-            
-        self.add_query(employee, employee_check_details, system_id, employee_id, "NetPay", 
-            "", 
-            0.0,
-            self.validate(employee_check_details.get("netPay"), "number")
-        )
+    # Insert employee details into database
+    def insert_employee_details(self, employee_details):
+        facility_name = self.client_legals.get(self.validate(employee_details.get("legalCode"))) or ""
+        row = mappings.employee_list.extract(employee_details, {
+            "facility_name": facility_name,
+            "load_date": self.get_load_date(employee_details),
+        })
+        list_type = 1 if facility_name != "" and facility_name.lower() not in self.exception_list else 2
+        if self.cdc and not self.is_changed_employee(row, list_type):
+            return
+        if list_type == 1:
+            self.load_row("employee_list_type_1", row)
+        else:
+            # employee_list_type_2 has no hourly_rate
+            self.load_row("employee_list_type_2", row[:19] + row[20:])
+        self.count_row(employee_details.get('legalCode'), facility_name)
 
-    def add_query(self, employee, employee_check_details, system_id, employee_id, earning_group, earning_code, hours, dallers):
-        today = date.today().strftime('%Y-%m-%d')
+    # Insert employee checks into database, one row per line item of the check
+    def insert_employee_checks(self, employee, employee_check_details):
+        context = {"load_date": self.get_load_date(employee_check_details)}
+        head = mappings.check_head.extract(employee_check_details, context)
+        tail = mappings.check_tail.extract(employee_check_details, context)
+        for items_key, line in mappings.check_lines:
+            items = (employee_check_details.get(items_key) or []) if items_key else [employee_check_details]
+            for item in items:
+                self.load_row("employee_checks", head + line.extract(item) + tail)
+                self.count_row(employee.get('legalCode'), employee_check_details.get('legalCompanyName'))
+
+    # Compare the employee with its open version, a changed one is queued as the new version
+    def is_changed_employee(self, row, list_type):
+        # str like the system_id read back from SQL, the API sends ints
+        system_id = str(row[self.system_id_index])
+        row_hash = hashlib.sha1(repr((list_type,) + row[:-1]).encode()).hexdigest()
+        if self.employee_hashes.get(system_id) == row_hash:
+            self.unchanged_employees += 1
+            return False
+        self.employee_hashes[system_id] = row_hash
+        self.load_row("employee_list_history", row[:-1] + (list_type, row_hash, row[-1]))
+        return True
+
+    # An employee the API no longer lists keeps its open version, and the daily views
+    # would go on showing it. After a pass that walked every client's employee list
+    # to the end, close the open versions of the employees it did not list. Sharded,
+    # resumed and replayed passes only see part of the employees and close none.
+    def close_missing_employees(self):
+        if not self.cdc or not self.database or not self.walked_all or self.leases is not None or self.replay:
+            return
+        missing = [system_id for system_id in self.employee_hashes if system_id not in self.seen_employees]
+        if not missing:
+            return
         try:
-            self.cursor.execute(f"""
-                IF NOT EXISTS (SELECT * FROM employee_checks WHERE system_id='{system_id}' and earning_code='{earning_code}' and earning_group='{earning_group}')
-                INSERT employee_checks (
-                    facility_name, department, department_code, employee_first_name, employee_last_name, 
-                    position, position_code, system_id, employee_id, hours, dollars, earning_code,
-                    earning_group, check_date, period_end_date, check_type, check_number, load_date
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                self.validate(employee_check_details.get("legalCompanyName")),
-                self.validate(employee_check_details.get("Department", {}).get("description")),
-                self.validate(employee_check_details.get("Department", {}).get("code")),
-                self.validate(employee_check_details.get("employeeName")).split(" ")[0],
-                self.validate(employee_check_details.get("employeeName")).split(" ")[-1],
-                self.validate(employee_check_details.get("Position", {}).get("description")),
-                self.validate(employee_check_details.get("Position", {}).get("code")),
-                system_id,
-                employee_id,
-                hours,
-                dallers,
-                earning_code,
-                earning_group,
-                self.validate(employee_check_details.get("checkDate"), "datetime"),
-                self.validate(employee_check_details.get("periodEndDate"), "datetime"),
-                self.validate(employee_check_details.get("checkTypeDescription")),
-                self.validate(employee_check_details.get("checkNumber")),
-                today
+            cursor = self.conn.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(
+                "UPDATE employee_list_history SET valid_to = ? WHERE system_id = ? AND valid_to IS NULL",
+                [(date.today().strftime('%Y-%m-%d'), system_id) for system_id in missing]
             )
             self.conn.commit()
-            if self.count / 100 == 0:
-                logging.info(f"counter: {self.count} | legal_code: {employee.get('legalCode')} | facility_name: {employee_check_details.get('legalCompanyName')}")
-            self.count += 1
+            cursor.close()
+            for system_id in missing:
+                del self.employee_hashes[system_id]
+            logging.info(f"cdc: closed {len(missing)} employees no longer listed")
         except Exception as e:
-            logging.exception(f"insert_employee_checks: {e}")
-            time.sleep(60)
-            logging.exception(f"insert_employee_checks: connecting database again")
-            self.connect_database()
-            self.add_query(employee, employee_check_details, system_id, employee_id, earning_group, earning_code, hours, dallers)
+            logging.exception(f"close_missing_employees: {e}")
+
+    # The hashes of the open versions, without SQL Server they are kept from the last pass
+    def load_employee_hashes(self):
+        if not self.cdc or not self.database:
+            return
+        started = time.time()
+        self.employee_hashes = {}
+        try:
+            self.cursor.execute("SELECT system_id, row_hash FROM employee_list_history WHERE valid_to IS NULL")
+            while True:
+                rows = self.cursor.fetchmany(50000)
+                if not rows:
+                    break
+                self.employee_hashes.update((str(row[0]), row[1]) for row in rows)
+        except Exception as e:
+            logging.exception(f"load_employee_hashes: {e}")
+        logging.info(f"load_employee_hashes: {len(self.employee_hashes)} employees in {time.time() - started:.1f}s")
+
+    def count_row(self, legal_code, facility_name):
+        if self.count % 100 == 0:
+            logging.info("counter: %s | legal_code: %s | facility_name: %s", self.count, legal_code, facility_name)
+        self.count += 1
 
 
     def validate(self, item, field_type="string"):
@@ -748,59 +1391,24 @@ class Main:
         return item
 
 
-    def get_employee_status_code(self, status):
-        employment_status_types = {
-            "Active": "A",
-            "Inactive": "I",
-            "Terminated": "T"
-        }
-        if status in employment_status_types:
-            return employment_status_types[status]
-        else:
-            return status
-
-    # Create csv file
-    def get_writer(self):
-        output_file = open(f'myisolved_{self.name}.csv', mode='w', newline='')
-        output_writer = csv.writer(output_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-        csv_headers = {
-            "details": [
-                "Facility Name", "Department", "Department Code", "Employee First Name", "Employee Middle Name", 
-                "Employee Last Name", "Hire Date", "Rehire Date", "Termination Date", "Leave Date", 
-                "Seniority Date", "Position", "Position ID", "Employee ID", "Status", "Status Type",
-                "Email", "Pay Type", "Hourly Rate",
-            ],
-            "checks": [
-                "Facility Name", "Department", "Department Code", "Employee First Name", "Employee Last Name",
-                "Position", "Position Code", "Employee ID", "Hours", "Dollars", "Earning Code",
-                "Earning Group", "Check Date", "Period End Date", "Check Type", "Check Number",
-            ]
-        }
-        output_writer.writerow(csv_headers[self.name])
-        return output_writer
-
-    
-    def write(self, values):
-        row = []
-        for header in self.csv_headers:
-            row.append(values.get(header, ''))
-        self.csv_writer.writerow(row)
-
-
+    # Text lines or json lines (log_format), written by a background thread with
+    # log_queue_size, log_sample keeps a share of the frequent info events and
+    # log_max_mb rotates and gzips the file
     def setup_log(self):
-        filename = 'history.log'
-        if not os.path.isdir("logs"):
-            os.makedirs("logs")
         timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M')
-        logging.basicConfig(
-            filename=f"logs/{self.name}-{timestamp}.log",
-            format='%(asctime)s %(levelname)-8s %(message)s',
-            level=logging.INFO,
-            datefmt='%Y-%m-%d %H:%M:%S')
+        log_writer.body_limit = self.setting("log_body_limit", log_writer.body_limit, int)
+        setup_logging(
+            f"logs/{self.name}-{timestamp}.log",
+            self.setting("log_format", "text"),
+            self.setting("log_queue_size", 0, int),
+            parse_sample(self.setting("log_sample", None)),
+            int(self.setting("log_max_mb", 0, float) * 1024 * 1024),
+            self.setting("log_backups", 10, int),
+        )
         logging.info("==============================================================")
         logging.info("========================= start ==============================")
         logging.info("==============================================================")
 
 
 if __name__ == "__main__":
-    Main()
+    Main.start()
@@ -0,0 +1,75 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+# A job that runs every `interval` seconds (counted from the start of its last
+# run) or every day at `at` ("HH:MM"), plus a random delay of up to `jitter` seconds
+class Job:
+    def __init__(self, name, func, interval=None, at=None, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.at = at
+        self.jitter = jitter
+        self.next_run = 0
+        self.runs = 0
+
+    def schedule(self, started):
+        now = time.time()
+        if self.at is not None:
+            hour, minute = [int(part) for part in self.at.split(":")]
+            next_run = datetime.fromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if next_run.timestamp() <= now:
+                next_run += timedelta(days=1)
+            next_run = next_run.timestamp()
+        else:
+            next_run = started + self.interval
+            # A run that took longer than the interval is followed by one run, not a backlog
+            if next_run < now:
+                logging.info(f"scheduler: {self.name} ran {now - started:.0f}s, longer than its interval")
+                next_run = now
+        self.next_run = next_run + random.uniform(0, self.jitter)
+
+
+# Runs the jobs one at a time on the calling thread and sleeps until the next one
+# is due. Jobs never overlap, a job that comes due while another runs waits for it.
+class Scheduler:
+    # Wake up at least this often, so a changed wall clock is noticed
+    max_sleep = 300
+
+    def __init__(self):
+        self.jobs = []
+        self.stopped = threading.Event()
+
+    def add(self, name, func, interval=None, at=None, jitter=0, run_now=True):
+        job = Job(name, func, interval, at, jitter)
+        if not run_now:
+            job.schedule(time.time())
+        self.jobs.append(job)
+        return job
+
+    def run_forever(self):
+        while self.jobs and not self.stopped.is_set():
+            job = min(self.jobs, key=lambda job: job.next_run)
+            wait = job.next_run - time.time()
+            if wait > 0:
+                self.stopped.wait(min(wait, self.max_sleep))
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        started = time.time()
+        logging.info(f"scheduler: starting {job.name}")
+        try:
+            job.func()
+        except Exception as e:
+            logging.exception(f"scheduler: {job.name}: {e}")
+        job.runs += 1
+        job.schedule(started)
+        logging.info(f"scheduler: {job.name} took {time.time() - started:.0f}s, next at {datetime.fromtimestamp(job.next_run):%Y-%m-%d %H:%M:%S}")
+
+    def stop(self):
+        self.stopped.set()
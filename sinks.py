@@ -0,0 +1,201 @@
+import csv
+import os
+import time
+from collections import OrderedDict
+from datetime import date
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+float_columns = ["hours", "dollars", "hourly_rate"]
+
+
+# Appends the rows of one table to <directory>/<table>.csv, header first.
+# Same interface as BulkLoader, so Main writes through either.
+class CsvSink:
+    sink = "csv"
+
+    def __init__(self, directory, table, columns, batch_size=1000, flush_interval=30, part=None):
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Every writer thread appends to its own file
+        self.path = os.path.join(directory, f"{table}.csv" if not part else f"{table}-{part}.csv")
+        self.rows = []
+        self.last_flush = time.time()
+        self.inserted = 0
+        self.file = None
+
+    def set_connection(self, conn):
+        pass
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def is_due(self):
+        if len(self.rows) >= self.batch_size:
+            return True
+        return len(self.rows) > 0 and time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        if self.rows:
+            if self.file is None:
+                self.open()
+            self.writer.writerows(self.rows)
+            self.file.flush()
+        inserted = len(self.rows)
+        self.inserted += inserted
+        self.rows = []
+        self.last_flush = time.time()
+        return inserted
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, mode="a", newline="")
+        self.writer = csv.writer(self.file, delimiter=",", quotechar='"', quoting=csv.QUOTE_ALL)
+        if new_file:
+            self.writer.writerow(self.columns)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Streams the rows of one table into Parquet files partitioned by a date column,
+# <directory>/<table>/<partition>=<value>/part-<start>-<pid>-<part>-<n>.parquet (hive style,
+# the partition column lives in the directory name only). Main flushes every sink
+# together at the sql batch size, so a flush only writes the partitions that have
+# full row groups of row_group_size rows and keeps the rest. close() writes the
+# remainder and the footers, so a file is only readable once its pass is over.
+class ParquetSink:
+    sink = "parquet"
+
+    def __init__(self, directory, table, columns, partition="load_date", row_group_size=50000, flush_interval=30, part=None,
+                 max_buffered_rows=200000, max_open_files=64):
+        if pyarrow is None:
+            raise RuntimeError("The parquet sink needs pyarrow. Install it with: pip install pyarrow")
+        self.directory = os.path.join(directory, table)
+        self.table = table
+        self.columns = list(columns)
+        # Tables without the partition column fall back to load_date
+        self.partition = partition if partition in self.columns else "load_date"
+        self.partition_index = self.columns.index(self.partition)
+        self.batch_size = row_group_size
+        self.flush_interval = flush_interval
+        self.file_columns = [index for index, column in enumerate(self.columns) if column != self.partition]
+        self.schema = pyarrow.schema([(self.columns[index], self.get_type(self.columns[index])) for index in self.file_columns])
+        self.rows = []
+        # Rows waiting for a full row group, by partition value
+        self.buffers = {}
+        self.max_buffered_rows = max_buffered_rows
+        self.last_flush = time.time()
+        self.inserted = 0
+        # The open files by partition value, least recently written first
+        self.writers = OrderedDict()
+        self.max_open_files = max(1, max_open_files)
+        self.file_count = 0
+        self.part = part
+
+    def get_type(self, column):
+        if column in float_columns:
+            return pyarrow.float64()
+        if column.endswith("_date"):
+            return pyarrow.date32()
+        return pyarrow.string()
+
+    def set_connection(self, conn):
+        pass
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def is_due(self):
+        if len(self.rows) >= self.batch_size:
+            return True
+        return len(self.rows) > 0 and time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        for row in self.rows:
+            self.buffers.setdefault(row[self.partition_index], []).append(row)
+        self.rows = []
+        inserted = self.write()
+        self.last_flush = time.time()
+        return inserted
+
+    # Write the full row groups of every partition, or with last everything buffered.
+    # Past max_buffered_rows over all the partitions, the biggest partitions are
+    # written as smaller row groups until the rest fits.
+    def write(self, last=False):
+        inserted = 0
+        for value, rows in self.buffers.items():
+            inserted += self.write_rows(value, rows, len(rows) if last else len(rows) - len(rows) % self.batch_size)
+        buffered = sum(len(rows) for rows in self.buffers.values())
+        for value, rows in sorted(self.buffers.items(), key=lambda item: -len(item[1])):
+            if buffered <= self.max_buffered_rows:
+                break
+            buffered -= len(rows)
+            inserted += self.write_rows(value, rows, len(rows))
+        self.buffers = {value: rows for value, rows in self.buffers.items() if rows}
+        self.inserted += inserted
+        return inserted
+
+    # Write the first `size` rows of a partition in row groups
+    def write_rows(self, value, rows, size):
+        if not size:
+            return 0
+        writer = self.get_writer(value)
+        for start in range(0, size, self.batch_size):
+            writer.write_table(self.to_table(rows[start:min(start + self.batch_size, size)]))
+        del rows[:size]
+        return size
+
+    # A check_date partitioning can touch thousands of partitions in one pass, so past
+    # max_open_files the least recently written file is finished. The partition gets
+    # a new part file if it has more rows later.
+    def get_writer(self, value):
+        writer = self.writers.get(value)
+        if writer is not None:
+            self.writers.move_to_end(value)
+        else:
+            while len(self.writers) >= self.max_open_files:
+                self.writers.popitem(last=False)[1].close()
+            directory = os.path.join(self.directory, f"{self.partition}={value or 'unknown'}")
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file_count += 1
+            path = os.path.join(directory, f"part-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.part or 0}-{self.file_count}.parquet")
+            writer = self.writers[value] = pyarrow.parquet.ParquetWriter(path, self.schema, compression="snappy")
+        return writer
+
+    def to_table(self, rows):
+        arrays = []
+        for index, field in zip(self.file_columns, self.schema):
+            values = [row[index] for row in rows]
+            if field.type == pyarrow.date32():
+                values = [date.fromisoformat(value) if value else None for value in values]
+            elif field.type == pyarrow.string():
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.Table.from_arrays(arrays, schema=self.schema)
+
+    def close(self):
+        self.flush()
+        self.write(last=True)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = OrderedDict()
+
+
+# "sql,parquet" -> ["sql", "parquet"]
+def parse_sinks(value):
+    return [sink.strip() for sink in (value or "sql").split(",") if sink.strip()]
@@ -0,0 +1,72 @@
+import os
+import sys
+
+# The modules live at the top of the repository, next to run_me.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# A pyodbc cursor that records what is executed on its connection
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = -1
+        self.fast_executemany = False
+
+    def execute(self, query, *args):
+        self.run(query, args)
+
+    def executemany(self, query, rows):
+        self.run(query, list(rows))
+
+    def run(self, query, args):
+        query = " ".join(query.split())
+        if self.conn.fail and query.startswith(self.conn.fail):
+            raise RuntimeError(f"failed: {query}")
+        self.conn.queries.append((query, args))
+        self.rowcount = next((count for start, count in self.conn.rowcounts.items() if query.startswith(start)), -1)
+
+    def fetchone(self):
+        return self.conn.rows.pop(0) if self.conn.rows else None
+
+    def fetchmany(self, size):
+        rows, self.conn.rows = self.conn.rows[:size], self.conn.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.conn.rows = self.conn.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+# rowcounts maps the start of a query to the rowcount it reports, rows are what the
+# fetches return and a query starting with `fail` raises
+class FakeConn:
+    def __init__(self, rowcounts=None, rows=None, fail=None):
+        self.rowcounts = rowcounts or {}
+        self.rows = list(rows or [])
+        self.fail = fail
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+# A Main without __init__, so no .env, API or database, with only the given attributes
+def new_main(**attributes):
+    from run_me import Main
+    main = Main.__new__(Main)
+    main.__dict__.update(attributes)
+    return main
@@ -0,0 +1,50 @@
+import asyncio
+
+from async_engine import AsyncEngine
+from conftest import new_main
+from paginator import Paginator
+
+
+employee = {"id": "7", "links": [{"rel": "self", "href": "/employees/7"}, {"rel": "Checks", "href": "/employees/7/checks"}]}
+
+
+def make_engine():
+    engine = AsyncEngine.__new__(AsyncEngine)
+    engine.main = new_main(paginator=Paginator(None))
+    engine.requested = []
+    pages = {
+        "/employees/7": {"id": "7"},
+        "/employees/7/checks": {"results": [{"id": 3}, {"id": 2}], "nextPageUrl": "/employees/7/checks?page=2"},
+        "/employees/7/checks?page=2": {"results": [{"id": 1}], "nextPageUrl": None},
+    }
+
+    async def get_json(endpoint, url, name, scope=None):
+        engine.requested.append(url)
+        return pages.get(url)
+
+    async def get_employee_check_details(employee_check, jobs):
+        engine.requested.append(f"check {employee_check['id']}")
+        return {"id": employee_check["id"], "employeeOrganizations": []}
+
+    engine.get_json = get_json
+    engine.get_employee_check_details = get_employee_check_details
+    return engine
+
+
+def test_details_fallback_stops_at_first_check():
+    engine = make_engine()
+    details = asyncio.run(engine.get_employee_details(employee, []))
+    assert details == {"id": "7"}
+    assert "check 3" in engine.requested
+    assert "check 2" not in engine.requested and "check 1" not in engine.requested
+    # The prefetch of the second page is cancelled before it is sent
+    assert "/employees/7/checks?page=2" not in engine.requested
+
+
+def test_check_list_yields_every_page():
+    engine = make_engine()
+
+    async def run():
+        return [employee_check["id"] async for employee_check in engine.get_employee_check_list(employee)]
+
+    assert asyncio.run(run()) == [3, 2, 1]
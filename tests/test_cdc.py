@@ -0,0 +1,78 @@
+from datetime import date
+
+from conftest import FakeConn, new_main
+from run_me import Main
+
+
+def make_row(system_id, position="Cook", load_date="2026-10-16"):
+    values = {"system_id": system_id, "position": position, "load_date": load_date}
+    return tuple(values.get(column) for column in Main.employee_list_columns)
+
+
+def make_main():
+    main = new_main(employee_hashes={}, unchanged_employees=0, loaded=[])
+    main.load_row = lambda table, row: main.loaded.append((table, row))
+    return main
+
+
+def test_unchanged_employee_is_skipped():
+    main = make_main()
+    assert main.is_changed_employee(make_row("7"), 1)
+    # load_date is not part of the version
+    assert not main.is_changed_employee(make_row("7", load_date="2026-10-17"), 1)
+    assert main.unchanged_employees == 1
+    assert [table for table, _ in main.loaded] == ["employee_list_history"]
+
+
+def test_changed_employee_is_a_new_version():
+    main = make_main()
+    main.is_changed_employee(make_row("7"), 1)
+    assert main.is_changed_employee(make_row("7", position="Chef"), 1)
+    # Moving to the other list is a change too
+    assert main.is_changed_employee(make_row("7", position="Chef"), 2)
+    table, row = main.loaded[-1]
+    assert row[-1] == "2026-10-16" and row[-3] == 2
+    assert len(main.loaded) == 3
+
+
+def test_unchanged_int_id_is_skipped_after_a_reload():
+    first = make_main()
+    first.is_changed_employee(make_row(7), 1)
+    # system_id is nvarchar, the open versions come back with str ids
+    main = make_main()
+    main.cdc = main.database = True
+    main.cursor = FakeConn(rows=[(str(system_id), row_hash) for system_id, row_hash in first.employee_hashes.items()]).cursor()
+    main.load_employee_hashes()
+    assert not main.is_changed_employee(make_row(7), 1)
+    assert main.loaded == [] and main.unchanged_employees == 1
+    assert list(main.employee_hashes) == ["7"]
+
+
+def make_missing_main(**changes):
+    main = new_main(
+        cdc=True, database=True, leases=None, replay=False, conn=FakeConn(),
+        employee_hashes={"1": "a", "2": "b", "3": "c"}, seen_employees={"1", "3"}, walked_all=True,
+    )
+    main.__dict__.update(changes)
+    return main
+
+
+def test_full_pass_closes_employees_it_did_not_list():
+    main = make_missing_main()
+    main.close_missing_employees()
+    assert main.conn.queries[-1][1] == [(date.today().strftime("%Y-%m-%d"), "2")]
+    assert main.employee_hashes == {"1": "a", "3": "c"}
+
+
+def test_partial_pass_closes_nothing():
+    for change in [{"walked_all": False}, {"leases": object()}, {"replay": True}]:
+        main = make_missing_main(**change)
+        main.close_missing_employees()
+        assert main.conn.queries == []
+        assert len(main.employee_hashes) == 3
+
+
+def test_resumed_pass_is_not_a_full_walk():
+    main = new_main(leases=None, walked_all=True, resume={"client_index": 1})
+    assert list(main.claim_clients([{"id": 1}, {"id": 2}])) == [(1, {"client_index": 1})]
+    assert not main.walked_all
@@ -0,0 +1,24 @@
+from check_index import CheckIndex
+
+
+def test_load_chunks():
+    index = CheckIndex()
+    index.load([["5", "1", "ABC"], [3, "20"]])
+    assert list(index.ids) == [1, 3, 5, 20]
+    assert "ABC" in index and "20" in index and 3 in index
+    assert "4" not in index
+    assert len(index) == 5
+
+
+def test_load_sorted_chunks_keeps_order():
+    index = CheckIndex()
+    index.load([[str(number) for number in range(start, start + 10)] for start in range(0, 100, 10)])
+    assert list(index.ids) == list(range(100))
+
+
+def test_add_after_load():
+    index = CheckIndex()
+    index.load([])
+    index.add("7")
+    index.add("X-1")
+    assert "7" in index and "X-1" in index
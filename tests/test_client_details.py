@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from conftest import new_main
+from reference_cache import ReferenceCache
+
+
+client = {"id": 83, "name": "Client 83"}
+
+
+def make_details(*codes):
+    return {
+        "organizations": [{"title": "Department", "lookups": [{"code": code, "description": f"Dept {code}"} for code in codes]}],
+        "legalCompanies": [],
+    }
+
+
+def make_check(code):
+    return {"employeeOrganizations": [{"title": "Department", "value": code}]}
+
+
+def make_main(tmp_path, fresh_details):
+    main = new_main(api_endpoint="https://api.test", client_lock=threading.Lock(), fetched=[])
+    main.reference_cache = ReferenceCache(str(tmp_path / "reference.json"), 3600, main.api_endpoint)
+
+    def fetch_json(name, url):
+        main.fetched.append(url)
+        return fresh_details
+    main.fetch_json = fetch_json
+    return main
+
+
+def test_unknown_value_refreshes_client_details(tmp_path):
+    main = make_main(tmp_path, make_details("10", "20"))
+    main.set_client(client, make_details("10"))
+    record = {}
+    main.add_organizations(record, [], make_check("20"))
+    assert record["Department"] == {"code": "20", "description": "Dept 20"}
+    assert main.fetched == ["https://api.test/clients/83?includeDetails=True"]
+    # The next pass gets the new details from the cache
+    assert main.reference_cache.lookup(main.get_client_details_url(client), main.get_fingerprint(client)) == make_details("10", "20")
+
+
+def test_refresh_once_per_client(tmp_path):
+    main = make_main(tmp_path, make_details("10"))
+    main.set_client(client, make_details("10"))
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            main.add_organizations({}, [], make_check("30"))
+    assert len(main.fetched) == 1
+    main.set_client(client, make_details("10"))
+    with pytest.raises(KeyError):
+        main.add_organizations({}, [], make_check("30"))
+    assert len(main.fetched) == 2
+
+
+def test_known_value_does_not_refresh(tmp_path):
+    main = make_main(tmp_path, make_details("10"))
+    main.set_client(client, make_details("10"))
+    record = {}
+    main.add_organizations(record, [], make_check("10"))
+    assert record["Department"]["code"] == "10"
+    assert main.fetched == []
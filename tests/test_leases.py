@@ -0,0 +1,62 @@
+from conftest import FakeConn, new_main
+from leases import Leases
+
+
+clients = [{"id": 83}, {"id": 84}, {"id": 85}]
+
+
+def make_leases(rows=()):
+    conn = FakeConn({"UPDATE": 1}, rows)
+    leases = Leases(lambda: conn, "details", "w1", duration=90)
+    return leases, conn
+
+
+def test_claims_yield_the_claimed_clients():
+    leases, conn = make_leases([("85",), ("83",)])
+    assert list(leases.claims(clients)) == [2, 0]
+    query, registered = conn.queries[0]
+    assert query.startswith("MERGE work_leases")
+    assert registered == [("details", "83", 0), ("details", "84", 1), ("details", "85", 2)]
+    assert leases.held == {"83", "85"}
+    leases.close()
+
+
+def test_client_gone_from_the_list_is_completed():
+    leases, conn = make_leases([("99",)])
+    assert list(leases.claims(clients)) == []
+    completed = [args for query, args in conn.queries if "completed_at = SYSUTCDATETIME()" in query]
+    assert completed == [("details", "99", "w1")]
+    leases.close()
+
+
+def test_complete_drops_the_lease():
+    leases, conn = make_leases([("83",)])
+    list(leases.claims(clients))
+    leases.complete(83)
+    assert leases.held == set()
+    assert "completed_at = SYSUTCDATETIME()" in conn.queries[-1][0]
+    leases.close()
+
+
+def test_release_keeps_completed_at():
+    leases, conn = make_leases()
+    leases.held.add("83")
+    leases.release(83, 90)
+    query, args = conn.queries[-1]
+    assert "completed_at" not in query
+    assert args == (90, "details", "83", "w1")
+    assert leases.held == set()
+    leases.close()
+
+
+def test_unwalked_client_is_released_not_completed():
+    leases, conn = make_leases()
+    leases.held.add("83")
+    main = new_main(leases=leases)
+    main.complete_client({"id": 83}, walked=False)
+    query, args = conn.queries[-1]
+    assert "completed_at" not in query and args[0] == 90
+    leases.held.add("83")
+    main.complete_client({"id": 83})
+    assert "completed_at = SYSUTCDATETIME()" in conn.queries[-1][0]
+    leases.close()
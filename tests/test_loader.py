@@ -0,0 +1,80 @@
+import pytest
+
+from conftest import FakeConn
+from loader import BulkLoader
+
+
+columns = ["system_id", "earning_code", "earning_group", "dollars"]
+keys = ["system_id", "earning_code", "earning_group"]
+rows = [("1", "REG", "Earnings", 10.0), ("2", "REG", "Earnings", 20.0)]
+
+
+def make_loader(conn, **options):
+    loader = BulkLoader(conn, "employee_checks", columns, keys, **options)
+    for row in rows:
+        loader.add(row)
+    return loader
+
+
+def test_flush_stages_and_merges_the_batch():
+    conn = FakeConn({"WITH batch": 2})
+    loader = make_loader(conn)
+    assert loader.flush() == 2
+    queries = [query for query, _ in conn.queries]
+    assert queries[0].startswith("IF OBJECT_ID('tempdb..#stage_employee_checks') IS NULL")
+    assert queries[1] == "TRUNCATE TABLE #stage_employee_checks"
+    assert conn.queries[2] == (loader.stage_query, rows)
+    assert "NOT EXISTS (SELECT 1 FROM employee_checks t WHERE t.system_id = s.system_id AND t.earning_code = s.earning_code AND t.earning_group = s.earning_group)" in queries[3]
+    assert conn.commits == 1
+    assert loader.rows == [] and loader.inserted == 2
+
+
+def test_stage_table_is_created_once_per_connection():
+    conn = FakeConn()
+    loader = make_loader(conn)
+    loader.flush()
+    loader.add(rows[0])
+    loader.flush()
+    assert sum(query.startswith("IF OBJECT_ID") for query, _ in conn.queries) == 1
+    conn = FakeConn()
+    loader.set_connection(conn)
+    loader.add(rows[0])
+    loader.flush()
+    assert conn.queries[0][0].startswith("IF OBJECT_ID")
+
+
+def test_failed_flush_keeps_the_rows():
+    conn = FakeConn(fail="WITH batch")
+    loader = make_loader(conn)
+    with pytest.raises(RuntimeError):
+        loader.flush()
+    assert conn.rollbacks == 1 and conn.commits == 0
+    assert loader.rows == rows
+
+
+def test_due_on_batch_size():
+    loader = make_loader(FakeConn(), batch_size=3)
+    assert not loader.is_due()
+    loader.add(rows[0])
+    assert loader.is_due()
+
+
+def test_insert_counts_skipped_rows():
+    conn = FakeConn({"WITH batch": 1})
+    loader = make_loader(conn)
+    assert loader.flush() == 1
+    assert loader.skipped == 1
+    assert not any(query.startswith("DELETE") for query, _ in conn.queries)
+
+
+def test_replace_deletes_keys_before_insert():
+    conn = FakeConn({"DELETE": 2, "WITH batch": 2})
+    loader = make_loader(conn, replace=True)
+    assert loader.flush() == 2
+    queries = [query for query, _ in conn.queries]
+    delete = next(index for index, query in enumerate(queries) if query.startswith("DELETE"))
+    insert = next(index for index, query in enumerate(queries) if query.startswith("WITH batch"))
+    assert delete < insert
+    assert "t.system_id = s.system_id AND t.earning_code = s.earning_code AND t.earning_group = s.earning_group" in queries[delete]
+    assert loader.replaced == 2
+    assert loader.skipped == 0
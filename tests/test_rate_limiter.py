@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from rate_limiter import AIMDLimiter, RateController
+from run_me import Main
+
+
+def test_async_waiter_wakes_on_release():
+    limiter = AIMDLimiter(1)
+
+    async def run():
+        await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_release_from_another_thread_wakes_async_waiter():
+    limiter = AIMDLimiter(1)
+    limiter.acquire()
+
+    async def run():
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        threading.Thread(target=limiter.release).start()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+    assert limiter.in_flight == 1
+
+
+def test_cancelled_waiter_passes_the_slot_on():
+    limiter = AIMDLimiter(1)
+
+    async def run():
+        await limiter.acquire_async()
+        first = asyncio.ensure_future(limiter.acquire_async())
+        second = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        # The release wakes the first waiter, which is cancelled before it runs
+        limiter.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+
+
+def test_retry_after_pauses_every_worker_without_rate_limit():
+    rate = RateController(Main.rate_limit, None, 4)
+    assert rate.bucket.reserve() == 0
+    rate.record(429, 0.1, "30")
+    # Every later request waits, not only the one that got the 429
+    for _ in range(3):
+        assert 29 < rate.bucket.reserve() <= 30
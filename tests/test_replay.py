@@ -0,0 +1,44 @@
+import json
+from datetime import date, datetime
+
+import archive
+from archive import ArchiveReader, ResponseArchive
+from conftest import new_main
+from json_decoder import JsonDecoder
+from metrics import Metrics
+from profiler import Profiler
+from run_me import Main
+
+
+check_url = "https://api.test/employees/7/checks/3"
+
+
+def make_main(tmp_path, monkeypatch):
+    archived_at = datetime(2024, 5, 1, 6, 0).timestamp()
+    monkeypatch.setattr(archive.time, "time", lambda: archived_at)
+    responses = ResponseArchive(str(tmp_path))
+    responses.add("get_employee_check_details", check_url, json.dumps({"id": 3, "checkDate": "2024-04-30T00:00:00"}).encode())
+    responses.add("get_employee_check_list", "https://api.test/employees/7/checks", b'{"results": [], "nextPageUrl": null}')
+    responses.close()
+    return new_main(
+        replay=True, archive_reader=ArchiveReader(str(tmp_path)), json_decoder=JsonDecoder(),
+        profiler=Profiler(), metrics=Metrics(),
+    )
+
+
+def test_replayed_rows_get_the_archive_date(tmp_path, monkeypatch):
+    main = make_main(tmp_path, monkeypatch)
+    employee_check_details = main.fetch_json("get_employee_check_details", check_url)
+    assert main.get_load_date(employee_check_details) == "2024-05-01"
+    rows = []
+    main.load_row = lambda table, row: rows.append(row)
+    main.count_row = lambda legal_code, facility_name: None
+    main.insert_employee_checks({"id": 7}, employee_check_details)
+    load_date = Main.employee_checks_columns.index("load_date")
+    assert rows and all(row[load_date] == "2024-05-01" for row in rows)
+
+
+def test_list_pages_are_not_dated(tmp_path, monkeypatch):
+    main = make_main(tmp_path, monkeypatch)
+    assert "_fetched_at" not in main.fetch_json("get_employee_check_list", "https://api.test/employees/7/checks")
+    assert main.get_load_date({}) == date.today().strftime("%Y-%m-%d")
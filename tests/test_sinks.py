@@ -0,0 +1,50 @@
+import pytest
+
+from sinks import ParquetSink
+
+pyarrow = pytest.importorskip("pyarrow")
+
+
+columns = ["system_id", "dollars", "load_date"]
+
+
+def test_parquet_row_groups_reach_row_group_size(tmp_path):
+    sink = ParquetSink(str(tmp_path), "employee_checks", columns, row_group_size=5)
+    for flush in range(4):
+        for number in range(3):
+            sink.add((f"{flush}-{number}", 1.0, "2026-01-02"))
+        sink.flush()
+    # 12 rows in flushes of 3: two full row groups written, 2 rows kept
+    assert sink.inserted == 10
+    sink.close()
+    assert sink.inserted == 12
+    [path] = (tmp_path / "employee_checks" / "load_date=2026-01-02").iterdir()
+    metadata = pyarrow.parquet.ParquetFile(str(path)).metadata
+    assert [metadata.row_group(index).num_rows for index in range(metadata.num_row_groups)] == [5, 5, 2]
+
+
+def test_parquet_buffered_rows_are_capped(tmp_path):
+    sink = ParquetSink(str(tmp_path), "employee_checks", columns, row_group_size=5, max_buffered_rows=6)
+    for day in range(1, 5):
+        sink.add((f"{day}-1", 1.0, f"2026-01-0{day}"))
+        sink.add((f"{day}-2", 1.0, f"2026-01-0{day}"))
+    sink.add(("4-3", 1.0, "2026-01-04"))
+    sink.flush()
+    # 9 rows over 4 partitions: the biggest one is written early
+    assert sink.inserted == 3
+    assert sorted(sink.buffers) == ["2026-01-01", "2026-01-02", "2026-01-03"]
+    sink.close()
+    assert sink.inserted == 9
+
+
+def test_parquet_open_files_are_capped(tmp_path):
+    sink = ParquetSink(str(tmp_path), "employee_checks", columns, row_group_size=1, max_open_files=2)
+    for day in [1, 2, 3, 1]:
+        sink.add((str(day), 1.0, f"2026-01-0{day}"))
+        sink.flush()
+        assert len(sink.writers) <= 2
+    sink.close()
+    # The first file of 2026-01-01 was finished to open 2026-01-03, the next row went to a new one
+    paths = sorted((tmp_path / "employee_checks" / "load_date=2026-01-01").iterdir())
+    assert len(paths) == 2
+    assert sum(pyarrow.parquet.ParquetFile(str(path)).metadata.num_rows for path in tmp_path.glob("employee_checks/*/*.parquet")) == 4
@@ -0,0 +1,133 @@
+from conftest import FakeConn, new_main
+from metrics import Metrics
+from paginator import Paginator
+from profiler import Profiler
+from request_cache import RequestCache
+
+
+employee = {"id": "7", "links": [{"rel": "Checks", "href": "/employees/7/checks"}]}
+
+
+def make_check(check_id, day):
+    return {"id": check_id, "checkDate": f"2026-01-{day:02}T00:00:00"}
+
+
+# Checks 10 down to 1 on pages of 3, newest first
+def make_pages():
+    checks = [make_check(check_id, check_id) for check_id in range(10, 0, -1)]
+    pages = {}
+    for number, start in enumerate(range(0, len(checks), 3), 1):
+        next_url = f"/employees/7/checks?page={number + 1}" if start + 3 < len(checks) else None
+        url = "/employees/7/checks" if number == 1 else f"/employees/7/checks?page={number}"
+        pages[url] = {"results": checks[start:start + 3], "nextPageUrl": next_url}
+    return pages
+
+
+def make_main(pages, check_list_order="newest_first"):
+    main = new_main(
+        name="checks", check_list_order=check_list_order, paginator=Paginator(lambda name, url, scope: pages.get(url)),
+        request_cache=RequestCache(), use_check_index=False, watermarks={},
+    )
+    main.get_employee_jobs = lambda employee: []
+    main.get_employee_check_details = lambda employee_check, jobs: dict(employee_check)
+    return main
+
+
+def test_select_new_checks_without_watermark():
+    main = make_main({})
+    checks = [make_check(3, 3), make_check(5, 5), make_check(4, 4)]
+    new_checks, watermark = main.select_new_checks(checks, None, "/page")
+    assert [check["id"] for check in new_checks] == [5, 4, 3]
+    assert watermark == {"check_id": "5", "check_date": "2026-01-05", "page_url": "/page"}
+
+
+def test_select_new_checks_stops_at_known_check():
+    main = make_main({})
+    checks = [make_check(6, 6), make_check(5, 5), make_check(4, 4)]
+    watermark = {"check_id": "5", "check_date": "2026-01-05", "page_url": None}
+    new_checks, new_watermark = main.select_new_checks(checks, watermark, "/page")
+    assert [check["id"] for check in new_checks] == [6]
+    assert new_watermark["check_id"] == "6"
+
+
+def test_select_new_checks_nothing_new():
+    main = make_main({})
+    watermark = {"check_id": "5", "check_date": "2026-01-05", "page_url": None}
+    assert main.select_new_checks([make_check(5, 5), make_check(4, 4)], watermark, "/page") == ([], None)
+
+
+def test_select_new_checks_oldest_first_same_day():
+    main = make_main({}, "oldest_first")
+    checks = [make_check(1, 5), make_check(2, 5)]
+    new_checks, watermark = main.select_new_checks(checks, None, "/page")
+    # Later in an oldest first list is newer
+    assert watermark["check_id"] == "2"
+
+
+def test_reached_watermark():
+    main = make_main({})
+    watermark = {"check_id": "5", "check_date": "2026-01-05", "page_url": None}
+    assert not main.reached_watermark([make_check(7, 7), make_check(6, 6)], watermark)
+    assert main.reached_watermark([make_check(6, 6), make_check(5, 5)], watermark)
+    # An older check also means the watermark is behind
+    assert main.reached_watermark([make_check(3, 3)], watermark)
+    assert not main.reached_watermark([make_check(3, 3)], None)
+
+
+def test_reached_watermark_oldest_first_never_stops():
+    main = make_main({}, "oldest_first")
+    watermark = {"check_id": "5", "check_date": "2026-01-05", "page_url": None}
+    assert not main.reached_watermark([make_check(5, 5)], watermark)
+
+
+def test_walk_stops_at_watermark():
+    main = make_main(make_pages())
+    watermark = {"check_id": "5", "check_date": "2026-01-05", "page_url": None}
+    checks, last_page_url, walked = main.walk_employee_check_list(employee, watermark)
+    assert [check["id"] for check in checks] == [10, 9, 8, 7, 6, 5]
+    assert last_page_url == "/employees/7/checks?page=2"
+    assert walked
+
+
+def test_walk_reports_failed_page():
+    pages = make_pages()
+    del pages["/employees/7/checks?page=2"]
+    main = make_main(pages)
+    checks, last_page_url, walked = main.walk_employee_check_list(employee, None)
+    assert [check["id"] for check in checks] == [10, 9, 8]
+    assert not walked
+
+
+def test_failed_walk_keeps_watermark():
+    pages = make_pages()
+    del pages["/employees/7/checks?page=2"]
+    main = make_main(pages)
+    main.watermarks = {"7": {"check_id": "5", "check_date": "2026-01-05", "page_url": None}}
+    _, rows, watermark = main.fetch_employee(employee)
+    # The checks that were read are loaded, the watermark stays for the next pass
+    assert [row["id"] for row in rows] == [10, 9, 8]
+    assert watermark is None
+
+
+def test_walked_employee_moves_watermark():
+    main = make_main(make_pages())
+    main.watermarks = {"7": {"check_id": "5", "check_date": "2026-01-05", "page_url": None}}
+    _, rows, watermark = main.fetch_employee(employee)
+    assert [row["id"] for row in rows] == [10, 9, 8, 7, 6]
+    assert watermark["check_id"] == "10"
+
+
+def test_int_id_watermark_survives_a_reload():
+    main = new_main(
+        name="checks", incremental=True, database=True, replay=False, cdc=False, writer=None,
+        metrics=Metrics(), profiler=Profiler(), pending_watermarks={}, watermarks={},
+    )
+    watermark = {"check_id": "10", "check_date": "2026-01-10", "page_url": None}
+    main.store_employee(({"id": 7}, [], watermark))
+    conn = FakeConn()
+    main.save_watermarks(main.pending_watermarks, conn)
+    # employee_system_id is nvarchar, so the saved rows come back with str ids
+    conn.rows = [tuple(str(value) if value is not None else None for value in row) for row in conn.queries[-1][1]]
+    main.cursor = conn.cursor()
+    main.load_watermarks()
+    assert main.get_watermark({"id": 7}) == watermark
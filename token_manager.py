@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+
+
+# Hands out the OAuth token and refreshes it ahead of its expires_in.
+# Only one thread refreshes at a time, the others wait for its token.
+class TokenManager:
+    refresh_margin = 60
+    default_expires_in = 300
+    retry_delay = 5
+
+    def __init__(self, request_token, refresh_token=None, refresh_margin=None):
+        self.request_token = request_token
+        self.refresh_token = refresh_token
+        self.refresh_margin = self.refresh_margin if refresh_margin is None else refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.refresh_at = 0
+        self.retry_at = 0
+        self.refresh_count = 0
+
+    # The current access token, refreshed first if it is about to expire. None if that failed.
+    def get_access_token(self):
+        access_token = self.peek()
+        if access_token is not None:
+            return access_token
+        with self.lock:
+            # Another thread may have refreshed it while this one waited for the lock
+            access_token = self.peek()
+            if access_token is not None:
+                return access_token
+            # After a failed refresh wait a bit instead of hitting /token on every request
+            if time.time() >= self.retry_at:
+                self.refresh()
+            return self.token["access_token"] if self.token else None
+
+    # The access token if it does not need a refresh yet, without blocking
+    def peek(self):
+        token = self.token
+        if token is not None and time.time() < self.refresh_at:
+            return token["access_token"]
+        return None
+
+    # A request got 401 with this access token. Only the first caller drops the
+    # token, the rest see it already replaced and retry with the new one.
+    def invalidate(self, access_token):
+        with self.lock:
+            if self.token is not None and self.token.get("access_token") == access_token:
+                self.refresh_at = 0
+
+    def refresh(self):
+        token = None
+        if self.refresh_token is not None and self.token and self.token.get("refresh_token"):
+            token = self.refresh_token(self.token["refresh_token"])
+        if not token:
+            token = self.request_token()
+        if not token:
+            logging.error("token_manager: refresh failed")
+            self.retry_at = time.time() + self.retry_delay
+            return
+
+        expires_in = float(token.get("expires_in") or self.default_expires_in)
+        margin = min(self.refresh_margin, expires_in / 2)
+        self.token = token
+        self.refresh_at = time.time() + expires_in - margin
+        self.refresh_count += 1
+        logging.info(f"token_manager: refreshed, expires_in: {expires_in} | refresh in: {expires_in - margin}")